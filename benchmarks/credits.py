@@ -0,0 +1,56 @@
+"""
+Measures time and peak memory for extracting the cast of a synthetic full credits page,
+once with a BeautifulSoup tree (the former *parser.cast*) and once with the streaming
+*parser.credits*. Memory figures need Python 3.
+
+    python -m benchmarks.credits -n 5000
+"""
+import time
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from lib import parser
+from benchmarks.pages import credits_page
+
+
+def soup_cast(source):
+    """*parser.cast* as it was before the streaming credits parser."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(source, 'html.parser')
+    return [a.get('href').split('/', 3)[2]
+            for a in soup.find(id='fullcredits-content').find_all('a')]
+
+def measure(func, source, rounds):
+    """Returns the seconds per call and, in a separate traced call, the peak memory."""
+    start = time.time()
+    for _ in range(rounds):
+        func(source)
+    elapsed = (time.time() - start) / rounds
+    peak = 0
+    if tracemalloc:
+        tracemalloc.start()
+        func(source)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--credits', type=int, default=5000)
+    ap.add_argument('-r', '--rounds', type=int, default=3)
+    args = ap.parse_args()
+
+    source = credits_page(args.credits)
+    assert len(parser.cast(source)) == args.credits
+    print('page: {} credits, {:.1f} MB'.format(args.credits, len(source) / 1e6))
+    for name, func in (('soup', soup_cast), ('streaming', parser.cast)):
+        elapsed, peak = measure(func, source, args.rounds)
+        print('{:<10} {:8.1f} ms/page {:8.1f} MB peak'.format(name, elapsed * 1000, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures model lookups per second against a local SQLite file, once with an engine built
+for every lookup (the behaviour before engines were cached) and once with the process wide
+engine of *lib.database*, and finally all at once through *get_cached_models*.
+
+    python -m benchmarks.database -n 2000
+"""
+import os
+import time
+import argparse
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from lib import database
+from lib.models import Base, Movie, TVShow, Person
+
+
+def legacy_get_cached_model(model_id, db_uri):
+    """*get_cached_model* as it used to be: new engine, session factory and schema check."""
+    engine = create_engine(db_uri)
+    db = sessionmaker(bind=engine)()
+    Base.metadata.create_all(engine)
+    try:
+        for m in (Movie, TVShow, Person):
+            existing_model = db.query(m).get(model_id)
+            if existing_model:
+                return existing_model
+    finally:
+        db.close()
+        engine.dispose()
+
+def populate(db_uri, count):
+    """Stores *count* people and returns their identifiers."""
+    ids = ['nm{:07d}'.format(i) for i in range(count)]
+    with database.session_scope(db_uri) as db:
+        for model_id in ids:
+            db.add(Person(id=model_id, firstname='First', lastname='Last'))
+    return ids
+
+def run(lookup, ids, db_uri):
+    start = time.time()
+    for model_id in ids:
+        lookup(model_id, db_uri)
+    return len(ids) / (time.time() - start)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--lookups', type=int, default=1000)
+    args = ap.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    db_uri = 'sqlite:///' + db_path
+    try:
+        ids = populate(db_uri, args.lookups)
+        before = run(legacy_get_cached_model, ids, db_uri)
+        database.clear_model_cache(db_uri)
+        after = run(database.get_cached_model, ids, db_uri)
+        database.clear_model_cache(db_uri)
+        start = time.time()
+        database.get_cached_models(ids, db_uri)
+        bulk = len(ids) / (time.time() - start)
+        print('lookups: {}'.format(len(ids)))
+        print('before:  {:10.1f} lookups/sec'.format(before))
+        print('after:   {:10.1f} lookups/sec'.format(after))
+        print('bulk:    {:10.1f} lookups/sec'.format(bulk))
+        print('speedup: {:10.1f}x'.format(after / before))
+    finally:
+        database.dispose_db(db_uri)
+        os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    main()
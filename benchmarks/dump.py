@@ -0,0 +1,58 @@
+"""
+Measures rows per second for exporting a database to a dump and loading the dump into an
+empty database. The source database holds synthetic people, movies and cast edges.
+
+    python -m benchmarks.dump -n 100000
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from lib import database, dump
+from lib.models import Movie, Person, actor_movie
+
+
+def populate(db_uri, count):
+    """Stores *count* people, *count* movies and five cast edges per movie."""
+    with database.session_scope(db_uri) as db:
+        db.execute(Person.__table__.insert(),
+                   [{'id': 'nm{:07d}'.format(i), 'firstname': 'First', 'lastname': 'Last'}
+                    for i in range(count)])
+        db.execute(Movie.__table__.insert(),
+                   [{'id': 'tt{:07d}'.format(i), 'title': 'Title', 'rating': 7.0,
+                     'plot': 'A plot.', 'release_year': 2000} for i in range(count)])
+        db.execute(actor_movie.insert(),
+                   [{'actor_id': 'nm{:07d}'.format((i * 7 + j) % count),
+                     'movie_id': 'tt{:07d}'.format(i)} for i in range(count) for j in range(5)])
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--models', type=int, default=50000)
+    ap.add_argument('--gzip', action='store_true', default=False)
+    args = ap.parse_args()
+
+    directory = tempfile.mkdtemp()
+    source_uri = 'sqlite:///' + os.path.join(directory, 'source.db')
+    target_uri = 'sqlite:///' + os.path.join(directory, 'target.db')
+    path = os.path.join(directory, 'dump.jsonl' + ('.gz' if args.gzip else ''))
+    try:
+        populate(source_uri, args.models)
+        start = time.time()
+        rows = sum(dump.dump(path, source_uri).values())
+        elapsed = time.time() - start
+        print('export: {:10.1f} rows/sec, {} rows, {:.1f} MB'.format(
+            rows / elapsed, rows, os.path.getsize(path) / 1e6))
+        database.init_db(target_uri)
+        start = time.time()
+        dump.load(path, target_uri)
+        print('import: {:10.1f} rows/sec'.format(rows / (time.time() - start)))
+    finally:
+        database.dispose_db(source_uri)
+        database.dispose_db(target_uri)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
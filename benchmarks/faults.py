@@ -0,0 +1,54 @@
+"""
+Measures the throughput and the share of pages fetched intact from a local stand-in server
+which injects errors, stalls and throttling, once with a fetch policy which never retries
+nor times out and once with retries, timeouts and adaptive throttling.
+
+    python -m benchmarks.faults -n 300 --error-rate 0.1 --stall-rate 0.02 --max-rate 200
+"""
+import time
+import argparse
+
+from lib.fetch import Fetcher
+from lib.policy import FetchPolicy
+from lib.tests.server import StandInServer, Faults
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--pages', type=int, default=300)
+    ap.add_argument('-c', '--concurrency', type=int, default=8)
+    ap.add_argument('--delay', type=float, default=0.01)
+    ap.add_argument('--error-rate', type=float, default=0.1)
+    ap.add_argument('--stall-rate', type=float, default=0.02)
+    ap.add_argument('--stall', type=float, default=2.0,
+                    help='Seconds a stalled answer is held back')
+    ap.add_argument('--max-rate', type=float, default=200,
+                    help='Requests per second beyond which the server answers 429')
+    ap.add_argument('--timeout', type=float, default=0.5,
+                    help='Transfer timeout of the retrying policy')
+    args = ap.parse_args()
+
+    policies = (
+        ('no policy', FetchPolicy(timeout=0, retries=0, breaker_threshold=args.pages)),
+        ('policy', FetchPolicy(timeout=args.timeout, retries=5, backoff=0.05, max_backoff=1,
+                               breaker_threshold=args.pages)),
+    )
+    for name, policy in policies:
+        faults = Faults(error_rate=args.error_rate, stall_rate=args.stall_rate,
+                        stall=args.stall, max_rate=args.max_rate, retry_after=0)
+        with StandInServer(delay=args.delay, faults=faults) as server:
+            paths = list(server.pages)
+            urls = [server.url + paths[i % len(paths)] for i in range(args.pages)]
+            fetcher = Fetcher(concurrency=args.concurrency, policy=policy)
+            start = time.time()
+            fetched = sum(1 for _, source in fetcher.fetch(urls)
+                          if source and 'pageId' in source)
+            elapsed = time.time() - start
+            fetcher.close()
+        print('{:>10} {:8.1f} pages/sec {:6.1f}% intact {:6} requests  {}'.format(
+            name, fetched / elapsed, 100.0 * fetched / len(urls), server.requests,
+            policy.summary()))
+
+
+if __name__ == '__main__':
+    main()
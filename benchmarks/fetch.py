@@ -0,0 +1,46 @@
+"""
+Measures pages per second fetched from the local stand-in server for a range of
+*Fetcher* concurrency limits. The server delays every response to simulate latency.
+With --stream the fetchers stop every transfer once the model of the page is complete
+and the bytes saved per page are printed as well.
+
+    python -m benchmarks.fetch -n 200 --delay 0.02 --stream
+"""
+import time
+import argparse
+
+from lib.crawl import process_url
+from lib.fetch import Fetcher
+from lib.tests.server import StandInServer
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--pages', type=int, default=200)
+    ap.add_argument('--delay', type=float, default=0.02)
+    ap.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    ap.add_argument('--stream', action='store_true', default=False)
+    args = ap.parse_args()
+
+    with StandInServer(delay=args.delay) as server:
+        paths = list(server.pages)
+        urls = [server.url + paths[i % len(paths)] for i in range(args.pages)]
+
+        start = time.time()
+        for url in urls:
+            process_url(url)
+        print('{:>12} {:10.1f} pages/sec'.format('sequential', len(urls) / (time.time() - start)))
+
+        for concurrency in args.concurrency:
+            fetcher = Fetcher(concurrency=concurrency, stream=args.stream)
+            start = time.time()
+            fetched = sum(1 for _, source in fetcher.fetch(urls, model_pages=True) if source)
+            elapsed = time.time() - start
+            fetcher.close()
+            print('{:>12} {:10.1f} pages/sec'.format('c=' + str(concurrency), fetched / elapsed))
+            if args.stream:
+                print('{:>12} {}'.format('', fetcher.summary()))
+
+
+if __name__ == '__main__':
+    main()
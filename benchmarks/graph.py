@@ -0,0 +1,62 @@
+"""
+Measures building, snapshot loading and shortest path queries of the cast graph on a
+synthetic graph. Every title gets a cast of random people, where a few people are far more
+likely to be cast than the rest, like on IMDb.
+
+    python -m benchmarks.graph --titles 100000 --cast 10
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from lib.graph import CastGraph
+
+
+def synthetic_edges(titles, people, cast):
+    """Returns (person number, title number) edges, *cast* people per title."""
+    rnd = random.Random(42)
+    edges = []
+    for title in range(1, titles + 1):
+        for _ in range(cast):
+            edges.append((int(people * rnd.random() ** 2) + 1, title))
+    return edges
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--titles', type=int, default=100000)
+    ap.add_argument('--people', type=int, default=200000)
+    ap.add_argument('--cast', type=int, default=10)
+    ap.add_argument('-q', '--queries', type=int, default=200)
+    args = ap.parse_args()
+
+    edges = synthetic_edges(args.titles, args.people, args.cast)
+    start = time.time()
+    graph = CastGraph.from_edges(edges)
+    print('build:    {:10.1f} ms for {} edges'.format((time.time() - start) * 1000, len(graph)))
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        graph.save(path)
+        start = time.time()
+        loaded = CastGraph.load(path)
+        print('load:     {:10.1f} ms'.format((time.time() - start) * 1000))
+
+        rnd = random.Random(7)
+        pairs = [('nm{:07d}'.format(rnd.choice(graph.people)),
+                  'nm{:07d}'.format(rnd.choice(graph.people))) for _ in range(args.queries)]
+        for name, g in (('memory', graph), ('snapshot', loaded)):
+            start = time.time()
+            lengths = [len(g.shortest_path(a, b) or ()) // 2 for a, b in pairs]
+            elapsed = (time.time() - start) * 1000 / len(pairs)
+            print('{:<9} {:10.2f} ms/path, {:.1f} degrees on average'.format(
+                name + ':', elapsed, sum(lengths) / float(len(lengths))))
+        loaded.close()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
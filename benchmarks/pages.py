@@ -0,0 +1,22 @@
+"""Synthetic page generators for benchmarks which need inputs larger than the fixtures."""
+
+def credits_page(count):
+    """Returns a full credits page listing *count* people with their characters."""
+    rows = []
+    for i in range(count):
+        rows.append(
+            '<tr class="{parity}">\n'
+            '  <td class="primary_photo"><a href="/name/nm{id:07d}/?ref_=ttfc_fc_cl_i{n}">'
+            '<img height="44" width="32" alt="Person {n}" src="/p/{id}.jpg"></a></td>\n'
+            '  <td><a href="/name/nm{id:07d}/?ref_=ttfc_fc_cl_t{n}"> Person {n}\n</a></td>\n'
+            '  <td class="ellipsis"> ... </td>\n'
+            '  <td class="character">\n'
+            '    <a href="/title/tt0000001/characters/nm{id:07d}">Character {n}</a>\n'
+            '  </td>\n'
+            '</tr>'.format(parity='odd' if i % 2 else 'even', id=i + 1, n=i + 1))
+    return ('<!DOCTYPE html>\n<html><head><title>Full Cast &amp; Crew</title>'
+            '<meta charset="utf-8"></head>\n<body>\n<div id="header"><a href="/">IMDb</a>'
+            '</div>\n<div id="fullcredits-content" class="header">\n'
+            '<table class="cast_list">\n' + '\n'.join(rows) + '\n</table>\n</div>\n'
+            '<div id="footer"><a href="/name/nm9999999/">Not a credit</a></div>\n'
+            '</body></html>\n')
@@ -0,0 +1,52 @@
+"""
+Measures pages and bytes per second for extracting every field of the fixture pages, once
+field by field like the factory used to and once with the single pass *parser.extract*.
+
+    python -m benchmarks.parser -n 200
+"""
+import os
+import time
+import argparse
+
+from lib import parser
+from lib.tests.server import here
+
+
+def per_field(source):
+    """Extracts a page the way the factory did before *parser.extract* existed."""
+    model_type = parser.model_type(source)
+    if model_type == 'actor':
+        return (parser.model_id(source), parser.fullname(source), parser.birthday(source))
+    fields = (parser.model_id(source), parser.title(source), parser.poster(source),
+              parser.rating(source), parser.plot(source), parser.release_year(source),
+              parser.genres(source))
+    if model_type == 'movie':
+        fields += (parser.duration(source),)
+    return fields
+
+def run(extractor, sources, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        for source in sources:
+            extractor(source)
+    elapsed = time.time() - start
+    pages = len(sources) * rounds
+    return pages / elapsed, sum(len(s) for s in sources) * rounds / elapsed
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--rounds', type=int, default=200)
+    args = ap.parse_args()
+
+    sources = []
+    for filename in ('the_matrix.html', 'black_mirror.html', 'morgan_freeman.html'):
+        with open(os.path.join(here, 'files', filename)) as f:
+            sources.append(f.read())
+
+    for name, extractor in (('per field', per_field), ('extract', parser.extract)):
+        pages, nbytes = run(extractor, sources, args.rounds)
+        print('{:<10} {:10.1f} pages/sec {:8.1f} MB/sec'.format(name, pages, nbytes / 1e6))
+
+
+if __name__ == '__main__':
+    main()
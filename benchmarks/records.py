@@ -0,0 +1,72 @@
+"""
+Measures the latency and the peak memory of printing a large cached search result set,
+once through the ORM relationships of *get_search_results* and once through the Core
+UNION query of *records.search_result_records*.
+
+    python -m benchmarks.records -n 5000
+"""
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from lib import database, records
+from lib.models import Movie, Person
+
+
+def populate(db_uri, count):
+    """Stores a search result set of *count* people and *count* movies."""
+    models = []
+    with database.WriteBuffer(db_uri, max_rows=10000) as buffer:
+        for i in range(count):
+            models.append(Person(id='nm{:07d}'.format(i), firstname='First', lastname='Last'))
+            models.append(Movie(id='tt{:07d}'.format(i), title='Title', poster=None, rating=7.0,
+                                plot='A plot.', duration=None, release_year=2000, genres=[]))
+            buffer.add_model(models[-2])
+            buffer.add_model(models[-1])
+    database.store_search_results('query', models, db_uri)
+
+def consume(results):
+    """Formats every result the way *print_model* does, without printing."""
+    for model in results:
+        if model.id.startswith('tt'):
+            u'{} {} {} {}'.format(model.id, model.title, model.release_year, model.rating)
+        else:
+            u'{} {} {}'.format(model.id, model.firstname, model.lastname)
+
+def run(reader, db_uri, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        consume(reader('query', db_uri))
+    elapsed = (time.time() - start) / rounds
+    # Memory is measured in a separate pass, tracing slows the reads down.
+    tracemalloc.start()
+    consume(reader('query', db_uri))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--results', type=int, default=5000)
+    ap.add_argument('-r', '--rounds', type=int, default=5)
+    args = ap.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    db_uri = 'sqlite:///' + db_path
+    try:
+        populate(db_uri, args.results)
+        for name, reader in (('orm', database.get_search_results),
+                             ('records', records.search_result_records)):
+            elapsed, peak = run(reader, db_uri, args.rounds)
+            print('{:<8} {:8.1f} ms/search {:8.1f} KB peak'.format(name, elapsed * 1000,
+                                                                   peak / 1024.0))
+    finally:
+        database.dispose_db(db_uri)
+        os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Measures how the throughput of *reparse* scales with the amount of parser processes. A
+temporary page cache is filled with copies of the fixture pages under distinct identifiers
+and parsed into a temporary database once per process count.
+
+    python -m benchmarks.reparse -n 5000 -j 1 2 4 8
+"""
+import os
+import re
+import shutil
+import argparse
+import tempfile
+
+from lib import database, pagecache
+from lib.reparse import reparse
+from lib.tests.server import load_fixture_pages
+
+
+def fill_cache(cache, count):
+    """Stores *count* pages, each fixture page with the identifiers rewritten."""
+    pages = list(load_fixture_pages().items())
+    for i in range(count):
+        path, body = pages[i % len(pages)]
+        model_id = path.rsplit('/', 1)[1]
+        new_id = '{}{:07d}'.format(model_id[:2], i + 1)
+        body = re.sub(model_id.encode('ascii'), new_id.encode('ascii'), body)
+        cache.put('http://www.imdb.com' + path.replace(model_id, new_id), body)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--pages', type=int, default=3000)
+    ap.add_argument('-j', '--processes', type=int, nargs='+', default=[1, 2, 4])
+    ap.add_argument('--chunk-size', type=int, default=64)
+    args = ap.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = pagecache.PageCache(directory, max_bytes=float('inf'))
+        fill_cache(cache, args.pages)
+        base = None
+        for processes in args.processes:
+            db_fd, db_filepath = tempfile.mkstemp()
+            db_uri = 'sqlite:///' + db_filepath
+            try:
+                stats = reparse(cache, db_uri, processes=processes, chunk_size=args.chunk_size)
+            finally:
+                database.dispose_db(db_uri)
+                os.close(db_fd)
+                os.unlink(db_filepath)
+            rate = stats['pages'] / stats['seconds']
+            base = base or rate
+            print('{:>3} processes {:10.1f} pages/sec {:6.2f}x'.format(processes, rate,
+                                                                       rate / base))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Runs the offline benchmark suite over the hot paths and saves the results as JSON.
+
+The suite needs no network: pages come from the fixtures, served by the local stand-in
+server where a fetch is involved, and from the synthetic generators for scaled inputs. Every
+case reports a rate where higher is better; the best of *--repeat* runs counts.
+
+    python -m benchmarks.suite -o before.json
+    python -m benchmarks.suite -o after.json
+    python -m benchmarks.suite --compare before.json after.json
+
+--compare with a single file runs the suite and compares against that file. Cases which
+got slower by more than *--threshold* are flagged and make the command exit with status 1.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+from lib import constants, crawl, database, factory, pagecache, parser, search
+from lib.models import Movie, Person
+from lib.tests.server import StandInServer, load_fixture_pages
+from benchmarks.pages import credits_page
+
+cases = []
+
+def case(name, unit):
+    """Registers the decorated function as the benchmark *name* measured in *unit*."""
+    def register(func):
+        cases.append((name, unit, func))
+        return func
+    return register
+
+def best_rate(func, count, repeat, setup=None):
+    """Returns *count* divided by the fastest of *repeat* calls to *func*. *setup* runs
+    before every call and isn't timed."""
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / max(best, 1e-9)
+
+
+class Workspace(object):
+    """Lazily built inputs shared by the cases, removed by *close*."""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.directory = tempfile.mkdtemp()
+        self.sources = [body.decode('utf-8') for body in load_fixture_pages().values()]
+        self._people_uri = None
+        self.server = None
+
+    def db_uri(self, name):
+        return 'sqlite:///' + os.path.join(self.directory, name + '.db')
+
+    def people_uri(self):
+        """A database with *scale* people and their search index."""
+        if self._people_uri is None:
+            self._people_uri = self.db_uri('people')
+            rnd = random.Random(1)
+            names = ['Morgan', 'Keanu', 'Carrie', 'Laurence', 'Hugo', 'Gloria', 'Joe', 'Ann']
+            with database.session_scope(self._people_uri) as db:
+                for i in range(0, self.scale, 10000):
+                    db.execute(Person.__table__.insert(), [
+                        {'id': 'nm{:07d}'.format(n), 'firstname': rnd.choice(names),
+                         'lastname': rnd.choice(names) + 'son'}
+                        for n in range(i, min(i + 10000, self.scale))])
+            search.has_fts(self._people_uri)
+        return self._people_uri
+
+    def stand_in(self):
+        if self.server is None:
+            self.server = StandInServer().__enter__()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.__exit__(None, None, None)
+        for uri in list(database._engines):
+            if uri.startswith('sqlite:///' + self.directory):
+                database.dispose_db(uri)
+        shutil.rmtree(self.directory)
+
+
+class silenced(object):
+    """Swallows stdout, e.g. the progress lines of *store_cast_member*."""
+
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+#
+# Cases
+#
+
+@case('parser.extract', 'pages/sec')
+def bench_extract(ws, repeat):
+    rounds = 200
+    return best_rate(lambda: [parser.extract(s) for _ in range(rounds) for s in ws.sources],
+                     rounds * len(ws.sources), repeat)
+
+@case('factory.model_builder', 'pages/sec')
+def bench_model_builder(ws, repeat):
+    db_uri = ws.db_uri('builder')
+    rounds = 100
+    return best_rate(lambda: [factory.model_builder(s, db_uri)
+                              for _ in range(rounds) for s in ws.sources],
+                     rounds * len(ws.sources), repeat)
+
+@case('parser.cast[1k credits]', 'pages/sec')
+def bench_cast(ws, repeat):
+    source = credits_page(1000)
+    rounds = 20
+    return best_rate(lambda: [parser.cast(source) for _ in range(rounds)], rounds, repeat)
+
+@case('get_cached_model[cold]', 'lookups/sec')
+def bench_get_cached_model_cold(ws, repeat):
+    db_uri = ws.people_uri()
+    ids = ['nm{:07d}'.format(n) for n in random.Random(2).sample(range(ws.scale), 2000)]
+    return best_rate(lambda: [database.get_cached_model(i, db_uri) for i in ids], len(ids),
+                     repeat, setup=lambda: database.clear_model_cache(db_uri))
+
+@case('get_cached_model[warm]', 'lookups/sec')
+def bench_get_cached_model_warm(ws, repeat):
+    db_uri = ws.people_uri()
+    ids = ['nm{:07d}'.format(n) for n in random.Random(3).sample(range(ws.scale), 2000)]
+    database.get_cached_models(ids, db_uri)
+    return best_rate(lambda: [database.get_cached_model(i, db_uri) for i in ids], len(ids),
+                     repeat)
+
+@case('get_cached_models[bulk]', 'lookups/sec')
+def bench_get_cached_models(ws, repeat):
+    db_uri = ws.people_uri()
+    ids = ['nm{:07d}'.format(n) for n in random.Random(4).sample(range(ws.scale), 2000)]
+    return best_rate(lambda: database.get_cached_models(ids, db_uri), len(ids), repeat,
+                     setup=lambda: database.clear_model_cache(db_uri))
+
+@case('store_cast_member', 'edges/sec')
+def bench_store_cast_member(ws, repeat):
+    db_uri = ws.db_uri('edges')
+    movie = Movie(id='tt0000001', title='Title', poster=None, rating=None, plot=None,
+                  duration=None, release_year=None, genres=[])
+    people = [Person(id='nm{:07d}'.format(i), firstname='First') for i in range(200)]
+
+    def store():
+        with silenced():
+            for person in people:
+                database.store_cast_member(movie, person, db_uri)
+
+    def clear():
+        with database.session_scope(db_uri) as db:
+            db.execute('DELETE FROM tbl_actor_movie')
+    return best_rate(store, len(people), repeat, setup=clear)
+
+@case('WriteBuffer.add_cast_member', 'edges/sec')
+def bench_write_buffer(ws, repeat):
+    db_uri = ws.db_uri('buffered_edges')
+    movie = Movie(id='tt0000001', title='Title', poster=None, rating=None, plot=None,
+                  duration=None, release_year=None, genres=[])
+    people = [Person(id='nm{:07d}'.format(i), firstname='First') for i in range(5000)]
+
+    def store():
+        with database.WriteBuffer(db_uri) as buffer:
+            for person in people:
+                buffer.add_cast_member(movie, person)
+
+    def clear():
+        with database.session_scope(db_uri) as db:
+            db.execute('DELETE FROM tbl_actor_movie')
+    return best_rate(store, len(people), repeat, setup=clear)
+
+@case('models_from_source[stand-in]', 'models/sec')
+def bench_models_from_source(ws, repeat):
+    server = ws.stand_in()
+    source = ' '.join('<a href="{}/">'.format(path) for path in server.pages)
+    uris = iter(ws.db_uri('source{}'.format(i)) for i in range(repeat))
+    state = {}
+
+    def run():
+        url_base = constants.url_base
+        constants.url_base = server.url
+        try:
+            list(crawl.models_from_source(source, state['uri']))
+        finally:
+            constants.url_base = url_base
+
+    def fresh_db():
+        # Every run starts without any model stored, so all pages are fetched.
+        state['uri'] = next(uris)
+        database.init_db(state['uri'])
+    return best_rate(run, len(server.pages), repeat, setup=fresh_db)
+
+@case('search.search_ids', 'queries/sec')
+def bench_search(ws, repeat):
+    db_uri = ws.people_uri()
+    queries = ['morgan', 'keanu car', 'hugoson', 'ann glo', 'laurence joeson'] * 20
+    return best_rate(lambda: [search.search_ids(q, db_uri=db_uri) for q in queries],
+                     len(queries), repeat)
+
+@case('search.search_records', 'queries/sec')
+def bench_search_records(ws, repeat):
+    db_uri = ws.people_uri()
+    queries = ['morgan', 'keanu car', 'hugoson', 'ann glo', 'laurence joeson'] * 20
+    return best_rate(lambda: [search.search_records(q, db_uri=db_uri) for q in queries],
+                     len(queries), repeat)
+
+#
+# Running and comparing
+#
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(pattern=None, scale=100000, repeat=3, stream=None):
+    """Runs the cases whose name matches the regex *pattern* and returns the results."""
+    stream = stream or sys.stdout
+    # The suite measures the code, not the page cache.
+    pagecache.disable()
+    results = {}
+    ws = Workspace(scale)
+    try:
+        for name, unit, func in cases:
+            if pattern and not re.search(pattern, name):
+                continue
+            value = func(ws, repeat)
+            results[name] = {'value': value, 'unit': unit}
+            stream.write('{:<32} {:>14.1f} {}\n'.format(name, value, unit))
+    finally:
+        ws.close()
+    return {'commit': git_commit(), 'python': platform.python_version(),
+            'time': time.time(), 'scale': scale, 'repeat': repeat, 'results': results}
+
+def compare(base, new, threshold=0.1, stream=None):
+    """Prints the change of every case in both result sets and returns the names of the
+    cases which got slower by more than *threshold*."""
+    stream = stream or sys.stdout
+    regressions = []
+    stream.write('{:<32} {:>14} {:>14} {:>8}\n'.format(
+        'case', base.get('commit') or 'base', new.get('commit') or 'new', 'change'))
+    for name in sorted(set(base['results']) & set(new['results'])):
+        before, after = base['results'][name]['value'], new['results'][name]['value']
+        change = after / before - 1 if before else 0.0
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        stream.write('{:<32} {:>14.1f} {:>14.1f} {:>+7.1f}%{}\n'.format(
+            name, before, after, change * 100, flag))
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-o', '--output', help='Save the results to this JSON file')
+    ap.add_argument('-k', '--pattern', help='Only run the cases matching this regex')
+    ap.add_argument('--scale', type=int, default=100000,
+                    help='Amount of people in the database used by lookups and search')
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--compare', nargs='+', metavar='RESULTS',
+                    help='Compare two result files, or one against a fresh run')
+    ap.add_argument('--threshold', type=float, default=0.1,
+                    help='Slowdown which counts as a regression, 0.1 is 10%%')
+    args = ap.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        ap.error('--compare takes one or two result files')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+    else:
+        new = run_suite(args.pattern, args.scale, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(new, f, indent=2, sort_keys=True)
+        if not args.compare:
+            return 0
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        sys.stdout.write('\n')
+    return 1 if compare(base, new, args.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Measures cast edges inserted per second into a local SQLite file, once with a commit per
+edge through *store_cast_member* and once through a *WriteBuffer*. A tenth of the edges
+are duplicates to exercise the conflict handling.
+
+    python -m benchmarks.writes -n 10000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from lib import database
+from lib.models import Movie, Person
+
+
+def cast_set(count):
+    """Returns *count* (movie, person) pairs spread over 100 movies, 10% of them repeated."""
+    movies = [Movie(id='tt{:07d}'.format(i), title='Title', poster=None, rating=None, plot=None,
+                    duration=None, release_year=None, genres=[]) for i in range(100)]
+    unique = count - count // 10
+    edges = [(movies[i % 100], Person(id='nm{:07d}'.format(i), firstname='First'))
+             for i in range(unique)]
+    return edges + edges[:count - unique]
+
+def per_edge(edges, db_uri):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for movie, person in edges:
+            database.store_cast_member(movie, person, db_uri)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def buffered(edges, db_uri, max_rows=500):
+    with database.WriteBuffer(db_uri, max_rows=max_rows) as buffer:
+        for movie, person in edges:
+            buffer.add_cast_member(movie, person)
+
+def timed(func, edges, **kwargs):
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    db_uri = 'sqlite:///' + db_path
+    try:
+        database.init_db(db_uri)
+        start = time.time()
+        func(edges, db_uri, **kwargs)
+        return time.time() - start
+    finally:
+        database.dispose_db(db_uri)
+        os.unlink(db_path)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--edges', type=int, default=10000)
+    ap.add_argument('--max-rows', type=int, default=500)
+    args = ap.parse_args()
+
+    edges = cast_set(args.edges)
+    before = timed(per_edge, edges)
+    after = timed(buffered, edges, max_rows=args.max_rows)
+    print('edges:    {}'.format(len(edges)))
+    print('per edge: {:10.1f} edges/sec'.format(len(edges) / before))
+    print('buffered: {:10.1f} edges/sec'.format(len(edges) / after))
+    print('speedup:  {:10.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
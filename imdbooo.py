@@ -1,12 +1,14 @@
 import os
 import sys
+import time
 import argparse
-import json
 
-from lib import crawl, models, constants, database
+# Everything else is imported by the routines using it, a forwarded call only needs the client.
+from lib import constants
 
 def print_model(model, fmt_person, fmt_title):
-    """Prints out a model with the passed *fmt_person* and *fmt_title* format strings."""
+    """Prints out a model or a record with the passed *fmt_person* and *fmt_title* format
+    strings."""
     if model.id.startswith('tt'):
         print(fmt_title.format(id=model.id,
                                title=model.title,
@@ -20,55 +22,273 @@ def print_model(model, fmt_person, fmt_title):
                                 middlename=model.middlename or 'N/A',
                                 lastname=model.lastname or 'N/A'))
 
+def forward_client(args):
+    """Returns the client of the server the search, get and index commands are forwarded to
+    with --connect, None when they run locally."""
+    if not args.connect:
+        return None
+    from lib.client import Client
+    return Client(args.server)
+
 def index_routine(args):
     """Indexes as many models as possible either by reading from a source file, passed by the
-    -f / --file argument, or by crawling an URL directly which is passed by -u / --url."""
-    if args.url:
-        for model in crawl.models_from_url(args.url):
-            if isinstance(model, models.Person) and args.without_roles is False:
-                crawl.extract_acts_by_person(model)
-            if isinstance(model, (models.Movie, models.TVShow)) and args.without_cast is False:
-                crawl.extract_cast(model)
-            print_model(model, args.format_person, args.format_title)
-    else:
+    -f / --file argument, or by crawling an URL directly which is passed by -u / --url.
+    --depth and --max-pages expand the found models breadth first along their cast and
+    filmography."""
+    expand = args.depth is not None or args.max_pages is not None
+    if args.use_async and expand:
+        sys.stderr.write('--depth and --max-pages can\'t be combined with --async.\n')
+        sys.exit(1)
+    client = forward_client(args)
+    if args.use_async:
+        if client:
+            sys.stderr.write('--async can\'t be forwarded to a server.\n')
+            sys.exit(1)
+        return index_async_routine(args)
+
+    source = None
+    if args.file:
         with open(args.file) as source_file:
             source = source_file.read()
-        for model in crawl.models_from_source(source):
-            if isinstance(model, models.Person) and args.without_roles is False:
-                crawl.extract_acts_by_person(model)
-            if isinstance(model, (models.Movie, models.TVShow)) and args.without_cast is False:
-                crawl.extract_cast(model)
-            print_model(model, args.format_person, args.format_title)
+    emit = lambda m: print_model(m, args.format_person, args.format_title)
+    if client:
+        found, expansion = client.index(url=args.url, source=source,
+                                        with_cast=args.without_cast is False,
+                                        with_roles=args.without_roles is False,
+                                        depth=args.depth, max_pages=args.max_pages)
+        for model in found:
+            emit(model)
+    else:
+        from lib import service
+
+        expansion = service.index(emit, url=args.url, source=source,
+                                  with_cast=args.without_cast is False,
+                                  with_roles=args.without_roles is False,
+                                  depth=args.depth, max_pages=args.max_pages)
+        if expansion is not None:
+            expansion = {'levels': expansion.levels, 'pages': expansion.pages,
+                         'stored': expansion.stored}
+    if expansion is not None:
+        sys.stderr.write('Expanded {levels} levels: {pages} pages fetched, '
+                         '{stored} models stored.\n'.format(**expansion))
+
+def index_async_routine(args):
+    """Runs the index routine as an asyncio pipeline with separate fetch, parse and persist
+    stages. Per stage statistics are written to stderr when indexing finishes."""
+    from lib.pipeline import Pipeline
+
+    pipeline = Pipeline(on_model=lambda m: print_model(m, args.format_person, args.format_title),
+                        with_cast=args.without_cast is False,
+                        with_roles=args.without_roles is False,
+                        fetch_workers=args.fetch_workers,
+                        parse_workers=args.parse_workers,
+                        persist_workers=args.persist_workers,
+                        queue_size=args.queue_size)
+    try:
+        if args.url:
+            pipeline.run_url(args.url)
+        else:
+            with open(args.file) as source_file:
+                pipeline.run_source(source_file.read())
+    finally:
+        pipeline.print_stats()
 
 def search_routine(args):
+    """Searches the local index, then our cached search result sets and finally IMDb's
+    suggestions. --timings reports the time to the first result and in total on stderr."""
+    started = time.time()
+    first_result = []
+
+    def emit(model):
+        if not first_result:
+            first_result.append(time.time())
+        print_model(model, args.format_person, args.format_title)
+
+    try:
+        client = forward_client(args)
+        if client:
+            for model in client.search(args.query, limit=args.limit, remote=args.remote,
+                                       ordered=args.ordered):
+                emit(model)
+        else:
+            from lib import service
+
+            try:
+                service.search(args.query, emit, limit=args.limit, remote=args.remote,
+                               ordered=args.ordered)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+    finally:
+        if args.timings:
+            sys.stderr.write('first result: {}, total: {:.1f} ms\n'.format(
+                '{:.1f} ms'.format((first_result[0] - started) * 1000)
+                if first_result else 'none', (time.time() - started) * 1000))
+
+def get_routine(args):
+    """Prints the model with the passed identifier, fetching and storing it first when it
+    isn't stored yet unless --no-fetch is passed."""
+    client = forward_client(args)
+    if client:
+        model = client.get(args.id, fetch=args.no_fetch is False)
+    else:
+        from lib import service
+
+        model = service.get(args.id, fetch=args.no_fetch is False)
+    if model is None:
+        sys.stderr.write('No model {} found.\n'.format(args.id))
+        sys.exit(1)
+    print_model(model, args.format_person, args.format_title)
+
+def serve_routine(args):
+    """Answers search, get and index requests from a long running process with warm caches,
+    see lib/server.py. Runs until interrupted or terminated."""
+    import signal
+    from lib.server import Server
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    server = Server(args.listen, workers=args.workers)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        warmed = server.warm(prewarm=args.prewarm)
+        if warmed:
+            sys.stderr.write('Loaded {} search result sets\n'.format(warmed))
+        sys.stderr.write('Serving on {}\n'.format(server.address))
+        server.serve_forever()
+    finally:
+        server.close()
+
+def crawl_routine(args):
+    """Crawls continuously from the persistent frontier. The frontier is seeded with the
+    identifiers or URLs passed by --seed and refilled with --random identifiers whenever it
+    runs dry. Stopping and restarting the crawler resumes where it left off."""
+    from lib import parser
+    from lib.frontier import Frontier, Crawler, random_ids
+
+    frontier = Frontier(args.frontier)
+    for seed in args.seed or []:
+        frontier.add(parser.model_ids('/' + seed), priority=100)
+
+    crawler = Crawler(frontier, batch_size=args.batch_size,
+                      with_cast=args.without_cast is False,
+                      with_roles=args.without_roles is False,
+                      on_model=lambda m: print_model(m, args.format_person, args.format_title))
+    last_report = time.time()
+    try:
+        while True:
+            if not crawler.step():
+                if not args.random:
+                    break
+                frontier.add(random_ids(args.random))
+            if time.time() - last_report >= args.report_interval:
+                crawler.report()
+                last_report = time.time()
+    finally:
+        crawler.report()
+        frontier.close()
+
+def reparse_routine(args):
+    """Derives every model again from the title and person pages in the page cache and
+    overwrites the stored rows. Nothing is fetched."""
+    from lib import pagecache
+    from lib.reparse import reparse
+
+    cache = pagecache.PageCache(args.cache_dir)
+    stats = reparse(cache, processes=args.processes, chunk_size=args.chunk_size,
+                    batch_size=args.batch_size)
+    print('{pages} pages, {stored} models stored, {failed} failed in {seconds:.1f} seconds'
+          .format(**stats))
+
+def refresh_routine(args):
+    """Fetches the pages of the stored models due for a refresh again and updates the models
+    whose pages changed. Cached pages are revalidated instead of served, so an unchanged
+    page costs a conditional request."""
+    from lib import pagecache
+    from lib.refresh import refresh
+
+    cache = pagecache.get_cache()
+    if cache is not None:
+        cache.ttl = 0
+    stats = refresh(args.budget, args.order, args.max_age)
+    columns = ', '.join('{} {}'.format(name, count)
+                        for name, count in sorted(stats['columns'].items()))
+    print('{checked} pages checked, {updated} models updated, {unchanged} unchanged, '
+          '{failed} failed in {seconds:.1f} seconds'.format(**stats) +
+          (' ({})'.format(columns) if columns else ''))
+
+def graph_routine(args):
+    """Answers co-star, shortest path and neighbourhood queries from the cast graph. The
+    graph is loaded from its snapshot file, which is built from the database when it doesn't
+    exist yet or when --rebuild is passed."""
+    from lib import records
+    from lib.graph import CastGraph
+
+    if args.rebuild or not os.path.exists(args.snapshot):
+        graph = CastGraph.from_db()
+        graph.save(args.snapshot)
+        sys.stderr.write('Built a graph of {} cast edges.\n'.format(len(graph)))
+    else:
+        graph = CastGraph.load(args.snapshot)
 
-    encoded_query = crawl.encode_search_query(args.query)
-    if not encoded_query:
-        print('Search query was empty after encoding it.')
-        exit(1)
-
-    # Query our database for a cached search result set before making an actual web request.
-    cached_models = database.get_search_results(encoded_query)
-    had_models = False
-    for model in cached_models:
-        if model:
-            had_models = True
-            print_model(model, args.format_person, args.format_title)
-    if had_models:
+    if args.costars:
+        found = graph.costars(args.costars)
+        model_ids = [model_id for model_id, _ in found]
+    elif args.path:
+        model_ids = graph.shortest_path(args.path[0], args.path[1], args.max_degrees) or []
+        if not model_ids:
+            print('No path between {} and {}.'.format(*args.path))
+    elif args.around:
+        found = graph.neighbourhood(args.around, args.depth)
+        model_ids = sorted(found, key=lambda model_id: (found[model_id], model_id))
+    else:
         return
 
-    query_url = u'https://v2.sg.media-imdb.com/suggests/{}/{}.json'
-    json_result_raw = crawl.process_url(query_url.format(encoded_query[0], encoded_query))
-    if json_result_raw:
-        json_result = json.loads(json_result_raw.split('(', 1)[1][:-1])
-        for model in crawl.models_from_json(json_result):
-            if model:
-                print_model(model, args.format_person, args.format_title)
+    found_records = records.model_records(model_ids)
+    for model_id in model_ids:
+        if model_id in found_records:
+            print_model(found_records[model_id], args.format_person, args.format_title)
+        else:
+            print(model_id)
+
+def export_routine(args):
+    """Writes the whole database to a line delimited JSON dump, gzip compressed when the
+    file name ends with .gz."""
+    from lib import dump
+
+    counts = dump.dump(args.output, chunk_size=args.chunk_size)
+    sys.stderr.write('Exported {} rows.\n'.format(sum(counts.values())))
+
+def import_routine(args):
+    """Loads a dump written by the export command into the database."""
+    from lib import dump
+
+    started = time.time()
+    counts = dump.load(args.input, chunk_size=args.chunk_size)
+    sys.stderr.write('Imported {} rows in {:.1f} seconds.\n'.format(
+        sum(counts.values()), time.time() - started))
 
 def main(args):
 
     if args.command == 'index':
         index_routine(args)
+    elif args.command == 'get':
+        get_routine(args)
+    elif args.command == 'serve':
+        serve_routine(args)
+    elif args.command == 'crawl':
+        crawl_routine(args)
+    elif args.command == 'reparse':
+        reparse_routine(args)
+    elif args.command == 'refresh':
+        refresh_routine(args)
+    elif args.command == 'graph':
+        graph_routine(args)
+    elif args.command == 'export':
+        export_routine(args)
+    elif args.command == 'import':
+        import_routine(args)
     else:
         search_routine(args)
 
@@ -97,25 +317,159 @@ if __name__ == "__main__":
                         {lastname}
                     """)
 
+    ap.add_argument('--database', default=None,
+                    help='SQLAlchemy URI of the database, defaults to $IMDBOOO_DATABASE_URI '
+                         'or the SQLite file in database/')
+    ap.add_argument('--offline', action='store_true', default=False,
+                    help='Serve pages from the page cache only, never hit the network')
+    ap.add_argument('--no-page-cache', action='store_true', default=False,
+                    help='Neither read nor store fetched pages in the page cache')
+    ap.add_argument('--cache-ttl', type=int, default=constants.page_cache_ttl,
+                    help='Seconds after which a cached page is revalidated')
+    ap.add_argument('--cache-stats', action='store_true', default=False,
+                    help='Print page and search cache hit/miss counters to stderr when done')
+    ap.add_argument('--query-log', metavar='PATH', default=constants.query_log_path,
+                    help='Append search queries to this file, defaults to $IMDBOOO_QUERY_LOG')
+    ap.add_argument('--stream', action='store_true', default=False,
+                    help='Stop fetching title and person pages once the model is complete '
+                         'and print the bytes saved per page to stderr when done')
+
+    ap.add_argument('--metrics', action='store_true', default=False,
+                    help='Print fetch, parse and database figures to stderr periodically')
+    ap.add_argument('--metrics-interval', type=float, default=10,
+                    help='Seconds between two metrics reports')
+    ap.add_argument('--metrics-jsonl', metavar='PATH',
+                    help='Append a JSON snapshot of the figures to this file periodically')
+    ap.add_argument('--metrics-port', type=int, default=None,
+                    help='Serve the figures for Prometheus on this port at /metrics')
+    ap.add_argument('--profile', metavar='PATH',
+                    help='Profile the run and write the result to this file')
+    ap.add_argument('--profile-mode', choices=('cprofile', 'sample'), default='cprofile',
+                    help='cprofile writes pstats, sample writes folded stacks')
+    ap.add_argument('--connect', action='store_true',
+                    default=bool(os.environ.get('IMDBOOO_SERVER')),
+                    help='Forward the search, get and index commands to the server started '
+                         'by the serve command at --server, the default when $IMDBOOO_SERVER '
+                         'is set. Other commands run locally')
+    ap.add_argument('--server', metavar='ADDRESS', default=constants.server_address,
+                    help='Address of the server --connect forwards to (unix:PATH or '
+                         'HOST:PORT), defaults to $IMDBOOO_SERVER or the Unix socket in '
+                         'database/')
+
     sub_parsers = ap.add_subparsers(dest='command')
     sub_parsers.required = True
 
     search_parser = sub_parsers.add_parser('search')
     search_parser.add_argument('-q', '--query', required=True)
+    search_parser.add_argument('--remote', action='store_true', default=False,
+                               help='Skip the local index and ask IMDb for suggestions')
+    search_parser.add_argument('-l', '--limit', type=int, default=20,
+                               help='Maximum amount of results from the local index')
+    search_parser.add_argument('--ordered', action='store_true', default=False,
+                               help='Print fetched results in ranking order, not as they arrive')
+    search_parser.add_argument('--timings', action='store_true', default=False,
+                               help='Print the time to the first result and in total to stderr')
 
     index_parser = sub_parsers.add_parser('index')
     index_parser.add_argument('--without-cast', action='store_true', default=False,
                               help='Disable the indexing of tvshow|movie -> actor')
     index_parser.add_argument('--without-roles', action='store_true', default=False,
                               help='Disable the indexing of people -> movie|tvshow')
+    index_parser.add_argument('--depth', type=int, default=None,
+                              help='Expand the found models breadth first this many levels')
+    index_parser.add_argument('--max-pages', type=int, default=None,
+                              help='Fetch at most this many pages while expanding')
+    index_parser.add_argument('--async', dest='use_async', action='store_true', default=False,
+                              help='Fetch, parse and store concurrently (Python 3.5+)')
+    index_parser.add_argument('--fetch-workers', type=int, default=8,
+                              help='Amount of concurrent fetches in --async mode')
+    index_parser.add_argument('--parse-workers', type=int, default=2,
+                              help='Amount of parse workers in --async mode')
+    index_parser.add_argument('--persist-workers', type=int, default=1,
+                              help='Amount of database writers in --async mode')
+    index_parser.add_argument('--queue-size', type=int, default=32,
+                              help='Capacity of the parse and persist queues in --async mode')
     model_source = index_parser.add_mutually_exclusive_group(required=True)
     model_source.add_argument('-u', '--url')
     model_source.add_argument('-f', '--file')
 
-    args = ap.parse_args()
+    get_parser = sub_parsers.add_parser('get')
+    get_parser.add_argument('id', help='Identifier of the title or person, e.g. tt0133093')
+    get_parser.add_argument('--no-fetch', action='store_true', default=False,
+                            help='Only look in the database, don\'t fetch missing models')
 
-    if os.path.isdir(constants.database_dir) is False:
-        os.mkdir(constants.database_dir)
+    serve_parser = sub_parsers.add_parser('serve')
+    serve_parser.add_argument('-l', '--listen', default=constants.server_address,
+                              help='unix:PATH or HOST:PORT to serve the JSON API on, defaults '
+                                   'to $IMDBOOO_SERVER or a Unix socket in database/')
+    serve_parser.add_argument('-w', '--workers', type=int, default=constants.server_workers,
+                              help='Amount of threads answering requests')
+    serve_parser.add_argument('--prewarm', type=int, default=0, metavar='N',
+                              help='Load the result sets of the N most frequent queries of '
+                                   '--query-log into the search cache on start')
+
+    crawl_parser = sub_parsers.add_parser('crawl')
+    crawl_parser.add_argument('-s', '--seed', action='append',
+                              help='An identifier or URL to start from, can be repeated')
+    crawl_parser.add_argument('-r', '--random', type=int, default=0,
+                              help='Queue this many random identifiers when the frontier is empty')
+    crawl_parser.add_argument('--batch-size', type=int, default=50)
+    crawl_parser.add_argument('--frontier', default=constants.frontier_path,
+                              help='Path of the SQLite file which holds the frontier')
+    crawl_parser.add_argument('--report-interval', type=int, default=60,
+                              help='Seconds between progress reports on stderr')
+    crawl_parser.add_argument('--without-cast', action='store_true', default=False,
+                              help='Disable the indexing of tvshow|movie -> actor')
+    crawl_parser.add_argument('--without-roles', action='store_true', default=False,
+                              help='Disable the indexing of people -> movie|tvshow')
+
+    reparse_parser = sub_parsers.add_parser('reparse')
+    reparse_parser.add_argument('--cache-dir', default=constants.page_cache_dir,
+                                help='Directory of the page cache to read the pages from')
+    reparse_parser.add_argument('-j', '--processes', type=int, default=None,
+                                help='Amount of parser processes, one per core by default')
+    reparse_parser.add_argument('--chunk-size', type=int, default=64,
+                                help='Amount of pages handed to a parser process at once')
+    reparse_parser.add_argument('--batch-size', type=int, default=1000,
+                                help='Amount of models written per transaction')
+
+    refresh_parser = sub_parsers.add_parser('refresh')
+    refresh_parser.add_argument('-n', '--budget', type=int, default=100,
+                                help='Maximum amount of pages to fetch')
+    refresh_parser.add_argument('--order', choices=('oldest', 'popular'), default='oldest',
+                                help='Refresh the models fetched longest ago or those with '
+                                     'the most cast and search result links first')
+    refresh_parser.add_argument('--max-age', type=int, default=None,
+                                help='Only refresh models fetched more than this many '
+                                     'seconds ago')
+
+    graph_parser = sub_parsers.add_parser('graph')
+    graph_parser.add_argument('--snapshot', default=constants.graph_snapshot_path,
+                              help='Path of the graph snapshot file')
+    graph_parser.add_argument('--rebuild', action='store_true', default=False,
+                              help='Build the snapshot from the database again')
+    graph_query = graph_parser.add_mutually_exclusive_group()
+    graph_query.add_argument('--costars', metavar='ID',
+                             help='List the people who played in a title with this person')
+    graph_query.add_argument('--path', nargs=2, metavar=('FROM', 'TO'),
+                             help='Print the shortest path between two people')
+    graph_query.add_argument('--around', metavar='ID',
+                             help='List the people and titles up to --depth degrees away')
+    graph_parser.add_argument('--depth', type=int, default=1)
+    graph_parser.add_argument('--max-degrees', type=int, default=None,
+                              help='Give up on paths longer than this many titles')
+
+    export_parser = sub_parsers.add_parser('export')
+    export_parser.add_argument('-o', '--output', default='-',
+                               help='File to write the dump to, stdout by default')
+    export_parser.add_argument('--chunk-size', type=int, default=10000)
+
+    import_parser = sub_parsers.add_parser('import')
+    import_parser.add_argument('-i', '--input', default='-',
+                               help='Dump file to load, stdin by default')
+    import_parser.add_argument('--chunk-size', type=int, default=10000)
+
+    args = ap.parse_args()
 
     if args.format_title:
         opening_b = args.format_title.count('{')
@@ -132,7 +486,62 @@ if __name__ == "__main__":
                              'amounts of opening and closing brackets.\n')
             sys.exit(1)
 
+    if args.connect and args.command in ('search', 'get', 'index'):
+        from lib.client import ServerError
+
+        try:
+            sys.exit(main(args))
+        except ServerError as e:
+            sys.stderr.write('{}\n'.format(e))
+            sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+    from lib import database, metrics, pagecache
+
+    if args.database:
+        constants.database_uri = args.database
+    if os.path.isdir(constants.database_dir) is False:
+        os.mkdir(constants.database_dir)
+    database.init_db()
+
+    if args.offline and args.no_page_cache:
+        sys.stderr.write('--offline needs the page cache, drop --no-page-cache.\n')
+        sys.exit(1)
+    if args.no_page_cache is False:
+        pagecache.configure(ttl=args.cache_ttl, offline=args.offline)
+    constants.fetch_stream = args.stream
+    constants.query_log_path = args.query_log
+
+    sinks = []
+    if args.metrics or args.metrics_jsonl or args.metrics_port is not None:
+        registry = metrics.enable()
+        if args.metrics:
+            sinks.append(metrics.StderrSink(registry, args.metrics_interval))
+        if args.metrics_jsonl:
+            sinks.append(metrics.JSONLinesSink(registry, args.metrics_jsonl,
+                                               args.metrics_interval))
+        if args.metrics_port is not None:
+            sinks.append(metrics.PrometheusSink(registry, args.metrics_port))
+    profiler = None
+    if args.profile:
+        from lib.profiling import start_profiler
+        profiler = start_profiler(args.profile_mode, args.profile)
+
     try:
         sys.exit(main(args))
     except KeyboardInterrupt:
         sys.exit(1)
+    finally:
+        if profiler:
+            profiler.stop()
+        for sink in sinks:
+            sink.close()
+        if args.cache_stats and pagecache.get_cache():
+            sys.stderr.write(pagecache.get_cache().summary() + '\n')
+        if args.cache_stats and args.command == 'search':
+            from lib import searchcache
+            sys.stderr.write(searchcache.get_cache().summary() + '\n')
+        if args.stream:
+            from lib.fetch import default_fetcher
+            sys.stderr.write(default_fetcher().summary() + '\n')
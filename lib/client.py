@@ -0,0 +1,132 @@
+"""
+A thin client of the server in lib/server.py. It only imports the standard library, so a
+command line call forwarded with --connect neither imports SQLAlchemy nor pycurl nor opens
+the database; the server answers it with its warm caches.
+
+    client = Client('unix:database/imdbooo.sock')
+    for record in client.search('matrix'):
+        print(record.id, record.title)
+"""
+import json
+import socket
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from lib import constants
+
+def parse_address(address):
+    """
+    Returns ('unix', path) or ('tcp', (host, port)) for *address*, which is one of
+    unix:PATH, a path, HOST:PORT or http://HOST:PORT.
+    """
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    if address.startswith('http://'):
+        address = address[len('http://'):].rstrip('/')
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        return 'tcp', (host or '127.0.0.1', int(port))
+    return 'unix', address
+
+
+class ServerError(Exception):
+    """Raised when the server can't be reached or answers with an error; *status* is the HTTP
+    status of the answer, None when there was none."""
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Record(object):
+    """A record answered by the server, its fields are attributes like on the records of
+    *lib.records*."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class _UnixConnection(httplib.HTTPConnection):
+    """An HTTP connection over the Unix socket at *socket_path*."""
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client(object):
+    """Sends requests to the server at *address*, *constants.server_address* by default.
+    *timeout* limits the seconds a request may take, None waits for indexing to finish."""
+
+    def __init__(self, address=None, timeout=None):
+        self.address = address or constants.server_address
+        self.family, self.target = parse_address(self.address)
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.family == 'unix':
+            return _UnixConnection(self.target, self.timeout)
+        return httplib.HTTPConnection(self.target[0], self.target[1], timeout=self.timeout)
+
+    def request(self, method, path, params=None, body=None):
+        """Sends a request and returns the decoded JSON answer."""
+        if params:
+            path += '?' + urlencode(params)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        connection = self._connection()
+        try:
+            connection.request(method, path, data, headers)
+            response = connection.getresponse()
+            answer = json.loads(response.read().decode('utf-8'))
+        except (socket.error, httplib.HTTPException, ValueError) as e:
+            raise ServerError('No answer from the server at {}: {}'.format(self.address, e))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ServerError(answer.get('error', 'HTTP {}'.format(response.status)),
+                              response.status)
+        return answer
+
+    def search(self, query, limit=20, remote=False, ordered=False):
+        """Returns the records found for *query*, see *lib.service.search*."""
+        answer = self.request('GET', '/search', {'q': query, 'limit': limit,
+                                                 'remote': int(remote), 'ordered': int(ordered)})
+        return [Record(fields) for fields in answer['results']]
+
+    def get(self, model_id, fetch=True):
+        """Returns the record of *model_id* or None, see *lib.service.get*."""
+        answer = self.request('GET', '/get', {'id': model_id, 'fetch': int(fetch)})
+        return Record(answer['results'][0]) if answer['results'] else None
+
+    def index(self, url=None, source=None, with_cast=True, with_roles=True, depth=None,
+              max_pages=None):
+        """
+        Indexes *url* or the page *source* on the server, see *lib.service.index*. Returns
+        the records of the models indexed and a dict with the levels, pages and stored
+        figures of the expansion, None when the models weren't expanded.
+        """
+        answer = self.request('POST', '/index', body={
+            'url': url, 'source': source, 'with_cast': with_cast, 'with_roles': with_roles,
+            'depth': depth, 'max_pages': max_pages})
+        return [Record(fields) for fields in answer['results']], answer['expansion']
+
+    def status(self):
+        """Returns the process id, the uptime and the amount of requests of the server."""
+        return self.request('GET', '/status')
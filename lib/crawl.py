@@ -4,36 +4,100 @@ except ImportError:
     import urlparse
 
 import re
+import time
+import threading
 
 try:
     from io import BytesIO
 except ImportError:
     from StringIO import StringIO as BytesIO
 
-import pycurl
-
-from lib import constants, factory, parser
+from lib import constants, factory, metrics, pagecache, parser
+from lib.models import Person
+from lib.policy import default_policy, retry_statuses
 from lib.database import (
     store_model,
     get_cached_model,
-    store_cast_member,
-    store_search_result
+    get_cached_models,
+    store_search_results,
+    WriteBuffer
 )
 
+_local = threading.local()
+
+# pycurl is imported on the first fetch, a search answered from the database never pays for it.
+
+def fetch_many(urls, model_pages=False):
+    """See *lib.fetch.fetch_many*."""
+    from lib import fetch
+    return fetch.fetch_many(urls, model_pages)
+
 def process_url(url):
     """
-    Takes care of submitting a GET request to the passed *url*. The *callback* parameter
-    will be used to populate the received data.
+    Takes care of submitting a GET request to the passed *url* and returns the decoded
+    response body. The curl handle is kept per thread so connections are reused. Pages are
+    served from and stored in the page cache when it is enabled. Timeouts, retries and
+    throttling follow the shared fetch policy (see lib/policy.py); a *pycurl.error* is
+    raised when it gives up, the answer is still a retried status once the retries are
+    spent or the circuit of the host is open.
     """
-    buffer = BytesIO()
-    c = pycurl.Curl()
+    import pycurl
+
+    cache = pagecache.get_cache()
+    entry = None
+    extra_headers = []
+    if cache is not None:
+        body, extra_headers, entry = cache.before_fetch(url)
+        if body is not None:
+            metrics.record_transfer(None, cached=True)
+            return body.decode('utf-8')
+
+    policy = default_policy()
+    c = getattr(_local, 'curl', None)
+    if c is None:
+        c = _local.curl = pycurl.Curl()
+        c.setopt(c.FOLLOWLOCATION, True)
+    policy.apply(c)
     c.setopt(c.URL, url.encode('utf-8'))
-    c.setopt(c.HTTPHEADER, ['Accept-Language: en-US'])
-    c.setopt(c.FOLLOWLOCATION, True)
-    c.setopt(c.WRITEDATA, buffer)
-    c.perform()
-    c.close()
-    return buffer.getvalue().decode('utf-8')
+    c.setopt(c.HTTPHEADER, ['Accept-Language: en-US'] + extra_headers)
+    attempt = 0
+    while True:
+        if not policy.wait(url):
+            metrics.incr('fetch_errors')
+            raise pycurl.error(pycurl.E_COULDNT_CONNECT,
+                               'Circuit open for {}'.format(urlparse.urlsplit(url).netloc))
+        buffer = BytesIO()
+        headers = pagecache.HeaderCollector()
+        c.setopt(c.WRITEDATA, buffer)
+        c.setopt(c.HEADERFUNCTION, headers)
+        started_at = time.time()
+        try:
+            c.perform()
+        except pycurl.error as e:
+            delay = policy.outcome(url, attempt, error=e.args[0], started_at=started_at)
+            if delay is None:
+                metrics.incr('fetch_errors')
+                raise
+        else:
+            status = c.getinfo(c.RESPONSE_CODE)
+            delay = policy.outcome(url, attempt, status=status, headers=headers.headers,
+                                   started_at=started_at)
+            if delay is None:
+                break
+        time.sleep(delay)
+        attempt += 1
+
+    metrics.record_transfer(c)
+    if status in retry_statuses:
+        metrics.incr('fetch_errors')
+        raise pycurl.error(pycurl.E_HTTP_RETURNED_ERROR, 'HTTP {} from {}'.format(status, url))
+    body = buffer.getvalue()
+    if cache is not None:
+        body = cache.after_fetch(url, entry, status, body, headers.headers)
+        if body is None:
+            # Not modified, but the cached body is gone; the entry was dropped with it.
+            return process_url(url)
+    return body.decode('utf-8')
 
 def extract_cast(model, db_uri=None):
     """
@@ -43,32 +107,49 @@ def extract_cast(model, db_uri=None):
     cast_url = constants.cast_url.format(model_id=model.id)
     cast_source = process_url(cast_url)
 
-    for person_id in parser.cast(cast_source):
-        person = get_cached_model(person_id, db_uri)
-        if person is None:
-            # Add the missing person to the database.
-            source = process_url(urlparse.urljoin(constants.url_base, 'name/' + person_id))
-            new_person = factory.person(source)
-            if new_person:
-                if store_model(new_person):
-                    person = get_cached_model(person_id)
-        if person is not None:
-            store_cast_member(model, person)
+    missing_urls = []
+    with WriteBuffer(db_uri) as buffer:
+        person_ids = parser.cast(cast_source)
+        cached_people = get_cached_models(person_ids, db_uri)
+        for person_id in person_ids:
+            person = cached_people.get(person_id)
+            if person is None:
+                missing_urls.append(model_url(person_id))
+            else:
+                buffer.add_cast_member(model, person)
+
+        # Add the missing people to the database.
+        for _, source in fetch_many(missing_urls, model_pages=True):
+            if not source:
+                continue
+            new_person = factory.model_builder(source, db_uri)
+            if isinstance(new_person, Person):
+                buffer.add_model(new_person)
+                buffer.add_cast_member(model, new_person)
 
 def extract_acts_by_person(person, db_uri=None):
     """Extracts movies or tv shows the passed *person* played in."""
-    person_source = process_url(u'http://www.imdb.com/name/' + person.id)
-    for title_id in parser.roles(person_source):
-        title = get_cached_model(title_id)
-        if title is None:
-            # We don't have the movie or tv show cached; index it first.
-            source = process_url(urlparse.urljoin(constants.url_base, 'title/' + title_id))
-            new_title = factory.model_builder(source)
+    person_source = process_url(constants.roles_url.format(model_id=person.id))
+
+    missing_urls = []
+    with WriteBuffer(db_uri) as buffer:
+        title_ids = parser.roles(person_source)
+        cached_titles = get_cached_models(title_ids, db_uri)
+        for title_id in title_ids:
+            title = cached_titles.get(title_id)
+            if title is None:
+                missing_urls.append(model_url(title_id))
+            else:
+                buffer.add_cast_member(title, person)
+
+        # We don't have these movies or tv shows cached; index them first.
+        for _, source in fetch_many(missing_urls, model_pages=True):
+            if not source:
+                continue
+            new_title = factory.model_builder(source, db_uri)
             if new_title:
-                if store_model(new_title):
-                    title = get_cached_model(title_id)
-        if title is not None:
-            store_cast_member(title, person)
+                buffer.add_model(new_title)
+                buffer.add_cast_member(new_title, person)
 
 def model_url(model_id):
     """
@@ -82,52 +163,100 @@ def model_url(model_id):
         return urlparse.urljoin(constants.url_base, '/'.join(('name', model_id)))
 
 def models_from_source(source, db_uri=None):
-    for model_id in parser.model_ids(source):
+    missing_urls = []
+    model_ids = parser.model_ids(source)
+    cached_models = get_cached_models(model_ids, db_uri)
+    for model_id in model_ids:
         # Search the database for a cached model matching the current model id.
-        cached_model = get_cached_model(model_id, db_uri)
+        cached_model = cached_models.get(model_id)
         if cached_model:
             yield cached_model
             continue
 
         # When we reach this point in the loop the model is not cached in our database.
-        # Build the model, cache and yield it.
         _model_url = model_url(model_id)
-        if _model_url is None:
-            continue
+        if _model_url is not None:
+            missing_urls.append(_model_url)
 
-        model_source = process_url(_model_url)
+    # Build the missing models as their pages arrive, cache and yield them.
+    for _, model_source in fetch_many(missing_urls, model_pages=True):
+        if not model_source:
+            continue
         model = factory.model_builder(model_source, db_uri)
         if model:
             if store_model(model, db_uri):
-                yield get_cached_model(model_id, db_uri)
+                yield get_cached_model(model.id, db_uri)
 
 def encode_search_query(query):
     r = re.sub(r'[^a-zA-Z0-9_]', '', query.lower().replace(' ', '_'), flags=re.VERBOSE)
     return r
 
-def models_from_json(json_data, db_uri=None):
-    """Parses the passed search result *json_data* and extracts the models contained in it."""
+def models_from_json(json_data, db_uri=None, ordered=False, query=None):
+    """
+    Parses the passed search result *json_data* and extracts the models contained in it.
+    Cached models are yielded right away while the pages of the others are fetched
+    concurrently; those are yielded as they arrive unless *ordered* is True, in which case
+    every model is held back until all higher ranked results are out. The search result
+    set replaces the one stored for *query*, the query of *json_data* by default, in one
+    transaction once every result got an answer. A set cut short by failed transfers or a
+    consumer which stopped early is only merged into the stored one, which keeps its fetch
+    time.
+    """
 
     if not json_data or not json_data.get('d'):
         return
 
-    for result in json_data.get('d'):
-        cached_model = get_cached_model(result['id'], db_uri)
-        if cached_model:
-            store_search_result(json_data.get('q'), cached_model, db_uri)
-            yield cached_model
-            continue
+    ranking = [result['id'] for result in json_data.get('d')]
+    cached_models = get_cached_models(ranking, db_uri)
+    urls = {}
+    for model_id in ranking:
+        _model_url = model_url(model_id)
+        if model_id not in cached_models and _model_url is not None:
+            urls[_model_url] = model_id
+    ranking = [i for i in ranking if i in cached_models or model_url(i) in urls]
 
-        _model_url = model_url(result['id'])
-        if _model_url is None:
-            continue
+    # Maps the identifiers to their models; None marks a result which couldn't be built.
+    resolved = dict(cached_models)
+    found, unreachable = [], []
+    exhausted = False
+    position = [0]
 
-        model_source = process_url(_model_url)
-        model = factory.model_builder(model_source, db_uri)
-        if model:
-            store_search_result(json_data.get('q'), model, db_uri)
-            if store_model(model, db_uri):
-                yield get_cached_model(result['id'], db_uri)
+    def ready(model_id):
+        if not ordered:
+            if resolved[model_id] is not None:
+                yield resolved[model_id]
+            return
+        while position[0] < len(ranking) and ranking[position[0]] in resolved:
+            model = resolved[ranking[position[0]]]
+            position[0] += 1
+            if model is not None:
+                yield model
+
+    try:
+        for model_id in ranking:
+            if model_id in cached_models:
+                for model in ready(model_id):
+                    found.append(model)
+                    yield model
+
+        for url, model_source in fetch_many(urls, model_pages=True):
+            if model_source is None:
+                unreachable.append(urls[url])
+            model = factory.model_builder(model_source, db_uri) if model_source else None
+            if model is not None and store_model(model, db_uri):
+                model = get_cached_model(model.id, db_uri)
+            else:
+                model = None
+            resolved[urls[url]] = model
+            for model in ready(urls[url]):
+                found.append(model)
+                yield model
+        exhausted = True
+    finally:
+        complete = exhausted and not unreachable
+        if found:
+            store_search_results(query or json_data.get('q'), found, db_uri, replace=complete,
+                                 stamp=complete)
 
 def models_from_url(url, db_uri=None):
     """
@@ -1,8 +1,17 @@
+import time
+import random
+import functools
+import threading
+from contextlib import contextmanager
+
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, make_transient_to_detached
+from sqlalchemy.pool import QueuePool
 
-from lib import constants
+from lib import constants, metrics, migrations
+from lib.lru import LRUCache
 from lib.models import (
     Base,
     Genre,
@@ -12,48 +21,401 @@ from lib.models import (
     SearchResult,
     actor_movie,
     actor_tvshow,
+    genre_movie,
+    genre_tvshow,
     result_tvshow,
     result_movie,
     result_person
 )
 
+# One engine and one session factory per database URI for the lifetime of the process.
+_engines = {}
+_sessionmakers = {}
+_engine_lock = threading.Lock()
+
+# Recently seen models and identifiers known to be missing, per database URI. Writes made
+# through this module keep both up to date; models expire after *constants.model_cache_ttl*
+# and missing identifiers after *constants.missing_cache_ttl* since other processes write to
+# the database too.
+_model_caches = {}
+_missing_caches = {}
+
+# Genre name to identifier map, per database URI.
+_genre_ids = {}
+_genre_lock = threading.Lock()
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """Puts every new SQLite connection into WAL mode, which lets readers and one writer
+    work at the same time, and makes it wait for locks instead of failing right away."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(
+        int(constants.database_busy_timeout * 1000)))
+    cursor.close()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if metrics.get_registry() is not None:
+        context.metrics_started = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is not None:
+        metrics.observe('db_query_seconds', time.time() - started,
+                        kind=statement.split(None, 1)[0].upper())
+
+def _build_engine(db_uri):
+    """
+    Creates a new engine for *db_uri* with a connection pool suited for the backend. Query
+    counts and latencies are recorded while instrumentation is enabled.
+    """
+    engine = _create_engine(db_uri)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    return engine
+
+def _create_engine(db_uri):
+    url = make_url(db_uri)
+    if url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:'):
+        # File based SQLite databases default to a NullPool, which reconnects on every
+        # checkout. Keep a small pool of connections open instead.
+        engine = create_engine(db_uri, poolclass=QueuePool, pool_size=5, max_overflow=10,
+                               connect_args={'check_same_thread': False,
+                                             'timeout': constants.database_busy_timeout})
+        event.listen(engine, 'connect', _configure_sqlite)
+        return engine
+    if url.drivername.startswith('postgresql'):
+        return create_engine(db_uri, pool_size=5, max_overflow=10, pool_pre_ping=True)
+    return create_engine(db_uri)
+
+def _is_lock_error(error):
+    """Returns True for errors which go away when the transaction is run again."""
+    message = str(getattr(error, 'orig', error)).lower()
+    return any(text in message for text in ('database is locked', 'database table is locked',
+                                            'deadlock detected', 'could not serialize'))
+
+def retry_locked(func):
+    """
+    Runs *func* again with a growing, jittered delay when it fails because another
+    process holds a lock, up to *constants.database_retries* times. Only wrap functions
+    which run a whole transaction, so a retry repeats all of it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = 0.05
+        for attempt in range(constants.database_retries):
+            try:
+                return func(*args, **kwargs)
+            except sqlalchemy.exc.OperationalError as e:
+                if not _is_lock_error(e) or attempt == constants.database_retries - 1:
+                    raise
+                time.sleep(delay * (1 + random.random()))
+                delay = min(delay * 2, 2.0)
+    return wrapper
+
+def get_engine(db_uri=None):
+    """
+    Returns the process wide engine for the default database or the optionally passed
+    *db_uri*. The engine is created and pending schema migrations are applied on first
+    use only.
+    """
+    db_uri = db_uri or constants.database_uri
+    engine = _engines.get(db_uri)
+    if engine is not None:
+        return engine
+
+    with _engine_lock:
+        engine = _engines.get(db_uri)
+        if engine is None:
+            engine = _build_engine(db_uri)
+            migrations.migrate(engine)
+            _sessionmakers[db_uri] = sessionmaker(bind=engine, expire_on_commit=False)
+            _engines[db_uri] = engine
+    return engine
+
+def init_db(db_uri=None):
+    """Creates the engine and the schema up front, e.g. when the application starts."""
+    return get_engine(db_uri)
+
+def dispose_db(db_uri=None):
+    """Closes all pooled connections of the engine for *db_uri* and forgets about it."""
+    db_uri = db_uri or constants.database_uri
+    with _engine_lock:
+        engine = _engines.pop(db_uri, None)
+        _sessionmakers.pop(db_uri, None)
+    clear_model_cache(db_uri)
+    _genre_ids.pop(db_uri, None)
+    if engine is not None:
+        engine.dispose()
+
 def get_db(db_uri=None):
     """
     Connects to the default database or the optionally passed *db_uri* and returns a session.
     """
-    engine = create_engine(db_uri or constants.database_uri)
-    db = sessionmaker()
-    db.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    return db()
+    get_engine(db_uri)
+    return _sessionmakers[db_uri or constants.database_uri]()
+
+@contextmanager
+def session_scope(db_uri=None):
+    """
+    Provides a unit of work around a series of operations. The session is committed when
+    the block finishes, rolled back when it raises and closed in any case.
+
+        with session_scope() as db:
+            db.add(model)
+    """
+    db = get_db(db_uri)
+    try:
+        yield db
+        with metrics.timer('db_commit_seconds'):
+            db.commit()
+    except:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
+@retry_locked
 def store_model(model, db_uri=None):
-    """Caches the passed *model* in the database."""
+    """
+    Caches the passed *model* in the database. Returns False when the model couldn't be
+    stored because it exists already or isn't a model.
+    """
+    db = get_db(db_uri)
     try:
-        db = get_db(db_uri)
         db.add(model)
-        db.commit()
-        db.close()
+        with metrics.timer('db_commit_seconds'):
+            db.commit()
+        remember_model(model, db_uri)
         return True
     except(sqlalchemy.exc.IntegrityError, sqlalchemy.orm.exc.UnmappedInstanceError):
-        pass
+        db.rollback()
+    finally:
+        db.close()
     return False
 
+def _dialect_name(db):
+    dialect = getattr(db, 'dialect', None) or db.get_bind().dialect
+    return dialect.name
+
+def insert_ignore(table, db):
+    """
+    Returns an insert statement for *table* which silently skips rows that already exist,
+    written in the dialect of the database *db* is bound to. *db* is a session or a
+    connection.
+    """
+    dialect = _dialect_name(db)
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert().prefix_with('OR IGNORE')
+
+def upsert(table, rows, db):
+    """
+    Inserts the passed *rows* into *table* and overwrites the rows whose primary key
+    already exists, in the dialect of the database *db* is bound to. Updates go through
+    UPDATE statements so triggers on *table* see them as updates. Columns missing from the
+    rows keep their stored values.
+    """
+    if not rows:
+        return
+    keys = [c.key for c in table.primary_key.columns]
+    columns = [c.key for c in table.columns if c.key in rows[0] and c.key not in keys]
+    if _dialect_name(db) == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=keys,
+            set_=dict((key, statement.excluded[key]) for key in columns)), rows)
+        return
+
+    db.execute(insert_ignore(table, db), rows)
+    # Bound parameters must not share the names of the columns they set.
+    update = table.update() \
+        .where(sqlalchemy.and_(*[table.c[k] == sqlalchemy.bindparam('key_' + k) for k in keys])) \
+        .values(dict((key, sqlalchemy.bindparam('new_' + key)) for key in columns))
+    db.execute(update, [dict([('key_' + k, row[k]) for k in keys] +
+                             [('new_' + k, v) for k, v in row.items() if k not in keys])
+                        for row in rows])
+
+def cast_edge(model, person):
+    """Returns the edge table and the row linking *person* to the cast of *model*."""
+    table = actor_movie if isinstance(model, Movie) else actor_tvshow
+    return table, dict(zip(table.c.keys(), (person.id, model.id)))
+
+@retry_locked
 def store_cast_member(model, person, db_uri=None):
     """Adds a person to either a tv show or movie as a member of the cast."""
-    try:
-        db = get_db(db_uri)
-        if isinstance(model, Movie):
-            db.execute(actor_movie.insert().values([(person.id, model.id)]))
-            print('Storing cast member <{}> for movie <{}>'.format(person.id, model.id))
-        else:
-            db.execute(actor_tvshow.insert().values([(person.id, model.id)]))
-            print('Storing cast member <{}> for movie <{}>'.format(person.id, model.id))
-        db.commit()
-    except sqlalchemy.exc.IntegrityError:
-        pass
-    finally:
-        db.close()
+    table, row = cast_edge(model, person)
+    with session_scope(db_uri) as db:
+        db.execute(insert_ignore(table, db), row)
+    print('Storing cast member <{}> for {} <{}>'.format(
+        person.id, 'movie' if table is actor_movie else 'tv show', model.id))
+
+
+class WriteBuffer(object):
+    """
+    Collects models and cast edges and writes them in a single transaction once
+    *max_rows* rows are pending or the oldest pending row is *max_delay* seconds old.
+    Rows which already exist are skipped instead of raising an *IntegrityError*.
+    The deadline is checked whenever a row is added; *flush()* writes the rest.
+
+        with WriteBuffer() as buffer:
+            buffer.add_model(person)
+            buffer.add_cast_member(movie, person)
+    """
+
+    def __init__(self, db_uri=None, max_rows=500, max_delay=0.5):
+        self.db_uri = db_uri
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows = {}
+        self.models = []
+        self.pending = 0
+        self.written = 0
+        self.oldest = None
+
+    def add_model(self, model):
+        """Queues a *Movie*, *TVShow* or *Person* and its genre edges for insertion."""
+        table = sqlalchemy.inspect(model).mapper.local_table
+        self.models.append(model)
+        self._add(table, dict((c.key, getattr(model, c.key)) for c in table.columns))
+        if isinstance(model, (Movie, TVShow)):
+            genre_table = genre_movie if isinstance(model, Movie) else genre_tvshow
+            for genre in model.genres:
+                if genre.id is not None:
+                    self._add(genre_table, dict(zip(genre_table.c.keys(), (genre.id, model.id))))
+
+    def add_cast_member(self, model, person):
+        """Queues the edge between the movie or tv show *model* and *person*."""
+        self._add(*cast_edge(model, person))
+
+    def _add(self, table, row):
+        self.rows.setdefault(table, []).append(row)
+        self.pending += 1
+        if self.oldest is None:
+            self.oldest = time.time()
+        if self.pending >= self.max_rows or time.time() - self.oldest >= self.max_delay:
+            self.flush()
+
+    @retry_locked
+    def flush(self):
+        """Writes all pending rows in one transaction."""
+        if not self.pending:
+            return
+        with session_scope(self.db_uri) as db:
+            # Parent tables first so that the edges never reference a missing row.
+            for table in Base.metadata.sorted_tables:
+                rows = self.rows.get(table)
+                if rows:
+                    db.execute(insert_ignore(table, db), rows)
+        for model in self.models:
+            remember_model(model, self.db_uri)
+        metrics.incr('db_rows_written', self.pending)
+        self.written += self.pending
+        self.rows = {}
+        self.models = []
+        self.pending = 0
+        self.oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+def model_classes(model_id):
+    """
+    Returns the model classes an identifier can belong to, based on its prefix.
+    Titles (tt) are either movies or tv shows, names (nm) are people.
+    """
+    if model_id.startswith('tt'):
+        return (Movie, TVShow)
+    elif model_id.startswith('nm'):
+        return (Person,)
+    return (Movie, TVShow, Person)
+
+def _model_cache(db_uri):
+    """Returns the LRU caches of found models and of missing identifiers for *db_uri*."""
+    db_uri = db_uri or constants.database_uri
+    if db_uri not in _model_caches:
+        _model_caches[db_uri] = LRUCache(constants.model_cache_size)
+        _missing_caches[db_uri] = LRUCache(constants.model_cache_size)
+    return _model_caches[db_uri], _missing_caches[db_uri]
+
+def _known_missing(missing, model_id, now):
+    """Returns True when *model_id* was found missing less than *constants.missing_cache_ttl*
+    seconds before *now*."""
+    seen = missing.get(model_id)
+    if seen is None:
+        return False
+    if now - seen < constants.missing_cache_ttl:
+        return True
+    missing.pop(model_id)
+    return False
+
+def _known_model(found, model_id, now):
+    """Returns the model of *model_id* when it was looked up less than
+    *constants.model_cache_ttl* seconds before *now*, None otherwise."""
+    entry = found.get(model_id)
+    if entry is None:
+        return None
+    if now - entry[1] < constants.model_cache_ttl:
+        return entry[0]
+    found.pop(model_id)
+    return None
+
+def remember_model(model, db_uri=None):
+    """Puts a freshly stored *model* into the lookup cache."""
+    found, missing = _model_cache(db_uri)
+    found.put(model.id, (model, time.time()))
+    missing.pop(model.id)
+
+def forget_models(model_ids, db_uri=None):
+    """Drops the models of *model_ids* from the lookup cache, e.g. after updating them."""
+    found, _ = _model_cache(db_uri)
+    for model_id in model_ids:
+        found.pop(model_id)
+
+def clear_model_cache(db_uri=None):
+    """Forgets every cached model and missing identifier of *db_uri*."""
+    db_uri = db_uri or constants.database_uri
+    _model_caches.pop(db_uri, None)
+    _missing_caches.pop(db_uri, None)
+
+@retry_locked
+def _load_genre_ids(names, db_uri):
+    """Inserts the unknown genre *names* and returns the complete name to identifier map."""
+    with session_scope(db_uri) as db:
+        known = _genre_ids.get(db_uri, {})
+        new_names = set(name for name in names if name not in known)
+        if new_names:
+            db.execute(insert_ignore(Genre.__table__, db), [{'name': name} for name in new_names])
+        return dict(db.query(Genre.name, Genre.id))
+
+def resolve_genres(names, db_uri=None):
+    """
+    Returns a list of *Genre* objects for the passed genre *names*. The genres are resolved
+    from an in memory map which is loaded once; unknown names are inserted in one statement.
+    The returned objects are detached, so adding a model which refers to them never inserts
+    the genre a second time.
+    """
+    db_uri = db_uri or constants.database_uri
+    genre_ids = _genre_ids.get(db_uri)
+    if genre_ids is None or any(name not in genre_ids for name in names):
+        with _genre_lock:
+            genre_ids = _load_genre_ids(names, db_uri)
+            _genre_ids[db_uri] = genre_ids
+
+    genres = []
+    for name in sorted(set(names), key=names.index):
+        genre = Genre(name)
+        genre.id = genre_ids[name]
+        make_transient_to_detached(genre)
+        genres.append(genre)
+    return genres
 
 def get_cached_model(model_id, db_uri=None):
     """
@@ -62,35 +424,87 @@ def get_cached_model(model_id, db_uri=None):
     """
     if isinstance(model_id, bytes):
         model_id = model_id.decode('utf-8')
+    found, missing = _model_cache(db_uri)
+    now = time.time()
+    model = _known_model(found, model_id, now)
+    if model is not None:
+        return model
+    if _known_missing(missing, model_id, now):
+        return None
+
     db = get_db(db_uri)
-    for m in (Movie, TVShow, Person):
-        existing_model = db.query(m).get(model_id)
-        if existing_model:
+    try:
+        for m in model_classes(model_id):
+            existing_model = db.query(m).get(model_id)
+            if existing_model:
+                found.put(model_id, (existing_model, now))
+                return existing_model
+    finally:
+        db.close()
+    missing.put(model_id, now)
+
+def get_cached_models(model_ids, db_uri=None):
+    """
+    Looks up all passed *model_ids* at once and returns a dict mapping the identifiers of
+    the cached models to the models. Identifiers we don't have cached are left out.
+    """
+    found, missing = _model_cache(db_uri)
+    now = time.time()
+    models = {}
+    unresolved = set()
+    for model_id in model_ids:
+        if isinstance(model_id, bytes):
+            model_id = model_id.decode('utf-8')
+        model = _known_model(found, model_id, now)
+        if model is not None:
+            models[model_id] = model
+        elif not _known_missing(missing, model_id, now):
+            unresolved.add(model_id)
+
+    if unresolved:
+        db = get_db(db_uri)
+        try:
+            for m in (Movie, TVShow, Person):
+                candidates = [i for i in unresolved if m in model_classes(i)]
+                # Stay below SQLite's limit of bound parameters per statement.
+                for i in range(0, len(candidates), 500):
+                    for model in db.query(m).filter(m.id.in_(candidates[i:i + 500])):
+                        models[model.id] = model
+                        found.put(model.id, (model, now))
+                        unresolved.discard(model.id)
+        finally:
             db.close()
-            return existing_model
+        for model_id in unresolved:
+            missing.put(model_id, now)
+    return models
 
 def store_search_result(query, model, db_uri=None):
+    """Links the passed *model* to the search result set of *query*."""
+    store_search_results(query, [model], db_uri)
 
-    db = get_db(db_uri)
-    try:
-        sr = SearchResult(query)
-        db.add(sr)
-        db.commit()
-    except sqlalchemy.exc.IntegrityError:
-        db.rollback()
-
-    try:
-        if isinstance(model, Movie):
-            db.execute(result_movie.insert().values([query, model.id]))
-        elif isinstance(model, TVShow):
-            db.execute(result_tvshow.insert().values([query, model.id]))
-        elif isinstance(model, Person):
-            db.execute(result_person.insert().values([query, model.id]))
-    except sqlalchemy.exc.IntegrityError as e:
-        db.close()
-    else:
-        db.commit()
-        db.close()
+@retry_locked
+def store_search_results(query, models, db_uri=None, replace=False, stamp=True):
+    """
+    Links all passed *models* to the search result set of *query* in a single transaction
+    and stamps the set with the current time unless *stamp* is False. Links which already
+    exist are skipped; *replace* drops the links of the stored set first.
+    """
+    tables = ((Movie, result_movie), (TVShow, result_tvshow), (Person, result_person))
+    with session_scope(db_uri) as db:
+        if stamp:
+            upsert(SearchResult.__table__, [{'query': query, 'fetched_at': time.time()}], db)
+        else:
+            # A set without a fetch time is stale until it is stamped.
+            db.execute(insert_ignore(SearchResult.__table__, db),
+                       [{'query': query, 'fetched_at': None}])
+        if replace:
+            for _, table in tables:
+                db.execute(table.delete().where(table.c.query == query))
+        for model_class, table in tables:
+            rows = [dict(zip(table.c.keys(), (query, model.id)))
+                    for model in models if isinstance(model, model_class)]
+            if rows:
+                db.execute(insert_ignore(table, db), rows)
 
 def get_search_results(query, db_uri=None):
     db = get_db(db_uri)
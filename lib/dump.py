@@ -0,0 +1,132 @@
+"""
+Streams the database to and from a line delimited JSON dump.
+
+A dump holds every table of the schema, parents before the tables referring to them. Each
+table starts with a header line, an object with the table name and its columns, followed
+by one JSON array per row. Dumps whose name ends with *.gz* are gzip compressed. Rows are
+read and written in chunks, so memory use doesn't grow with the size of the database.
+"""
+import sys
+import gzip
+import json
+import datetime
+
+from sqlalchemy import select
+
+from lib import search
+from lib.database import get_engine, insert_ignore, clear_model_cache
+from lib.models import Base
+
+def _open(path, mode):
+    """Opens the dump at *path* in binary *mode*; '-' stands for stdin or stdout."""
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return getattr(stream, 'buffer', stream)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+def _encode(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+def dump(path, db_uri=None, chunk_size=10000):
+    """Writes every table of the database to the dump at *path* and returns the row counts."""
+    counts = {}
+    f = _open(path, 'w')
+    connection = get_engine(db_uri).connect()
+    try:
+        for table in Base.metadata.sorted_tables:
+            header = {'table': table.name, 'columns': [c.key for c in table.columns]}
+            f.write((json.dumps(header) + '\n').encode('utf-8'))
+            result = connection.execution_options(stream_results=True).execute(select([table]))
+            counts[table.name] = 0
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                f.write(''.join(json.dumps(list(row), default=_encode) + '\n'
+                                for row in rows).encode('utf-8'))
+                counts[table.name] += len(rows)
+    finally:
+        connection.close()
+        if path != '-':
+            f.close()
+    return counts
+
+class _TableLoader(object):
+    """Inserts the rows of one table of a dump through the DBAPI cursor of *connection*."""
+
+    def __init__(self, connection, table, columns):
+        self.connection = connection
+        self.table = table
+        self.columns = columns
+        self.count = 0
+        statement = insert_ignore(table, connection).compile(dialect=connection.dialect,
+                                                             column_keys=columns)
+        self.sql = statement.string
+        self.order = None
+        if connection.dialect.positional:
+            self.order = [columns.index(name) for name in statement.positiontup]
+
+    def insert(self, lines):
+        """Inserts the rows of the passed dump *lines* with one *executemany*."""
+        # One decoder call for the whole chunk is much faster than one per line.
+        rows = json.loads('[' + ','.join(lines) + ']')
+        if self.order is None:
+            rows = [dict(zip(self.columns, row)) for row in rows]
+        elif self.order != list(range(len(self.columns))):
+            rows = [[row[i] for i in self.order] for row in rows]
+        self.connection.connection.cursor().executemany(self.sql, rows)
+        self.count += len(rows)
+
+def load(path, db_uri=None, chunk_size=10000):
+    """
+    Loads the dump at *path* into the database in a single transaction and returns the row
+    counts. Rows which already exist are skipped. The rows are handed to the DBAPI as they
+    are in the dump; dates are ISO formatted strings, which is how SQLite stores them and
+    what PostgreSQL accepts. On SQLite syncing is turned off and the page cache is enlarged
+    for the load, and the full text index is dropped up front and built once at the end
+    instead of being updated row by row.
+    """
+    engine = get_engine(db_uri)
+    sqlite = engine.dialect.name == 'sqlite'
+    had_index = search.drop_index(db_uri) if sqlite else False
+    loaders = []
+    f = _open(path, 'r')
+    connection = engine.connect()
+    try:
+        if sqlite:
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA cache_size = -65536')
+        with connection.begin():
+            lines = []
+            for line in f:
+                line = line.decode('utf-8').rstrip('\n')
+                if line.startswith('{'):
+                    if lines:
+                        loaders[-1].insert(lines)
+                    header = json.loads(line)
+                    loaders.append(_TableLoader(connection,
+                                                Base.metadata.tables[header['table']],
+                                                header['columns']))
+                    lines = []
+                    continue
+
+                lines.append(line)
+                if len(lines) >= chunk_size:
+                    loaders[-1].insert(lines)
+                    lines = []
+            if lines:
+                loaders[-1].insert(lines)
+    finally:
+        if sqlite:
+            connection.execute('PRAGMA synchronous = FULL')
+        connection.close()
+        if path != '-':
+            f.close()
+        clear_model_cache(db_uri)
+    if had_index:
+        search.has_fts(db_uri)
+    return dict((loader.table.name, loader.count) for loader in loaders)
@@ -0,0 +1,176 @@
+"""
+Breadth first expansion of indexed models along their cast and filmography.
+
+Every level fetches the cast pages of its titles and the filmography pages of its people
+in one batch, then the pages of the people and titles found there which aren't stored yet,
+again in one batch. All models found make up the next level. No identifier is visited
+twice in a run. Across runs *tbl_complete_edges* records the models whose edges are all
+stored; those are expanded from the database without fetching anything.
+"""
+import time
+
+from sqlalchemy import select
+
+from lib import constants, factory, parser
+from lib.crawl import model_url
+from lib.database import (
+    get_engine,
+    get_cached_models,
+    session_scope,
+    insert_ignore,
+    retry_locked,
+    WriteBuffer,
+)
+from lib.fetch import fetch_many
+from lib.models import Person, actor_movie, actor_tvshow, complete_edges
+
+def complete_ids(model_ids, db_uri=None):
+    """Returns the identifiers of *model_ids* whose edges are recorded as complete."""
+    model_ids = list(model_ids)
+    found = set()
+    with get_engine(db_uri).connect() as connection:
+        # Stay below SQLite's limit of bound parameters per statement.
+        for i in range(0, len(model_ids), 500):
+            found.update(row[0] for row in connection.execute(
+                select([complete_edges.c.model_id])
+                .where(complete_edges.c.model_id.in_(model_ids[i:i + 500]))))
+    return found
+
+@retry_locked
+def store_complete(model_ids, db_uri=None):
+    """Records the edges of *model_ids* as complete."""
+    if not model_ids:
+        return
+    now = time.time()
+    with session_scope(db_uri) as db:
+        db.execute(insert_ignore(complete_edges, db),
+                   [{'model_id': model_id, 'completed_at': now} for model_id in model_ids])
+
+def stored_edges(model_ids, db_uri=None):
+    """Returns a dict mapping each of *model_ids* to the identifiers it has edges to."""
+    edges = dict((model_id, []) for model_id in model_ids)
+    title_ids = [i for i in edges if not i.startswith('nm')]
+    person_ids = [i for i in edges if i.startswith('nm')]
+    with get_engine(db_uri).connect() as connection:
+        for table in (actor_movie, actor_tvshow):
+            actor_column, title_column = list(table.c)
+            for column, other, ids in ((title_column, actor_column, title_ids),
+                                       (actor_column, title_column, person_ids)):
+                for i in range(0, len(ids), 500):
+                    for model_id, other_id in connection.execute(
+                            select([column, other]).where(column.in_(ids[i:i + 500]))):
+                        edges[model_id].append(other_id)
+    return edges
+
+
+class Expansion(object):
+    """
+    Expands models breadth first for *depth* levels; depth 1 expands the passed models
+    only. At most *max_pages* pages are fetched in total, None means no limit. *on_model*
+    is called with every newly stored model.
+    """
+
+    def __init__(self, depth=1, max_pages=None, with_cast=True, with_roles=True,
+                 on_model=None, db_uri=None):
+        self.depth = depth
+        self.max_pages = max_pages
+        self.with_cast = with_cast
+        self.with_roles = with_roles
+        self.on_model = on_model
+        self.db_uri = db_uri
+        self.visited = set()
+        self.pages = 0
+        self.stored = 0
+        self.levels = 0
+
+    def exhausted(self):
+        return self.max_pages is not None and self.pages >= self.max_pages
+
+    def _fetch(self, urls, model_pages=False):
+        """Fetches as many of *urls* as the page budget allows and yields (url, source)."""
+        urls = list(urls)
+        if self.max_pages is not None:
+            urls = urls[:max(self.max_pages - self.pages, 0)]
+        for url, source in fetch_many(urls, model_pages):
+            self.pages += 1
+            yield url, source
+
+    def _edges_url(self, model):
+        """Returns the URL of the page listing the edges of *model*, None when the edges
+        of its kind aren't expanded."""
+        if isinstance(model, Person):
+            return constants.roles_url.format(model_id=model.id) if self.with_roles else None
+        return constants.cast_url.format(model_id=model.id) if self.with_cast else None
+
+    def run(self, models):
+        """Expands the passed *models* level by level until *depth* or the page budget is
+        reached."""
+        level = []
+        for model in models:
+            if model.id not in self.visited:
+                self.visited.add(model.id)
+                level.append(model)
+        while level and self.levels < self.depth and not self.exhausted():
+            level = self.expand(level)
+            self.levels += 1
+
+    def expand(self, level):
+        """Stores the edges of the models of one *level* and returns the next level."""
+        urls = {}
+        for model in level:
+            url = self._edges_url(model)
+            if url is not None:
+                urls[url] = model
+        complete = complete_ids([m.id for m in urls.values()], self.db_uri)
+        # Maps the expanded models to the identifiers of their edges.
+        found = stored_edges(complete, self.db_uri)
+        for url, source in self._fetch(u for u, m in urls.items() if m.id not in complete):
+            if source:
+                model = urls[url]
+                found[model.id] = (parser.roles(source) if isinstance(model, Person)
+                                   else parser.cast(source))
+
+        expanded = dict((m.id, m) for m in urls.values() if m.id in found)
+        other_ids = set(i for ids in found.values() for i in ids)
+        models = get_cached_models(other_ids, self.db_uri)
+        models.update(expanded)
+        next_level = [models[i] for i in other_ids if i in models and i not in self.visited]
+        self.visited.update(models)
+
+        missing = {}
+        for model_id in other_ids:
+            if model_id not in models and model_id not in self.visited:
+                self.visited.add(model_id)
+                url = model_url(model_id)
+                if url is not None:
+                    missing[url] = model_id
+        with WriteBuffer(self.db_uri) as buffer:
+            for url, source in self._fetch(missing, model_pages=True):
+                model = factory.model_builder(source, self.db_uri) if source else None
+                if model is None or model.id != missing[url]:
+                    continue
+                buffer.add_model(model)
+                models[model.id] = model
+                next_level.append(model)
+                self.stored += 1
+                if self.on_model:
+                    self.on_model(model)
+
+            newly_complete = []
+            for model_id, edge_ids in found.items():
+                if model_id in complete:
+                    continue
+                model = expanded[model_id]
+                for other_id in edge_ids:
+                    other = models.get(other_id)
+                    if other is None:
+                        continue
+                    if isinstance(model, Person):
+                        buffer.add_cast_member(other, model)
+                    else:
+                        buffer.add_cast_member(model, other)
+                if all(i in models for i in edge_ids):
+                    newly_complete.append(model_id)
+        # Recorded once the edges are written, so a failed write never marks them complete.
+        store_complete(newly_complete, self.db_uri)
+        return next_level
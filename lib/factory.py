@@ -1,60 +1,88 @@
-from lib import parser
+import time
+import hashlib
+
+from lib import metrics, parser
+from lib.database import resolve_genres
 from lib.models import Movie, TVShow, Person
 
-def movie(source, db_uri=None):
+def movie(source, db_uri=None, record=None):
     """
     Builds a movie object from the passed *source* and returns it. The optional parameter
     *db_uri* can be modified to look up genres in a different database if needed. By default
-    this parameter uses the *constants.database_uri*.
-    """
-    return Movie(id=parser.model_id(source),
-                 title=parser.title(source),
-                 poster=parser.poster(source),
-                 rating=parser.rating(source),
-                 duration=parser.duration(source),
-                 plot=parser.plot(source),
-                 release_year=parser.release_year(source),
-                 genres=parser.genres(source, db_uri=db_uri))
+    this parameter uses the *constants.database_uri*. An already extracted *record* of the
+    source can be passed to skip the extraction.
+    """
+    record = record or parser.extract(source)
+    return Movie(id=record['id'],
+                 title=record['title'],
+                 poster=record['poster'],
+                 rating=record['rating'],
+                 duration=record['duration'],
+                 plot=record['plot'],
+                 release_year=record['release_year'],
+                 genres=resolve_genres(record['genres'], db_uri))
 
-def tvshow(source, db_uri=None):
+def tvshow(source, db_uri=None, record=None):
     """
     Builds a TVShow object from the passed *source* and returns it. The optional parameter
     *db_uri* can be modified to look up genres in a different database if needed. By default
-    this parameter uses *constants.database_uri*.
-    """
-    return TVShow(id=parser.model_id(source),
-                  title=parser.title(source),
-                  poster=parser.poster(source),
-                  rating=parser.rating(source),
-                  plot=parser.plot(source),
-                  release_year=parser.release_year(source),
-                  genres=parser.genres(source, db_uri=db_uri))
+    this parameter uses *constants.database_uri*. An already extracted *record* of the
+    source can be passed to skip the extraction.
+    """
+    record = record or parser.extract(source)
+    return TVShow(id=record['id'],
+                  title=record['title'],
+                  poster=record['poster'],
+                  rating=record['rating'],
+                  plot=record['plot'],
+                  release_year=record['release_year'],
+                  genres=resolve_genres(record['genres'], db_uri))
 
-def person(source):
+def person(source, record=None):
     """Builds a *Person* object from the information in the passed *source*."""
-    firstname, middlename, lastname = parser.fullname(source)
-    return Person(id=parser.model_id(source),
-                  firstname=firstname,
-                  lastname=lastname,
-                  middlename=middlename,
-                  birthday=parser.birthday(source))
+    record = record or parser.extract(source)
+    return Person(id=record['id'],
+                  firstname=record['firstname'],
+                  lastname=record['lastname'],
+                  middlename=record['middlename'],
+                  birthday=record['birthday'])
+
+def content_hash(source):
+    """
+    Returns the SHA-1 hex digest of the page *source* up to the end of the last field of
+    its model, used to detect changed pages. A streamed page stops there (see
+    *lib.fetch.PageExtractor*) and hashes like the full page.
+    """
+    found = parser.extract_prefix(source)
+    if found is not None:
+        source = source[:found[1]]
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
 
 def model_builder(source, db_uri=None):
     """
     This function tries to detect what kind of model to build by parsing the passed *source*.
-    On Success the parsed model is returned None on failure.
+    On Success the parsed model is returned None on failure. The model is stamped with the
+    time it was built and the *content_hash* of *source*.
 
     The optional parameter *db_uri* can be used to specify a different database to use during
     Genre lookups.
     """
+    start = time.time()
     try:
-        model_type = parser.model_type(source)
+        record = parser.extract(source)
+        model_type = record['model_type']
+        model = None
         if model_type == 'tv_show':
-            return tvshow(source, db_uri=db_uri)
+            model = tvshow(source, db_uri=db_uri, record=record)
         elif model_type == 'movie':
-            return movie(source, db_uri=db_uri)
+            model = movie(source, db_uri=db_uri, record=record)
         elif model_type == 'actor':
-            return person(source)
+            model = person(source, record=record)
+        if model is not None:
+            model.fetched_at = time.time()
+            model.content_hash = content_hash(source)
+        metrics.observe('build_seconds', time.time() - start, model_type=model_type)
+        return model
     except AttributeError:
         # Model couldn't be parsed.
-        pass
+        metrics.incr('build_failures')
@@ -0,0 +1,295 @@
+import time
+import threading
+from collections import deque
+
+try:
+    from io import BytesIO
+except ImportError:
+    from StringIO import StringIO as BytesIO
+
+import pycurl
+
+from lib import constants, metrics, pagecache, parser
+from lib.policy import FetchPolicy, default_policy, retry_statuses
+
+class PageExtractor(object):
+    """
+    A curl write callback which collects the body of a title or person page and stops the
+    transfer as soon as *parser.extract_prefix* finds every field, checked every *step*
+    bytes. *source* holds the page up to the end of the last field once it stopped.
+    """
+
+    def __init__(self, step=16384):
+        self.step = step
+        self.chunks = []
+        self.size = 0
+        self.checked = 0
+        self.source = None
+
+    def __call__(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size - self.checked < self.step:
+            return None
+        self.checked = self.size
+        body = b''.join(self.chunks)
+        self.chunks = [body]
+        found = parser.extract_prefix(body.decode('utf-8', 'replace'))
+        if found is None:
+            return None
+        self.source = body.decode('utf-8', 'replace')[:found[1]]
+        # Consuming fewer bytes than passed makes curl abort the transfer.
+        return 0
+
+    def getvalue(self):
+        if self.source is not None:
+            return self.source.encode('utf-8')
+        return b''.join(self.chunks)
+
+
+class Fetcher(object):
+    """
+    Fetches batches of URLs concurrently on top of *pycurl.CurlMulti*.
+
+    The easy handles are created once and reused between transfers which lets curl keep the
+    connections to a host alive. *concurrency* limits the amount of simultaneous transfers.
+    Timeouts, retries, throttling per host and circuit breaking follow *policy*, the policy
+    shared with *process_url* by default; a *rate_limit* gives the fetcher a policy of its
+    own which starts at most that many requests per second and host. With *stream* the
+    transfers of title and person pages stop once every field of the model arrived; see
+    *fetch*.
+    """
+
+    def __init__(self, concurrency=None, rate_limit=None, headers=None, stream=None,
+                 policy=None):
+        self.concurrency = concurrency or constants.fetch_concurrency
+        if policy is None:
+            policy = FetchPolicy(rate=rate_limit) if rate_limit is not None else default_policy()
+        self.policy = policy
+        self.headers = headers or ['Accept-Language: en-US']
+        self.stream = stream if stream is not None else constants.fetch_stream
+        self.multi = pycurl.CurlMulti()
+        self.free_handles = [self._new_handle() for _ in range(self.concurrency)]
+        self.active_handles = set()
+        self.stream_stats = {'pages': 0, 'stopped': 0, 'bytes_saved': 0}
+
+    def _new_handle(self):
+        c = pycurl.Curl()
+        c.setopt(c.HTTPHEADER, self.headers)
+        c.setopt(c.FOLLOWLOCATION, True)
+        c.setopt(c.TCP_KEEPALIVE, 1)
+        self.policy.apply(c)
+        return c
+
+    def _delay(self, request, now):
+        """Returns the seconds until *request* may start, None when its host is failing."""
+        if request[5] > now:
+            return request[5] - now
+        return self.policy.delay(request[0], now)
+
+    def _next_start(self, pending, longest):
+        """Returns the seconds until the first of the *pending* requests may start, at most
+        *longest*."""
+        now = time.time()
+        delays = [d for d in (self._delay(r, now) for r in pending) if d is not None]
+        return min([longest] + delays)
+
+    def _start(self, request, now):
+        url, extra_headers, entry, stream, attempt, not_before = request
+        c = self.free_handles.pop()
+        c.request = request
+        c.started_at = now
+        c.url = url
+        c.entry = entry
+        c.headers = pagecache.HeaderCollector()
+        c.setopt(c.URL, url.encode('utf-8'))
+        c.setopt(c.HTTPHEADER, self.headers + extra_headers)
+        if stream:
+            c.buffer = PageExtractor()
+            c.setopt(c.WRITEFUNCTION, c.buffer)
+        else:
+            c.buffer = BytesIO()
+            c.setopt(c.WRITEDATA, c.buffer)
+        c.setopt(c.HEADERFUNCTION, c.headers)
+        self.multi.add_handle(c)
+        self.active_handles.add(c)
+        self.policy.started(url, now)
+
+    def _schedule(self, pending, rejected):
+        """Starts as many *pending* transfers as the concurrency limit and the policy allow.
+        Requests to hosts whose circuit is open move to *rejected*."""
+        now = time.time()
+        for _ in range(len(pending)):
+            if not self.free_handles:
+                break
+            request = pending.popleft()
+            delay = self._delay(request, now)
+            if delay is None:
+                rejected.append(request)
+            elif delay <= 0:
+                self._start(request, now)
+            else:
+                pending.append(request)
+
+    def _retry(self, c, pending, **outcome):
+        """Tells the policy the outcome of the transfer of *c* and queues the request again
+        when the policy retries it. Returns True in that case and releases the handle."""
+        request = c.request
+        delay = self.policy.outcome(request[0], request[4], started_at=c.started_at, **outcome)
+        if delay is None:
+            return False
+        self._finish(c, failed=True)
+        pending.append(request[:4] + (request[4] + 1, time.time() + delay))
+        return True
+
+    def _finish(self, c, failed=False):
+        """Releases the handle *c* and returns its URL and raw body (None on failure)."""
+        self.multi.remove_handle(c)
+        self.active_handles.discard(c)
+        url, body = c.url, c.buffer.getvalue()
+        cache = pagecache.get_cache()
+        stopped = getattr(c.buffer, 'source', None) is not None
+        if failed:
+            body = None
+        else:
+            metrics.record_transfer(c)
+        if isinstance(c.buffer, PageExtractor) and not failed:
+            self._count_stream(c, stopped)
+        # A stopped transfer holds only the beginning of the page, which isn't cached.
+        if not failed and not stopped and cache is not None:
+            body = cache.after_fetch(url, c.entry, c.getinfo(c.RESPONSE_CODE), body,
+                                     c.headers.headers)
+        c.buffer = c.headers = c.entry = c.request = None
+        self.free_handles.append(c)
+        return url, body
+
+    def _count_stream(self, c, stopped):
+        """Records the bytes a streamed transfer saved, known when the server sent the
+        length of the body."""
+        self.stream_stats['pages'] += 1
+        if not stopped:
+            return
+        self.stream_stats['stopped'] += 1
+        length = c.headers.headers.get('content-length', '')
+        saved = max(int(length) - c.buffer.size, 0) if length.isdigit() else 0
+        self.stream_stats['bytes_saved'] += saved
+        metrics.incr('fetch_stopped_early')
+        metrics.incr('fetch_bytes_saved', saved)
+
+    def summary(self):
+        return ('streaming: {pages} model pages, {stopped} stopped early, {per_page:.0f} '
+                'bytes saved per page'.format(
+                    per_page=self.stream_stats['bytes_saved'] /
+                    float(max(self.stream_stats['pages'], 1)), **self.stream_stats))
+
+    def fetch(self, urls, model_pages=False):
+        """
+        Fetches all passed *urls* and yields *(url, source)* tuples in the order the
+        transfers complete. The source of a failed transfer is None; failed transfers and
+        answers with a status the policy retries are started again until the policy gives
+        up on them. Pages in the page cache are yielded without a request.
+
+        Callers which only build models from the pages pass *model_pages*; a streaming
+        fetcher then stops each transfer once the model is complete and the source ends
+        after its last field. Those pages don't go into the page cache.
+        """
+        cache = pagecache.get_cache()
+        stream = model_pages and self.stream
+        # (url, extra headers, cache entry, stream, attempt, not before)
+        pending = deque()
+        rejected = []
+        cached = []
+        for url in urls:
+            if cache is None:
+                pending.append((url, [], None, stream, 0, 0))
+                continue
+            body, extra_headers, entry = cache.before_fetch(url)
+            if body is not None:
+                metrics.record_transfer(None, cached=True)
+                cached.append((url, body.decode('utf-8', 'replace')))
+            else:
+                pending.append((url, extra_headers, entry, stream, 0, 0))
+
+        try:
+            # Get the transfers going before handing out the cached pages.
+            self._schedule(pending, rejected)
+            for result in cached:
+                yield result
+
+            while pending or self.active_handles or rejected:
+                self._schedule(pending, rejected)
+                while rejected:
+                    self.policy.reject()
+                    yield rejected.pop()[0], None
+                if not self.active_handles:
+                    # Every pending request is throttled or backing off; wait for the first
+                    # one which may start.
+                    time.sleep(self._next_start(pending, 1.0))
+                    continue
+
+                while self.multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+
+                while True:
+                    queued, succeeded, failed = self.multi.info_read()
+                    for c in succeeded:
+                        status = c.getinfo(c.RESPONSE_CODE)
+                        if self._retry(c, pending, status=status, headers=c.headers.headers):
+                            continue
+                        if status in retry_statuses:
+                            metrics.incr('fetch_errors')
+                            yield self._finish(c, failed=True)
+                            continue
+                        request = c.request
+                        url, body = self._finish(c)
+                        if body is None:
+                            # Not modified, but the cached body is gone; asks again without
+                            # the validators of the dropped entry.
+                            pending.append((url, [], None) + request[3:5] + (0,))
+                            continue
+                        yield url, body.decode('utf-8', 'replace')
+                    for c, errno, errmsg in failed:
+                        if getattr(c.buffer, 'source', None) is not None:
+                            # Stopped on purpose once the model was complete.
+                            self.policy.outcome(c.url, c.request[4],
+                                                status=c.getinfo(c.RESPONSE_CODE),
+                                                started_at=c.started_at)
+                            url, body = self._finish(c)
+                            yield url, body.decode('utf-8')
+                            continue
+                        if self._retry(c, pending, error=errno):
+                            continue
+                        metrics.incr('fetch_errors')
+                        yield self._finish(c, failed=True)
+                    if not queued:
+                        break
+
+                if self.active_handles:
+                    self.multi.select(self._next_start(pending, 1.0))
+        finally:
+            # The consumer may stop iterating early; hand the unfinished handles back.
+            for c in list(self.active_handles):
+                self._finish(c, failed=True)
+
+    def close(self):
+        for c in self.free_handles:
+            c.close()
+        self.free_handles = []
+        self.multi.close()
+
+_local = threading.local()
+
+def default_fetcher():
+    """Returns the *Fetcher* used by *fetch_many* in the calling thread, creating it on first
+    use. A curl multi handle must not be shared across threads, so every thread gets its own."""
+    fetcher = getattr(_local, 'fetcher', None)
+    if fetcher is None:
+        fetcher = _local.fetcher = Fetcher()
+    return fetcher
+
+def fetch_many(urls, model_pages=False):
+    """
+    Fetches the passed *urls* with the default *Fetcher* and yields *(url, source)* tuples
+    as the transfers complete. See *Fetcher.fetch* for *model_pages*.
+    """
+    return default_fetcher().fetch(urls, model_pages)
@@ -0,0 +1,304 @@
+"""
+A persistent crawl frontier for continuous indexing.
+
+The frontier is a SQLite backed priority queue of model identifiers. Every identifier which
+ever entered the frontier stays in its table, which makes the queue double as the record of
+what was seen; a compact bitmap over the numeric part of the identifiers is rebuilt from it
+on start up and answers the dedup checks in memory. Items which were being crawled when the
+process died are queued again on start up, items which are done are never fetched again.
+"""
+import re
+import sys
+import time
+import random
+import sqlite3
+
+from lib import constants, factory, parser
+from lib.crawl import model_url
+from lib.database import get_cached_models, WriteBuffer
+from lib.expand import complete_ids, stored_edges
+from lib.fetch import fetch_many
+from lib.models import Movie, TVShow, Person
+
+QUEUED, CRAWLING, DONE, FAILED = range(4)
+id_re = re.compile(r'^(tt|nm)(\d+)$')
+
+
+class SeenSet(object):
+    """A set of model identifiers stored as one growable bitmap per identifier prefix."""
+
+    def __init__(self):
+        self.bitmaps = {}
+        self.others = set()
+
+    def add(self, model_id):
+        """Adds *model_id* and returns True when it wasn't in the set yet."""
+        match = id_re.match(model_id)
+        if not match:
+            if model_id in self.others:
+                return False
+            self.others.add(model_id)
+            return True
+
+        number = int(match.group(2))
+        bitmap = self.bitmaps.setdefault(match.group(1), bytearray())
+        index, bit = number >> 3, 1 << (number & 7)
+        if index >= len(bitmap):
+            bitmap.extend(bytearray(max(index + 1, 2 * len(bitmap)) - len(bitmap)))
+        if bitmap[index] & bit:
+            return False
+        bitmap[index] |= bit
+        return True
+
+    def __contains__(self, model_id):
+        match = id_re.match(model_id)
+        if not match:
+            return model_id in self.others
+        number = int(match.group(2))
+        bitmap = self.bitmaps.get(match.group(1), b'')
+        return (number >> 3) < len(bitmap) and bool(bitmap[number >> 3] & (1 << (number & 7)))
+
+
+class Frontier(object):
+    """The SQLite backed queue of model identifiers waiting to be crawled."""
+
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or constants.frontier_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS frontier (
+                id TEXT PRIMARY KEY,
+                priority INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS ix_frontier_queue ON frontier (state, priority);
+            CREATE TABLE IF NOT EXISTS pending_edge (
+                waiting_id TEXT NOT NULL,
+                title_id TEXT NOT NULL,
+                person_id TEXT NOT NULL,
+                PRIMARY KEY (waiting_id, title_id, person_id)
+            );
+        ''')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(frontier)')]
+        if 'attempts' not in columns:
+            self.db.execute('ALTER TABLE frontier ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        # Whatever was being crawled when the last run stopped gets crawled again.
+        self.db.execute('UPDATE frontier SET state = ? WHERE state = ?', (QUEUED, CRAWLING))
+        self.db.commit()
+        self.seen = SeenSet()
+        for (model_id,) in self.db.execute('SELECT id FROM frontier'):
+            self.seen.add(model_id)
+
+    def add(self, model_ids, priority=0):
+        """Queues every identifier of *model_ids* which was never seen before."""
+        new_ids = [(i, priority, QUEUED) for i in model_ids if self.seen.add(i)]
+        if new_ids:
+            self.db.executemany('INSERT OR IGNORE INTO frontier (id, priority, state) '
+                                'VALUES (?, ?, ?)', new_ids)
+            self.db.commit()
+        return len(new_ids)
+
+    def pop(self, count):
+        """Marks the *count* identifiers with the highest priority as being crawled and
+        returns them as (id, priority) tuples."""
+        rows = self.db.execute('SELECT id, priority FROM frontier WHERE state = ? '
+                               'ORDER BY priority DESC, rowid LIMIT ?', (QUEUED, count)).fetchall()
+        self.db.executemany('UPDATE frontier SET state = ? WHERE id = ?',
+                            [(CRAWLING, i) for i, _ in rows])
+        self.db.commit()
+        return rows
+
+    def finish(self, model_ids, state=DONE):
+        self.db.executemany('UPDATE frontier SET state = ? WHERE id = ?',
+                            [(state, i) for i in model_ids])
+        self.db.commit()
+
+    def retry(self, model_ids, max_attempts=None):
+        """Queues *model_ids*, whose pages couldn't be fetched, again one priority lower.
+        Those which failed *max_attempts* times, *constants.frontier_max_attempts* by
+        default, are marked as failed instead."""
+        max_attempts = max_attempts or constants.frontier_max_attempts
+        self.db.executemany('UPDATE frontier SET attempts = attempts + 1, '
+                            'priority = priority - 1, '
+                            'state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END '
+                            'WHERE id = ?',
+                            [(max_attempts, FAILED, QUEUED, i) for i in model_ids])
+        self.db.commit()
+
+    def add_edges(self, edges):
+        """Remembers (waiting id, title id, person id) cast edges until the model with the
+        waiting id is stored."""
+        self.db.executemany('INSERT OR IGNORE INTO pending_edge VALUES (?, ?, ?)', edges)
+        self.db.commit()
+
+    def take_edges(self, model_ids):
+        """Returns and forgets the (title id, person id) edges waiting for *model_ids*."""
+        edges = []
+        for model_id in model_ids:
+            edges.extend(self.db.execute('SELECT title_id, person_id FROM pending_edge '
+                                         'WHERE waiting_id = ?', (model_id,)))
+            self.db.execute('DELETE FROM pending_edge WHERE waiting_id = ?', (model_id,))
+        self.db.commit()
+        return edges
+
+    def counts(self):
+        """Returns a dict with the amount of identifiers per state."""
+        names = {QUEUED: 'queued', CRAWLING: 'crawling', DONE: 'done', FAILED: 'failed'}
+        return dict((names[state], count) for state, count in
+                    self.db.execute('SELECT state, COUNT(*) FROM frontier GROUP BY state'))
+
+    def close(self):
+        self.db.close()
+
+
+def random_ids(count):
+    """Returns *count* random title and name identifiers, like rnd.sh used to pick."""
+    return ['{}{:07d}'.format(random.choice(('tt', 'nm')), random.randrange(1, 9999999))
+            for _ in range(count)]
+
+
+class Crawler(object):
+    """
+    Crawls the identifiers of a *Frontier* in batches. Every stored model is expanded by
+    its cast (titles) or its roles (people) and every identifier found on a crawled page
+    is queued with a priority one below the page it was found on. An identifier is done
+    once its edges are stored. Pages which aren't models fail it; failed transfers queue it
+    again (see *Frontier.retry*), and a batch of which nothing got through is followed by
+    a pause of *retry_delay* seconds, *constants.fetch_breaker_cooldown* by default.
+    """
+
+    def __init__(self, frontier, batch_size=50, with_cast=True, with_roles=True,
+                 on_model=None, retry_delay=None, db_uri=None):
+        self.frontier = frontier
+        self.batch_size = batch_size
+        self.with_cast = with_cast
+        self.with_roles = with_roles
+        self.on_model = on_model
+        self.retry_delay = (constants.fetch_breaker_cooldown if retry_delay is None
+                            else retry_delay)
+        self.db_uri = db_uri
+        self.pages = 0
+        self.started = time.time()
+
+    def step(self):
+        """Crawls one batch and returns the amount of identifiers taken from the frontier."""
+        batch = self.frontier.pop(self.batch_size)
+        if not batch:
+            return 0
+        priorities = dict(batch)
+        # Models stored before but never expanded, e.g. because the crawler stopped while
+        # fetching their cast, are expanded like freshly fetched ones.
+        cached = get_cached_models(priorities, self.db_uri)
+
+        urls = {}
+        for model_id in priorities:
+            _model_url = model_url(model_id)
+            if model_id not in cached and _model_url:
+                urls[_model_url] = model_id
+
+        # The page of a redirected or merged identifier holds a model with another one;
+        # maps the identifiers of the stored models to the ones requested.
+        requested = dict((model_id, model_id) for model_id in cached)
+        stored, done = list(cached.values()), list(cached)
+        failed, unreachable = [], []
+        with WriteBuffer(self.db_uri) as buffer:
+            for url, source in fetch_many(urls):
+                self.pages += 1
+                model_id = urls[url]
+                if source is None:
+                    # Timed out, refused or rejected; the page may well be there later.
+                    unreachable.append(model_id)
+                    continue
+                model = factory.model_builder(source, self.db_uri)
+                if model is None:
+                    failed.append(model_id)
+                    continue
+                buffer.add_model(model)
+                stored.append(model)
+                done.append(model_id)
+                requested[model.id] = model_id
+                self.frontier.add(parser.model_ids(source), priorities[model_id] - 1)
+                if self.on_model:
+                    self.on_model(model)
+        self.frontier.finish(failed, FAILED)
+
+        self._store_waiting_edges(requested)
+        unexpanded = self._expand(stored, dict((m.id, priorities[requested[m.id]])
+                                               for m in stored))
+        unreachable.extend(requested[model_id] for model_id in unexpanded)
+        self.frontier.retry(unreachable)
+        # Done only once the edges are stored, a crawler stopped before expands them again.
+        finished = set(done) - set(unreachable)
+        self.frontier.finish(finished)
+        if unreachable and not finished and not failed and self.retry_delay:
+            # Nothing got through; give the hosts a break before the next batch.
+            time.sleep(self.retry_delay)
+        return len(batch)
+
+    def _expand(self, models, priorities):
+        """Fetches the cast and role pages of the *models* and stores their edges. The
+        neighbours of models whose edges are all stored already are queued without
+        fetching anything."""
+        complete = complete_ids([m.id for m in models], self.db_uri)
+        for model_id, other_ids in stored_edges(complete, self.db_uri).items():
+            self.frontier.add(other_ids, priorities[model_id] - 1)
+
+        urls = {}
+        for model in models:
+            if model.id in complete:
+                continue
+            if isinstance(model, (Movie, TVShow)) and self.with_cast:
+                urls[constants.cast_url.format(model_id=model.id)] = model
+            elif isinstance(model, Person) and self.with_roles:
+                urls[constants.roles_url.format(model_id=model.id)] = model
+
+        edges, waiting, unreachable = [], [], []
+        for url, source in fetch_many(urls):
+            self.pages += 1
+            model = urls[url]
+            if source is None:
+                unreachable.append(model.id)
+                continue
+            if not source:
+                continue
+            if isinstance(model, Person):
+                found = [(title_id, model.id, title_id) for title_id in parser.roles(source)]
+            else:
+                found = [(model.id, person_id, person_id) for person_id in parser.cast(source)]
+            self.frontier.add([other_id for _, _, other_id in found], priorities[model.id] - 1)
+            cached = get_cached_models([other_id for _, _, other_id in found], self.db_uri)
+            for title_id, person_id, other_id in found:
+                if other_id in cached:
+                    edges.append((title_id, person_id))
+                else:
+                    waiting.append((other_id, title_id, person_id))
+
+        self.frontier.add_edges(waiting)
+        self._store_edges(edges)
+        return unreachable
+
+    def _store_waiting_edges(self, requested):
+        """Stores the edges waiting for the models in *requested*, which maps the identifiers
+        of stored models to the identifiers they were requested by."""
+        aliases = dict((requested_id, model_id) for model_id, requested_id in requested.items())
+        edges = self.frontier.take_edges(set(requested) | set(aliases))
+        self._store_edges([(aliases.get(title_id, title_id), aliases.get(person_id, person_id))
+                           for title_id, person_id in edges])
+
+    def _store_edges(self, edges):
+        models = get_cached_models(set(i for edge in edges for i in edge), self.db_uri)
+        with WriteBuffer(self.db_uri) as buffer:
+            for title_id, person_id in edges:
+                if title_id in models and person_id in models:
+                    buffer.add_cast_member(models[title_id], models[person_id])
+
+    def pages_per_minute(self):
+        return self.pages * 60.0 / max(time.time() - self.started, 1e-9)
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        counts = self.frontier.counts()
+        stream.write('{:.1f} pages/min, {} pages, {} queued, {} done, {} failed\n'.format(
+            self.pages_per_minute(), self.pages, counts.get('queued', 0),
+            counts.get('done', 0), counts.get('failed', 0)))
@@ -0,0 +1,291 @@
+"""
+An in-memory graph of the cast edges for co-star lookups and degrees of separation.
+
+People and titles are identified by the numeric part of their identifiers. Both are kept in
+sorted integer arrays, so the position of a person or title is found by bisection. The
+edges are stored twice in compressed sparse row form: *person_offsets* and *person_titles*
+list the titles of every person, *title_offsets* and *title_people* the people of every
+title. A snapshot file holds the same six arrays and is memory mapped when loaded.
+"""
+import os
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from sqlalchemy import select, union_all
+
+from lib import constants
+from lib.database import get_engine
+from lib.models import actor_movie, actor_tvshow
+
+snapshot_magic = b'IMGR'
+snapshot_version = 1
+# Magic, version, byte order, item size, amount of people, titles and edges.
+snapshot_header = struct.Struct('<4sI4sIIII')
+# Python 2 can't view a mapping as integers; snapshots are copied into arrays there.
+memoryview_cast = hasattr(memoryview, 'cast')
+
+
+class CastGraph(object):
+    """
+    The bipartite graph of people and the titles they played in. Paths between people
+    alternate between person and title identifiers.
+    """
+
+    def __init__(self, people, titles, person_offsets, person_titles, title_offsets,
+                 title_people):
+        self.people = people
+        self.titles = titles
+        self.person_offsets = person_offsets
+        self.person_titles = person_titles
+        self.title_offsets = title_offsets
+        self.title_people = title_people
+        self.snapshot = None
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Builds the graph from (person number, title number) tuples."""
+        edges = set(edges)
+        people = array('i', sorted(set(p for p, _ in edges)))
+        titles = array('i', sorted(set(t for _, t in edges)))
+        person_index = dict((n, i) for i, n in enumerate(people))
+        title_index = dict((n, i) for i, n in enumerate(titles))
+        pairs = sorted((person_index[p], title_index[t]) for p, t in edges)
+
+        person_offsets, person_titles = _csr(pairs, len(people))
+        pairs.sort(key=lambda pair: (pair[1], pair[0]))
+        title_offsets, title_people = _csr([(t, p) for p, t in pairs], len(titles))
+        return cls(people, titles, person_offsets, person_titles, title_offsets, title_people)
+
+    @classmethod
+    def from_db(cls, db_uri=None):
+        """Builds the graph from the movie and tv show cast tables."""
+        statement = union_all(select([actor_movie.c.actor_id, actor_movie.c.movie_id]),
+                              select([actor_tvshow.c.actor_id, actor_tvshow.c.tvshow_id]))
+        connection = get_engine(db_uri).connect()
+        try:
+            edges = [(int(person_id[2:]), int(title_id[2:]))
+                     for person_id, title_id in connection.execute(statement)]
+        finally:
+            connection.close()
+        return cls.from_edges(edges)
+
+    def save(self, path=None):
+        """Writes the graph to the snapshot file at *path*."""
+        path = path or constants.graph_snapshot_path
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(snapshot_header.pack(snapshot_magic, snapshot_version,
+                                         _byteorder(), self.people.itemsize, len(self.people),
+                                         len(self.titles), len(self.person_titles)))
+            for values in self._arrays():
+                array('i', values).tofile(f)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Maps the snapshot file at *path* into memory and returns the graph. The arrays are
+        read straight from the mapping, so loading takes the same time for any graph size;
+        on Python 2 they are copied out of it.
+        Raises ValueError for files which weren't written by *save* on this platform.
+        """
+        path = path or constants.graph_snapshot_path
+        with open(path, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byteorder, itemsize, people, titles, edges = \
+            snapshot_header.unpack_from(snapshot)
+        if (magic, version, byteorder, itemsize) != \
+                (snapshot_magic, snapshot_version, _byteorder(), array('i').itemsize):
+            snapshot.close()
+            raise ValueError('{} is not a graph snapshot of this version and '
+                             'platform'.format(path))
+
+        lengths = (people, titles, people + 1, edges, titles + 1, edges)
+        arrays = []
+        offset = snapshot_header.size
+        view = memoryview(snapshot) if memoryview_cast else None
+        for length in lengths:
+            size = length * itemsize
+            if view is not None:
+                arrays.append(view[offset:offset + size].cast('i'))
+            else:
+                arrays.append(array('i', snapshot[offset:offset + size]))
+            offset += size
+        if view is None:
+            snapshot.close()
+            return cls(*arrays)
+        graph = cls(*arrays)
+        graph.snapshot = snapshot
+        return graph
+
+    def _arrays(self):
+        return (self.people, self.titles, self.person_offsets, self.person_titles,
+                self.title_offsets, self.title_people)
+
+    def __len__(self):
+        """Returns the amount of edges."""
+        return len(self.person_titles)
+
+    #
+    # Nodes are the positions of people, followed by the positions of titles shifted by the
+    # amount of people.
+    #
+
+    def _node(self, model_id):
+        """Returns the node of *model_id* or None when the graph doesn't contain it."""
+        if model_id.startswith('nm'):
+            numbers = self.people
+        elif model_id.startswith('tt'):
+            numbers = self.titles
+        else:
+            return None
+        try:
+            number = int(model_id[2:])
+        except ValueError:
+            return None
+        i = bisect_left(numbers, number)
+        if i == len(numbers) or numbers[i] != number:
+            return None
+        return i if numbers is self.people else len(self.people) + i
+
+    def _model_id(self, node):
+        if node < len(self.people):
+            return 'nm{:07d}'.format(self.people[node])
+        return 'tt{:07d}'.format(self.titles[node - len(self.people)])
+
+    def _neighbours(self, node):
+        people = len(self.people)
+        if node < people:
+            start, end = self.person_offsets[node], self.person_offsets[node + 1]
+            return [people + t for t in self.person_titles[start:end]]
+        start, end = self.title_offsets[node - people], self.title_offsets[node - people + 1]
+        return self.title_people[start:end]
+
+    def titles_of(self, person_id):
+        """Returns the identifiers of the titles *person_id* played in."""
+        node = self._node(person_id)
+        return [self._model_id(n) for n in self._neighbours(node)] if node is not None else []
+
+    def cast_of(self, title_id):
+        """Returns the identifiers of the people in the cast of *title_id*."""
+        node = self._node(title_id)
+        return [self._model_id(n) for n in self._neighbours(node)] if node is not None else []
+
+    def costars(self, person_id):
+        """
+        Returns (person id, shared titles) tuples for everyone who played in a title with
+        *person_id*, most shared titles first.
+        """
+        node = self._node(person_id)
+        if node is None:
+            return []
+        counts = Counter()
+        for title in self._neighbours(node):
+            counts.update(self._neighbours(title))
+        del counts[node]
+        return [(self._model_id(n), count) for n, count in
+                sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+    def neighbourhood(self, model_id, depth=1):
+        """
+        Returns a dict mapping the identifiers of all people and titles at most *depth*
+        degrees away from *model_id* to their degree. A degree is a step from a person to a
+        co-star, or from a title to a title sharing a cast member.
+        """
+        node = self._node(model_id)
+        if node is None:
+            return {}
+        distances = {node: 0}
+        frontier = [node]
+        # Every degree is two hops in the bipartite graph.
+        for hop in range(1, 2 * depth + 1):
+            next_frontier = []
+            for n in frontier:
+                for neighbour in self._neighbours(n):
+                    if neighbour not in distances:
+                        distances[neighbour] = (hop + 1) // 2
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        return dict((self._model_id(n), d) for n, d in distances.items())
+
+    def shortest_path(self, from_id, to_id, max_degrees=None):
+        """
+        Returns the shortest path from *from_id* to *to_id* as a list of identifiers which
+        alternates between people and titles, or None when there is no path of at most
+        *max_degrees* degrees. The search runs from both ends and always expands the
+        smaller frontier.
+        """
+        source, target = self._node(from_id), self._node(to_id)
+        if source is None or target is None:
+            return None
+        if source == target:
+            return [from_id]
+
+        # Per direction a dict of node -> (parent node, hops from the start).
+        visited = ({source: (None, 0)}, {target: (None, 0)})
+        frontiers = [[source], [target]]
+        # Every degree is two hops in the bipartite graph.
+        max_hops = 2 * max_degrees if max_degrees is not None else None
+        expanded = 0
+        while frontiers[0] and frontiers[1]:
+            if max_hops is not None and expanded >= max_hops:
+                # Both directions met nowhere within max_hops hops in total.
+                return None
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = visited[side], visited[1 - side]
+            meetings = []
+            next_frontier = []
+            for node in frontiers[side]:
+                hops = seen[node][1] + 1
+                for neighbour in self._neighbours(node):
+                    if neighbour in seen:
+                        continue
+                    seen[neighbour] = (node, hops)
+                    if neighbour in other:
+                        meetings.append(neighbour)
+                    next_frontier.append(neighbour)
+            expanded += 1
+            if meetings:
+                # All meetings share the hops on this side, the other side may differ.
+                meeting = min(meetings, key=lambda n: other[n][1])
+                return self._join(meeting, visited)
+            frontiers[side] = next_frontier
+        return None
+
+    def _join(self, meeting, visited):
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = visited[0][node][0]
+        path.reverse()
+        node = visited[1][meeting][0]
+        while node is not None:
+            path.append(node)
+            node = visited[1][node][0]
+        return [self._model_id(n) for n in path]
+
+    def close(self):
+        """Releases the snapshot file the graph was loaded from."""
+        if self.snapshot is not None:
+            self.people = self.titles = self.person_offsets = self.person_titles = \
+                self.title_offsets = self.title_people = None
+            self.snapshot.close()
+            self.snapshot = None
+
+
+def _csr(pairs, count):
+    """Returns the offsets and targets for *pairs* of (row, target) sorted by row."""
+    offsets = array('i', [0]) * (count + 1)
+    for row, _ in pairs:
+        offsets[row + 1] += 1
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+    return offsets, array('i', [target for _, target in pairs])
+
+def _byteorder():
+    return b'LE  ' if sys.byteorder == 'little' else b'BE  '
@@ -0,0 +1,263 @@
+"""
+Counters and timings of the fetch, parse and database layers.
+
+Instrumentation is off until *enable()* is called; until then every recording function
+returns right away, so the hooks in the hot paths cost a global lookup. Recorded figures
+are kept in a *Registry* and read by sinks: a periodic summary on stderr, a JSON lines
+file and a Prometheus style text endpoint.
+
+    registry = metrics.enable()
+    with metrics.timer('parse_seconds', field='title'):
+        ...
+    metrics.incr('fetch_bytes', len(body))
+"""
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Registry(object):
+    """
+    Holds counters and timers keyed by name and labels. A timer keeps the amount of
+    observations, their sum and their maximum.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.started = time.time()
+
+    def incr(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, value, value]
+            else:
+                timer[0] += 1
+                timer[1] += value
+                timer[2] = max(timer[2], value)
+
+    def snapshot(self):
+        """Returns the current figures as a dict which can be serialized to JSON."""
+        with self.lock:
+            counters = [dict(name=name, labels=dict(labels), value=value)
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = [dict(name=name, labels=dict(labels), count=t[0], sum=t[1], max=t[2])
+                      for (name, labels), t in sorted(self.timers.items())]
+        return {'time': time.time(), 'uptime': time.time() - self.started,
+                'counters': counters, 'timers': timers}
+
+    def summary(self):
+        """Returns the current figures as human readable lines."""
+        lines = []
+        snapshot = self.snapshot()
+        for counter in snapshot['counters']:
+            lines.append('{:<40} {:>12}'.format(_label_name(counter), counter['value']))
+        for timer in snapshot['timers']:
+            lines.append('{:<40} {:>12} avg={:.2f}ms max={:.2f}ms total={:.2f}s'.format(
+                _label_name(timer), timer['count'], timer['sum'] / timer['count'] * 1000,
+                timer['max'] * 1000, timer['sum']))
+        return '\n'.join(lines)
+
+    def prometheus(self, prefix='imdbooo_'):
+        """Returns the current figures in the Prometheus text exposition format."""
+        lines = []
+        snapshot = self.snapshot()
+        typed = set()
+        for counter in snapshot['counters']:
+            name = prefix + counter['name'] + '_total'
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, _prometheus_labels(counter['labels']),
+                                          counter['value']))
+        for timer in snapshot['timers']:
+            name = prefix + timer['name']
+            labels = _prometheus_labels(timer['labels'])
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} summary'.format(name))
+            lines.append('{}_count{} {}'.format(name, labels, timer['count']))
+            lines.append('{}_sum{} {!r}'.format(name, labels, timer['sum']))
+            lines.append('{}_max{} {!r}'.format(name, labels, timer['max']))
+        return '\n'.join(lines) + '\n'
+
+
+def _label_name(figure):
+    labels = ','.join('{}={}'.format(k, v) for k, v in sorted(figure['labels'].items()))
+    return '{}{{{}}}'.format(figure['name'], labels) if labels else figure['name']
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+#
+# Recording
+#
+
+_registry = None
+
+def enable():
+    """Turns instrumentation on and returns the registry the figures are recorded in."""
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+def disable():
+    global _registry
+    _registry = None
+
+def get_registry():
+    """Returns the active *Registry* or None when instrumentation is off."""
+    return _registry
+
+def incr(name, value=1, **labels):
+    """Adds *value* to the counter *name*."""
+    if _registry is not None:
+        _registry.incr(name, value, tuple(sorted(labels.items())))
+
+def observe(name, seconds, **labels):
+    """Records a duration of *seconds* for the timer *name*."""
+    if _registry is not None:
+        _registry.observe(name, seconds, tuple(sorted(labels.items())))
+
+@contextmanager
+def timer(name, **labels):
+    """Times the enclosed block, whether it finishes or raises."""
+    if _registry is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _registry.observe(name, time.time() - start, tuple(sorted(labels.items())))
+
+def record_transfer(c, cached=False):
+    """Records the phases and the size of the finished transfer of the curl handle *c*."""
+    if _registry is None:
+        return
+    if cached:
+        incr('fetch_requests', status='cached')
+        return
+    status = c.getinfo(c.RESPONSE_CODE)
+    incr('fetch_requests', status=status)
+    incr('fetch_bytes', c.getinfo(c.SIZE_DOWNLOAD_T))
+    # The curl times are cumulative from the start of the transfer.
+    dns = c.getinfo(c.NAMELOOKUP_TIME)
+    connect = c.getinfo(c.CONNECT_TIME)
+    ttfb = c.getinfo(c.STARTTRANSFER_TIME)
+    total = c.getinfo(c.TOTAL_TIME)
+    observe('fetch_dns_seconds', dns)
+    observe('fetch_connect_seconds', max(connect - dns, 0.0))
+    observe('fetch_ttfb_seconds', max(ttfb - connect, 0.0))
+    observe('fetch_transfer_seconds', max(total - ttfb, 0.0))
+    observe('fetch_total_seconds', total)
+
+#
+# Sinks
+#
+
+class PeriodicSink(object):
+    """Calls *emit* every *interval* seconds and once more on *close*. Sinks override
+    *emit* to report the figures of *registry*."""
+
+    def __init__(self, registry, interval=10.0):
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.emit()
+
+    def emit(self):
+        """Reports the figures; does nothing here."""
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.emit()
+
+
+class StderrSink(PeriodicSink):
+    """Writes a summary of all figures to *stream*, stderr by default."""
+
+    def __init__(self, registry, interval=10.0, stream=None):
+        self.stream = stream or sys.stderr
+        PeriodicSink.__init__(self, registry, interval)
+
+    def emit(self):
+        summary = self.registry.summary()
+        if summary:
+            self.stream.write(summary + '\n')
+            self.stream.flush()
+
+
+class JSONLinesSink(PeriodicSink):
+    """Appends a snapshot of all figures as one JSON line to the file at *path*."""
+
+    def __init__(self, registry, path, interval=10.0):
+        self.path = path
+        PeriodicSink.__init__(self, registry, interval)
+
+    def emit(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.registry.snapshot()) + '\n')
+
+
+class _PrometheusHandler(object):
+    """The request handling of *PrometheusSink*, mixed into *BaseHTTPRequestHandler* when a
+    sink is created so the http.server import is only paid for when the figures are served."""
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PrometheusSink(object):
+    """Serves the figures at http://*host*:*port*/metrics for a Prometheus scraper. Port 0
+    picks a free port, see *url*."""
+
+    def __init__(self, registry, port=9108, host='127.0.0.1'):
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        handler = type('PrometheusHandler', (_PrometheusHandler, BaseHTTPRequestHandler), {})
+        self.httpd = HTTPServer((host, port), handler)
+        self.httpd.registry = registry
+        self.url = 'http://{}:{}/metrics'.format(host, self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
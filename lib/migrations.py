@@ -0,0 +1,118 @@
+"""
+Versioned schema migrations.
+
+Every migration has a version number and a function which gets a connection inside the
+transaction the migration runs in. Applied versions are recorded in *tbl_schema_version*,
+so an up to date database costs a single query when the engine is created. Databases which
+predate the version table get the initial migration, which only creates missing tables.
+
+New migrations are appended to *migrations* with the next version number and never change
+once released.
+"""
+import time
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, Float, String, select
+
+from lib.models import Base, Movie, TVShow, Person, SearchResult, complete_edges, \
+    genre_movie, genre_tvshow
+
+# Kept out of the models' metadata so dumps and create_all never touch it.
+version_metadata = MetaData()
+version_table = Table('tbl_schema_version', version_metadata,
+                      Column('version', Integer, primary_key=True),
+                      Column('description', String),
+                      Column('applied_at', Float))
+
+def _initial_schema(connection):
+    Base.metadata.create_all(connection)
+
+def _fetch_tracking(connection):
+    """Adds *fetched_at* and *content_hash* to the model tables. Databases created since the
+    columns exist got them from the initial migration already."""
+    inspector = sqlalchemy.inspect(connection)
+    for table in (Movie.__table__, TVShow.__table__, Person.__table__):
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for name in ('fetched_at', 'content_hash'):
+            if name not in columns:
+                connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, name, table.c[name].type.compile(connection.dialect)))
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+def _complete_edges(connection):
+    complete_edges.create(connection, checkfirst=True)
+
+def _search_result_age(connection):
+    """Adds *fetched_at* to the search result sets. Sets stored before have none and count
+    as expired."""
+    table = SearchResult.__table__
+    table.create(connection, checkfirst=True)
+    columns = set(c['name'] for c in sqlalchemy.inspect(connection).get_columns(table.name))
+    if 'fetched_at' not in columns:
+        connection.execute('ALTER TABLE {} ADD COLUMN fetched_at {}'.format(
+            table.name, table.c.fetched_at.type.compile(connection.dialect)))
+
+def _integer_genre_ids(connection):
+    """Makes *genre_id* of the genre link tables an Integer like the *tbl_genre.id* it
+    references; PostgreSQL refuses a foreign key between a VARCHAR and an INTEGER column.
+    SQLite can't change the type of a column, the tables are copied there."""
+    inspector = sqlalchemy.inspect(connection)
+    tables = inspector.get_table_names()
+    for table in (genre_movie, genre_tvshow):
+        if table.name not in tables:
+            table.create(connection)
+            continue
+        column = [c for c in inspector.get_columns(table.name) if c['name'] == 'genre_id'][0]
+        if isinstance(column['type'], sqlalchemy.Integer):
+            continue
+        if connection.dialect.name != 'sqlite':
+            connection.execute('ALTER TABLE {0} ALTER COLUMN genre_id TYPE INTEGER '
+                               'USING CAST(genre_id AS INTEGER)'.format(table.name))
+            continue
+        title_column = list(table.c)[1].name
+        connection.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table.name))
+        table.create(connection)
+        connection.execute('INSERT INTO {0} (genre_id, {1}) SELECT CAST(genre_id AS INTEGER), '
+                           '{1} FROM {0}_old'.format(table.name, title_column))
+        connection.execute('DROP TABLE {}_old'.format(table.name))
+
+migrations = [
+    (1, 'Initial schema', _initial_schema),
+    (2, 'Track when and from which page a model was fetched', _fetch_tracking),
+    (3, 'Record the models whose edges are complete', _complete_edges),
+    (4, 'Track when a search result set was fetched', _search_result_age),
+    (5, 'Make the genre links reference the integer genre ids', _integer_genre_ids),
+]
+
+def applied_versions(connection):
+    """Returns the set of migration versions applied to the database of *connection*."""
+    return set(row[0] for row in connection.execute(select([version_table.c.version])))
+
+def migrate(engine, attempts=5):
+    """
+    Applies the pending migrations to the database of *engine*, each in its own
+    transaction, and returns the versions it applied. Processes starting at the same time
+    may race for the same migration; the loser rolls back, sees the migration applied and
+    moves on.
+    """
+    applied = []
+    for attempt in range(attempts):
+        try:
+            version_table.create(engine, checkfirst=True)
+            for version, description, apply in migrations:
+                with engine.begin() as connection:
+                    if version in applied_versions(connection):
+                        continue
+                    apply(connection)
+                    connection.execute(version_table.insert(), version=version,
+                                       description=description, applied_at=time.time())
+                applied.append(version)
+            return applied
+        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.IntegrityError,
+                sqlalchemy.exc.ProgrammingError):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
@@ -35,6 +35,8 @@ class Movie(Base):
     plot = Column(String)
     duration = Column(String)
     release_year = Column(Integer)
+    fetched_at = Column(Float, index=True)
+    content_hash = Column(String(40))
 
     genres = relationship('Genre', secondary='tbl_genre_movie')
     actors = relationship('Person', secondary='tbl_actor_movie', lazy='dynamic',
@@ -60,6 +62,8 @@ class TVShow(Base):
     rating = Column(Float)
     plot = Column(String(2000))
     release_year = Column(Integer)
+    fetched_at = Column(Float, index=True)
+    content_hash = Column(String(40))
 
     genres = relationship('Genre', secondary='tbl_genre_tvshow')
     actors = relationship('Person', secondary='tbl_actor_tvshow',
@@ -82,6 +86,8 @@ class Person(Base):
     middlename = Column(String(256))
     lastname = Column(String(256))
     birthday = Column(Date)
+    fetched_at = Column(Float, index=True)
+    content_hash = Column(String(40))
 
     def __init__(self, id, firstname, lastname=None, birthday=None, middlename=None):
         self.id = id
@@ -94,20 +100,23 @@ class SearchResult(Base):
 
     __tablename__ = 'tbl_search_result'
     query = Column(String, primary_key=True)
+    # When the result set was fetched, to expire it after *constants.search_cache_ttl*.
+    fetched_at = Column(Float)
 
     people = relationship('Person', secondary='tbl_result_person', lazy='dynamic')
     tvshows = relationship('TVShow', secondary='tbl_result_tvshow', lazy='dynamic')
     movies = relationship('Movie', secondary='tbl_result_movie', lazy='dynamic')
 
-    def __init__(self, query):
+    def __init__(self, query, fetched_at=None):
         self.query = query
+        self.fetched_at = fetched_at
 
 
 genre_movie = Table('tbl_genre_movie', Base.metadata,
-                    Column('genre_id', String, ForeignKey('tbl_genre.id'), primary_key=True),
+                    Column('genre_id', Integer, ForeignKey('tbl_genre.id'), primary_key=True),
                     Column('movie_id', String, ForeignKey('tbl_movie.id'), primary_key=True))
 genre_tvshow = Table('tbl_genre_tvshow', Base.metadata,
-                     Column('genre_id', String, ForeignKey('tbl_genre.id'), primary_key=True),
+                     Column('genre_id', Integer, ForeignKey('tbl_genre.id'), primary_key=True),
                      Column('tvshow_id', String, ForeignKey('tbl_tvshow.id'), primary_key=True))
 
 actor_movie = Table('tbl_actor_movie', Base.metadata,
@@ -126,3 +135,8 @@ result_movie = Table('tbl_result_movie', Base.metadata,
 result_person = Table('tbl_result_person', Base.metadata,
                       Column('query', String, ForeignKey('tbl_search_result.query'), primary_key=True),
                       Column('person_id', String, ForeignKey('tbl_person.id'), primary_key=True))
+
+# Titles whose whole cast and people whose whole filmography are stored as edges.
+complete_edges = Table('tbl_complete_edges', Base.metadata,
+                       Column('model_id', String, primary_key=True),
+                       Column('completed_at', Float))
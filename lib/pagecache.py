@@ -0,0 +1,250 @@
+"""
+A compressed on-disk cache for fetched pages.
+
+Every URL has a small JSON metadata file which points to a zlib compressed body blob named
+after the SHA-1 of its content, identical pages are therefore stored once. Entries older
+than the TTL are revalidated with a conditional GET when the server sent an ETag or a
+Last-Modified header. Once the blobs exceed the size limit the least recently used entries
+are evicted.
+"""
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+
+from lib import constants
+
+class HeaderCollector(object):
+    """A curl HEADERFUNCTION which keeps the validators of the final response."""
+
+    def __init__(self):
+        self.headers = {}
+
+    def __call__(self, line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            # A new response starts, e.g. after following a redirect.
+            self.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+
+class PageCache(object):
+    """
+    Caches page bodies below *directory*. Entries are fresh for *ttl* seconds and the
+    compressed bodies take up at most *max_bytes*. An *offline* cache never lets a request
+    through; misses are answered with an empty body.
+    """
+
+    def __init__(self, directory, ttl=None, max_bytes=None, offline=False):
+        self.directory = directory
+        self.ttl = ttl if ttl is not None else constants.page_cache_ttl
+        self.max_bytes = max_bytes if max_bytes is not None else constants.page_cache_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stored': 0, 'evicted': 0,
+                      'bytes_saved': 0}
+
+    def _meta_path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'meta', digest[:2], digest + '.json')
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest + '.z')
+
+    def _write(self, path, data):
+        """Writes *data* to *path* atomically so readers never see a partial file."""
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def get(self, url):
+        """Returns the metadata of the cached *url* or None."""
+        try:
+            with open(self._meta_path(url)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read(self, entry):
+        """Returns the raw body of a cached *entry*."""
+        with open(self._blob_path(entry['content']), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def drop(self, url):
+        """Removes the metadata of the cached *url*. Its blob goes with the next eviction."""
+        try:
+            os.remove(self._meta_path(url))
+        except OSError:
+            pass
+
+    def entries(self):
+        """Yields the metadata of every cached page."""
+        for root, _, filenames in os.walk(os.path.join(self.directory, 'meta')):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(root, filename)) as f:
+                        yield json.load(f)
+                except (IOError, OSError, ValueError):
+                    continue
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, url, body, headers=None):
+        """Stores the raw *body* of *url* along with its response *headers*."""
+        headers = headers or {}
+        digest = hashlib.sha1(body).hexdigest()
+        blob_path = self._blob_path(digest)
+        blob = None if os.path.exists(blob_path) else zlib.compress(body)
+        entry = {'url': url, 'content': digest, 'size': len(body), 'fetched_at': time.time(),
+                 'etag': headers.get('etag'), 'last_modified': headers.get('last-modified')}
+        added = 0
+        # Blob and metadata are written together so eviction never sees an unreferenced blob.
+        with self.lock:
+            if blob is not None:
+                self._write(blob_path, blob)
+                added = len(blob)
+            self._write(self._meta_path(url), json.dumps(entry).encode('utf-8'))
+            self.stats['stored'] += 1
+            if self.total_bytes is not None:
+                self.total_bytes += added
+        if self._size() > self.max_bytes:
+            self.evict()
+        return entry
+
+    def _size(self):
+        if self.total_bytes is None:
+            total = 0
+            for root, _, filenames in os.walk(os.path.join(self.directory, 'blobs')):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in filenames)
+            self.total_bytes = total
+        return self.total_bytes
+
+    def evict(self):
+        """Removes the least recently used entries until the blobs fit into *max_bytes*."""
+        self._size()
+        with self.lock:
+            metas = []
+            for root, _, filenames in os.walk(os.path.join(self.directory, 'meta')):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    try:
+                        with open(path) as f:
+                            metas.append((os.path.getmtime(path), path, json.load(f)['content']))
+                    except (IOError, OSError, ValueError):
+                        continue
+            metas.sort()
+            references = {}
+            for _, _, digest in metas:
+                references[digest] = references.get(digest, 0) + 1
+
+            # Blobs of pages which changed since they were stored go first.
+            for root, _, filenames in os.walk(os.path.join(self.directory, 'blobs')):
+                for filename in filenames:
+                    if filename[:-len('.z')] not in references and filename.endswith('.z'):
+                        path = os.path.join(root, filename)
+                        self.total_bytes -= os.path.getsize(path)
+                        os.remove(path)
+
+            for _, path, digest in metas:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                os.remove(path)
+                self.stats['evicted'] += 1
+                references[digest] -= 1
+                if not references[digest]:
+                    blob_path = self._blob_path(digest)
+                    self.total_bytes -= os.path.getsize(blob_path)
+                    os.remove(blob_path)
+
+    def before_fetch(self, url):
+        """
+        Looks *url* up before a request is made. Returns a tuple of the cached raw body,
+        which is None when the request has to be made, the extra request headers and the
+        cache entry to pass on to *after_fetch*.
+        """
+        entry = self.get(url)
+        if entry is not None and (self.offline or self.is_fresh(entry)):
+            try:
+                body = self.read(entry)
+            except (IOError, OSError, zlib.error):
+                entry = None
+            else:
+                try:
+                    os.utime(self._meta_path(url), None)
+                except OSError:
+                    # Evicted by another process since; the body is still good.
+                    pass
+                with self.lock:
+                    self.stats['hits'] += 1
+                    self.stats['bytes_saved'] += len(body)
+                return body, [], entry
+
+        with self.lock:
+            self.stats['misses'] += 1
+        if self.offline:
+            return b'', [], None
+
+        headers = []
+        if entry is not None:
+            if entry.get('etag'):
+                headers.append('If-None-Match: ' + entry['etag'])
+            if entry.get('last_modified'):
+                headers.append('If-Modified-Since: ' + entry['last_modified'])
+        return None, headers, entry
+
+    def after_fetch(self, url, entry, status, body, headers):
+        """
+        Stores a successful response and resolves a *304 Not Modified* to the cached body.
+        Returns the raw body to use, None when the cached body is gone by now; the entry is
+        dropped then, so the page is requested again without validators.
+        """
+        if status == 304 and entry is not None:
+            try:
+                body = self.read(entry)
+            except (IOError, OSError, zlib.error):
+                # Evicted by another process during the request.
+                self.drop(url)
+                return None
+            entry['fetched_at'] = time.time()
+            self._write(self._meta_path(url), json.dumps(entry).encode('utf-8'))
+            with self.lock:
+                self.stats['revalidated'] += 1
+                self.stats['bytes_saved'] += len(body)
+        elif status == 200:
+            self.put(url, body, headers)
+        return body
+
+    def summary(self):
+        return ('page cache: {hits} hits, {misses} misses, {revalidated} revalidated, '
+                '{stored} stored, {evicted} evicted, {bytes_saved} bytes saved'
+                .format(**self.stats))
+
+_cache = None
+
+def configure(directory=None, ttl=None, max_bytes=None, offline=False):
+    """Enables the page cache used by *process_url* and the *Fetcher* and returns it."""
+    global _cache
+    _cache = PageCache(directory or constants.page_cache_dir, ttl, max_bytes, offline)
+    return _cache
+
+def disable():
+    global _cache
+    _cache = None
+
+def get_cache():
+    """Returns the configured *PageCache* or None when caching is disabled."""
+    return _cache
@@ -1,16 +1,35 @@
 import re
+import time
 import datetime
+from contextlib import contextmanager
 
-from bs4 import BeautifulSoup
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+from lib import metrics
+
+id_re = re.compile(r'pageId.+?[\"\']((?:tt|nm)\w+)[\"\']')
+model_id_re = re.compile(r'/((?:tt|nm)\d+)')
+type_re = re.compile(r'og:type.+?[\"\'].*?(actor|tv_show|movie)[\"\']')
+title_re = re.compile(r'og:title.+?[\"\'](.+?)\s+?\(.+?[\"\']')
+poster_re = re.compile(r'og:image.+?[\"\'](http.+?)[\"\']')
+rating_re = re.compile(r'(\d+\.\d*)<.+?\/\d+')
+duration_re = re.compile(r'datetime=.+?\s+([\d\s\w]+?)\n', re.DOTALL)
+plot_re = re.compile(r'plot-description[\'\"]>\s+(.+?)(?:\.{3}\s?<a href.+?)?<\/p>', re.DOTALL)
+year_re = re.compile(r'sub-header[\"\']>\s+\((\d+).+?\)', re.DOTALL)
+genre_re = re.compile(r'itemprop=[\'\"]genre[\'\"]>([\w\-]+?)<')
+fullname_re = re.compile(r'og:title.+?[\"\'](.+?)[\"\']\s')
+birthday_re = re.compile(r'time datetime=[\'\"](\d{4}\-\d{1,2}\-\d{1,2})[\'\"]')
+roles_re = re.compile(r'id=[\'\"]actor-(tt\d+)[\"\']')
 
 def model_id(source):
     """Extracts the identifier from the passed model *source*."""
-    id_re = re.compile('pageId.+?[\"\']((?:tt|nm)\w+)[\"\']')
     return id_re.search(source).group(1)
 
 def model_ids(source):
     """Returns a set of model identifiers found in the passed *source*."""
-    model_id_re = re.compile('/((?:tt|nm)\d+)')
     return set(model_id_re.findall(source))
 
 def model_type(source):
@@ -22,89 +41,248 @@ def model_type(source):
         - movie
         - actor
     """
-    type_re = re.compile('og:type.+?[\"\'].*?(actor|tv_show|movie)[\"\']')
     return type_re.search(source).group(1)
 
-def title(source):
-    """Extracts the title from the passed *source*."""
-    title_re = re.compile('og:title.+?[\"\'](.+?)\s+?\(.+?[\"\']')
-    match = title_re.search(source).group(1)
+def _clean_title(match):
     if 'TV Series ' in match:
         match = match.replace('TV Series ', '')
     return match
 
+def title(source):
+    """Extracts the title from the passed *source*."""
+    return _clean_title(title_re.search(source).group(1))
+
 def poster(source):
     """Extracts the absolute URL to the poster from the passed *source*."""
-    poster_re = re.compile('og:image.+?[\"\'](http.+?)[\"\']')
     return poster_re.search(source).group(1)
 
 def rating(source):
     """Extracts the rating from the passed *source*."""
-    rating_re = re.compile('(\d+\.\d*)<.+?\/\d+')
     return float(rating_re.search(source).group(1))
 
 def duration(source):
     """Extracts the duration (playtime) from the passed *source*."""
-    duration_re = re.compile('datetime=.+?\s+([\d\s\w]+?)\n', re.DOTALL)
     return duration_re.search(source).group(1)
 
 def plot(source):
     """Extracts the plot from the passed *source*."""
-    plot_re = re.compile('plot-description[\'\"]>\s+(.+?)(?:\.{3}\s?<a href.+?)?<\/p>',
-                         re.DOTALL)
     return plot_re.search(source).group(1).strip()
 
 def release_year(source):
     """Extracts the release year from the passed *source*."""
-    year_re = re.compile('sub-header[\"\']>\s+\((\d+).+?\)', re.DOTALL)
     return int(year_re.search(source).group(1))
 
-def genres(source, db_uri=None):
-    """Extracts a list of genres from the passed *source*."""
-    from . import constants
-    from .database import get_db
-    from .models import Genre
+def genres(source):
+    """Extracts a list of genre names from the passed *source*."""
+    return genre_re.findall(source)
+
+#
+# Single pass extraction
+#
+
+def _search(pattern, source, pos, field):
+    """
+    Searches *pattern* from *pos* onwards and falls back to the whole *source* for pages
+    which don't follow the usual field order. Raises AttributeError when nothing matches.
+    """
+    match = pattern.search(source, pos)
+    if match is None and pos:
+        match = pattern.search(source)
+    if match is None:
+        raise AttributeError('No match for the {} field'.format(field))
+    return match
+
+def _timed_search(pattern, source, pos, field):
+    """*_search* which records its duration and failures per field."""
+    start = time.time()
+    try:
+        return _search(pattern, source, pos, field)
+    except AttributeError:
+        metrics.incr('parse_failures', field=field)
+        raise
+    finally:
+        metrics.observe('parse_field_seconds', time.time() - start, field=field)
 
-    genre_re = re.compile('itemprop=[\'\"]genre[\'\"]>([\w\-]+?)<')
-    genre_strings = genre_re.findall(source)
-    db_session = get_db(db_uri or constants.database_uri)
+def _search_in_order(pattern, source, pos, field):
+    """*_search* without the fallback, for pages of which only the beginning is known."""
+    match = pattern.search(source, pos)
+    if match is None:
+        raise AttributeError('No match for the {} field'.format(field))
+    return match
+
+def extract(source):
+    """
+    Extracts all fields of a title or person page in a single walk over the passed *source*
+    and returns them in a dict. The fields appear in a fixed order on the page, so every
+    field is searched from where the previous one starts and the walk stops after the last
+    field we need. An AttributeError is raised when a required field is missing.
+
+    Titles have the keys model_type, id, title, poster, rating, duration, plot,
+    release_year and genres. People have model_type, id, firstname, middlename, lastname
+    and birthday.
+    """
+    search = _search if metrics.get_registry() is None else _timed_search
+    return _extract(source, search)[0]
 
-    genre_objects = []
-    for genre_string in genre_strings:
-        genre = db_session.query(Genre).filter_by(name=genre_string).first()
-        if not genre:
-            genre = Genre(genre_string)
-            db_session.add(genre)
-            db_session.commit()
-            db_session = get_db(db_uri)
+def extract_prefix(source):
+    """
+    Extracts the fields from the beginning of a title or person page, e.g. while the rest
+    is still being received. Returns a tuple of the record and the offset where the last
+    field ends, so that *extract* gives the same record for *source* cut at that offset.
+    Returns None while fields are missing; fields are only searched for in page order and
+    people need a birthday, as it may still be coming.
+    """
+    try:
+        return _extract(source, _search_in_order, partial=True)
+    except AttributeError:
+        return None
 
-    return genre_objects
+@contextmanager
+def _untimed(name, **labels):
+    yield
+
+def _extract(source, search, partial=False):
+    """Returns the record of *extract* and the offset where its last field ends. Prefixes
+    are checked over and over while a page arrives and stay out of the field timings."""
+    timer = _untimed if partial else metrics.timer
+    id_match = search(id_re, source, 0, 'id')
+    type_match = search(type_re, source, id_match.start(), 'model_type')
+    record = {'model_type': type_match.group(1), 'id': id_match.group(1)}
+
+    if record['model_type'] == 'actor':
+        fullname_match = search(fullname_re, source, type_match.start(), 'fullname')
+        record['firstname'], record['middlename'], record['lastname'] = \
+            _split_fullname(fullname_match.group(1))
+        with timer('parse_field_seconds', field='birthday'):
+            birthday_match = birthday_re.search(source, fullname_match.start())
+            if birthday_match is None and partial:
+                raise AttributeError('No match for the birthday field')
+            if birthday_match is None:
+                birthday_match = birthday_re.search(source)
+        record['birthday'] = _birthday(birthday_match)
+        return record, _end(id_match, type_match, fullname_match, birthday_match)
+
+    poster_match = search(poster_re, source, id_match.start(), 'poster')
+    record['poster'] = poster_match.group(1)
+    title_match = search(title_re, source, type_match.start(), 'title')
+    record['title'] = _clean_title(title_match.group(1))
+    year_match = search(year_re, source, title_match.start(), 'release_year')
+    record['release_year'] = int(year_match.group(1))
+    last_match = year_match
+    record['duration'] = None
+    if record['model_type'] == 'movie':
+        last_match = search(duration_re, source, year_match.start(), 'duration')
+        record['duration'] = last_match.group(1)
+    plot_match = search(plot_re, source, last_match.start(), 'plot')
+    record['plot'] = plot_match.group(1).strip()
+    # The genres are listed between the sub header and the plot.
+    with timer('parse_field_seconds', field='genres'):
+        record['genres'] = genre_re.findall(source, last_match.start(), plot_match.start())
+    rating_match = search(rating_re, source, plot_match.start(), 'rating')
+    record['rating'] = float(rating_match.group(1))
+    return record, _end(id_match, type_match, poster_match, title_match, year_match,
+                        last_match, plot_match, rating_match)
+
+def _end(*matches):
+    return max(match.end() for match in matches if match is not None)
 
 #
 # Credits page related patterns
 #
 
-def cast(source):
+# Elements without an end tag; they must not count towards the nesting depth.
+void_elements = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+                           'meta', 'param', 'source', 'track', 'wbr'))
+person_href_re = re.compile(r'/name/(nm\d+)')
+
+
+class CreditsParser(HTMLParser):
     """
-    Extracts the credits from a movie or tvshow and returns a list of tuples.
-    The tuple consists of two elements: name and id.
+    Collects the credits inside the element with the id *fullcredits-content* from the
+    parser events without building a document tree. Every person is recorded once, in the
+    order of their first link, together with the text of the first element with a
+    *character* class that follows it.
     """
-    soup = BeautifulSoup(source, 'html.parser')
-    return [a.get('href').split('/', 3)[2] for a in soup.find(id='fullcredits-content').find_all('a')]
 
-#
-# Below be h00mans
-#
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.credits = []
+        self.seen = set()
+        self.depth = 0
+        self.done = False
+        self.character_depth = None
+        self.character = []
 
-def fullname(source):
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if not self.depth:
+            if attrs.get('id') == 'fullcredits-content':
+                self.depth = 1
+            return
+        if tag not in void_elements:
+            self.depth += 1
+
+        href = attrs.get('href')
+        match = person_href_re.search(href) if href else None
+        if match and match.group(1) not in self.seen:
+            self._end_character()
+            self.seen.add(match.group(1))
+            self.credits.append([len(self.credits) + 1, match.group(1), None])
+        elif (self.character_depth is None and self.credits and
+              self.credits[-1][2] is None and 'character' in (attrs.get('class') or '')):
+            self.character_depth = self.depth
+
+    def handle_endtag(self, tag):
+        if not self.depth or self.done or tag in void_elements:
+            return
+        if self.character_depth == self.depth:
+            self._end_character()
+        self.depth -= 1
+        if not self.depth:
+            self.done = True
+
+    def handle_data(self, data):
+        if self.character_depth is not None:
+            self.character.append(data)
+
+    def _end_character(self):
+        if self.character_depth is not None:
+            self.credits[-1][2] = ' '.join(''.join(self.character).split()) or None
+            self.character_depth = None
+            self.character = []
+
+
+def credits(source, chunk_size=65536):
     """
-    Extracts the first-, middle- and last name of a person. This function returns a tuple of
-    three fields containing the individuals first, middle and last name.
+    Extracts the credits from the full credits page of a movie or tvshow and returns a list
+    of (billing, person id, character) tuples in billing order. The character is None when
+    the page doesn't name it. Parsing starts at the credits section and stops at its end.
+    """
+    start = source.find('fullcredits-content')
+    if start == -1:
+        return []
+    credits_parser = CreditsParser()
+    pos = source.rfind('<', 0, start)
+    while pos < len(source) and not credits_parser.done:
+        credits_parser.feed(source[pos:pos + chunk_size])
+        pos += chunk_size
+    credits_parser._end_character()
+    return [tuple(credit) for credit in credits_parser.credits]
+
+def cast(source):
     """
+    Extracts the credits from a movie or tvshow and returns a list with the identifiers of
+    the people in billing order.
+    """
+    return [person_id for _, person_id, _ in credits(source)]
 
-    fullname_re = re.compile('og:title.+?[\"\'](.+?)[\"\']\s')
-    fullname = fullname_re.search(source).group(1)
+#
+# Below be h00mans
+#
 
+def _split_fullname(fullname):
     groups = fullname.split(' ', 2)
     firstname = None
     middlename = None
@@ -121,10 +299,14 @@ def fullname(source):
 
     return firstname, middlename, lastname
 
-def birthday(source):
-    """Extracts the birthday date of a person. Returns a datetime.date object."""
-    birthday_re = re.compile('time datetime=[\'\"](\d{4}\-\d{1,2}\-\d{1,2})[\'\"]')
-    birthday_match = birthday_re.search(source)
+def fullname(source):
+    """
+    Extracts the first-, middle- and last name of a person. This function returns a tuple of
+    three fields containing the individuals first, middle and last name.
+    """
+    return _split_fullname(fullname_re.search(source).group(1))
+
+def _birthday(birthday_match):
     if not birthday_match:
         return None
     year, month, day = birthday_match.group(1).split('-', 3)
@@ -139,7 +321,10 @@ def birthday(source):
 
     return datetime.date(year=int(year), month=int(month), day=int(day))
 
+def birthday(source):
+    """Extracts the birthday date of a person. Returns a datetime.date object."""
+    return _birthday(birthday_re.search(source))
+
 def roles(source):
     """Extracts a persons' movies or tv shows he or she played a part in as an actor."""
-    roles = re.compile(r'id=[\'\"]actor-(tt\d+)[\"\']')
-    return roles.findall(source)
+    return roles_re.findall(source)
@@ -0,0 +1,230 @@
+"""
+An asyncio based indexing pipeline. Pages flow through three stages which run
+concurrently, each with its own amount of workers:
+
+    fetch -> parse -> persist
+
+The parse and persist queues are bounded, a slow stage therefore blocks the stage feeding
+it instead of piling up page sources or models in memory. The fetch queue only holds URLs
+and is fed back into by the persist stage (cast and role expansion), it is unbounded so that
+feedback can never deadlock the pipeline.
+
+This module requires Python 3.5 or newer.
+"""
+import sys
+import time
+import asyncio
+
+from lib import constants, factory, metrics, parser
+from lib.crawl import process_url, model_url
+from lib.database import (
+    get_cached_model,
+    get_cached_models,
+    store_model,
+    store_cast_member
+)
+from lib.models import Movie, TVShow, Person
+
+
+class StageStats(object):
+    """Collects latency and queue depth figures for a single pipeline stage."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.max_latency = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.max_depth = 0
+
+    def sample_depth(self, depth):
+        self.depth_total += depth
+        self.depth_samples += 1
+        self.max_depth = max(self.max_depth, depth)
+
+    def record(self, latency, failed=False):
+        self.processed += 1
+        self.failed += int(failed)
+        self.busy_time += latency
+        self.max_latency = max(self.max_latency, latency)
+        metrics.observe('stage_seconds', latency, stage=self.name)
+        if failed:
+            metrics.incr('stage_failures', stage=self.name)
+
+    def summary(self):
+        mean_latency = self.busy_time / self.processed if self.processed else 0.0
+        mean_depth = float(self.depth_total) / self.depth_samples if self.depth_samples else 0.0
+        return ('{:<8} workers={:<3} items={:<6} failed={:<5} latency avg={:.1f}ms '
+                'max={:.1f}ms queue avg={:.1f} max={}'
+                .format(self.name, self.workers, self.processed, self.failed,
+                        mean_latency * 1000, self.max_latency * 1000, mean_depth,
+                        self.max_depth))
+
+
+class Pipeline(object):
+    """
+    Indexes models with concurrent fetch, parse and persist stages. Every model found on
+    the seed page is passed to *on_model* and expanded by its cast (titles) or roles (people)
+    unless *with_cast* or *with_roles* are False.
+    """
+
+    def __init__(self, on_model=None, with_cast=True, with_roles=True, fetch_workers=8,
+                 parse_workers=2, persist_workers=1, queue_size=32, db_uri=None):
+        self.on_model = on_model
+        self.with_cast = with_cast
+        self.with_roles = with_roles
+        self.queue_size = queue_size
+        self.db_uri = db_uri
+        self.stats = {'fetch': StageStats('fetch', fetch_workers),
+                      'parse': StageStats('parse', parse_workers),
+                      'persist': StageStats('persist', persist_workers)}
+        self.outstanding = 0
+
+    def run_url(self, url):
+        """Indexes the models found on the page at *url*."""
+        return self._run(fetch_item=('seed', url, None))
+
+    def run_source(self, source):
+        """Indexes the models found in *source*."""
+        return self._run(parse_item=('seed', source, None))
+
+    def _run(self, fetch_item=None, parse_item=None):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main(fetch_item, parse_item))
+        finally:
+            loop.close()
+
+    async def _main(self, fetch_item, parse_item):
+        self.loop = asyncio.get_event_loop()
+        self.done = asyncio.Event()
+        self.fetch_queue = asyncio.Queue()
+        self.parse_queue = asyncio.Queue(self.queue_size)
+        self.persist_queue = asyncio.Queue(self.queue_size)
+
+        if fetch_item:
+            self._submit(fetch_item)
+        if parse_item:
+            self.outstanding += 1
+            await self.parse_queue.put(parse_item)
+
+        stages = (('fetch', self.fetch_queue, self._fetch),
+                  ('parse', self.parse_queue, self._parse),
+                  ('persist', self.persist_queue, self._persist))
+        workers = []
+        for name, queue, handler in stages:
+            stats = self.stats[name]
+            for _ in range(stats.workers):
+                workers.append(asyncio.ensure_future(self._worker(queue, handler, stats)))
+
+        await self.done.wait()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _submit(self, item):
+        """Queues *item* (kind, url, parent) for fetching."""
+        self.outstanding += 1
+        self.fetch_queue.put_nowait(item)
+
+    def _finish(self):
+        """Marks one item as fully processed or dropped."""
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.done.set()
+
+    async def _worker(self, queue, handler, stats):
+        while True:
+            item = await queue.get()
+            stats.sample_depth(queue.qsize())
+            start = time.time()
+            try:
+                handled = await handler(*item)
+            except Exception:
+                handled = False
+            stats.record(time.time() - start, failed=not handled)
+            if not handled:
+                self._finish()
+            queue.task_done()
+
+    async def _fetch(self, kind, url, parent):
+        source = await self.loop.run_in_executor(None, process_url, url)
+        await self.parse_queue.put((kind, source, parent))
+        return True
+
+    async def _parse(self, kind, source, parent):
+        result = await self.loop.run_in_executor(None, self._parse_source, kind, source)
+        if not result:
+            return False
+        await self.persist_queue.put((kind, result, parent))
+        return True
+
+    def _parse_source(self, kind, source):
+        if kind == 'model':
+            return factory.model_builder(source, self.db_uri)
+        elif kind == 'seed':
+            return parser.model_ids(source)
+        elif kind == 'cast':
+            return parser.cast(source)
+        elif kind == 'roles':
+            return parser.roles(source)
+
+    async def _persist(self, kind, result, parent):
+        new_items = await self.loop.run_in_executor(None, self._persist_result, kind, result,
+                                                    parent)
+        # Queue the follow-up fetches before this item counts as done.
+        for item in new_items:
+            self._submit(item)
+        self._finish()
+        return True
+
+    def _persist_result(self, kind, result, parent):
+        """Stores *result* and returns a list of items which need to be fetched next."""
+        new_items = []
+        if kind == 'model':
+            model = result
+            if not store_model(model, self.db_uri):
+                model = get_cached_model(model.id, self.db_uri)
+            if model is None:
+                return new_items
+            if parent is None:
+                new_items.extend(self._emit(model))
+            else:
+                self._store_edge(parent, model)
+            return new_items
+
+        cached_models = get_cached_models(result, self.db_uri)
+        for model_id in result:
+            cached_model = cached_models.get(model_id)
+            if cached_model is None:
+                _model_url = model_url(model_id)
+                if _model_url is not None:
+                    new_items.append(('model', _model_url, parent))
+            elif parent is None:
+                new_items.extend(self._emit(cached_model))
+            else:
+                self._store_edge(parent, cached_model)
+        return new_items
+
+    def _store_edge(self, a, b):
+        if isinstance(a, Person):
+            a, b = b, a
+        store_cast_member(a, b, self.db_uri)
+
+    def _emit(self, model):
+        """Hands a seed *model* to *on_model* and returns the items to expand it with."""
+        if self.on_model:
+            self.on_model(model)
+        if isinstance(model, Person) and self.with_roles:
+            return [('roles', constants.roles_url.format(model_id=model.id), model)]
+        elif isinstance(model, (Movie, TVShow)) and self.with_cast:
+            return [('cast', constants.cast_url.format(model_id=model.id), model)]
+        return []
+
+    def print_stats(self, stream=None):
+        stream = stream or sys.stderr
+        for name in ('fetch', 'parse', 'persist'):
+            stream.write(self.stats[name].summary() + '\n')
@@ -0,0 +1,333 @@
+"""
+How fetches behave when hosts are slow, failing or throttling us: timeouts, retries with
+exponential backoff and jitter, Retry-After, a token bucket per host whose rate adapts to
+the answers and a circuit breaker per host.
+
+Both *lib.fetch.Fetcher* and *lib.crawl.process_url* ask the policy before starting a
+request and tell it the outcome afterwards:
+
+    wait = policy.delay(url)        # None: the circuit is open, fail right away
+    ...                             # 0: go ahead, otherwise sleep that long and ask again
+    policy.started(url)
+    retry = policy.outcome(url, attempt, status=status, headers=headers)
+    # None: done, otherwise start the request again after *retry* seconds
+
+The rate of a host halves (down to *min_rate*) when it answers 429, asks for a wait with
+Retry-After or when most of its recent answers failed; only once for the requests started
+before the previous decrease, or once per second when the start isn't known. Every
+successful request then raises it again by *increase* requests per second, up to the
+configured *rate*. A host without a configured rate is unthrottled until it first pushes
+back; the rate it was fetched at then is the starting point.
+
+The circuit of a host opens after *breaker_threshold* failures in a row; requests to it
+fail right away for *breaker_cooldown* seconds. After that a single probe request is let
+through, which closes the circuit when it succeeds and opens it again when it fails.
+
+This module doesn't import pycurl, the curl error numbers it retries on are spelled out.
+"""
+import time
+import random
+import threading
+from collections import deque, Counter
+
+from lib import constants, metrics
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+# CURLE_COULDNT_CONNECT, CURLE_PARTIAL_FILE, CURLE_OPERATION_TIMEDOUT, CURLE_GOT_NOTHING,
+# CURLE_SEND_ERROR and CURLE_RECV_ERROR.
+retry_errors = frozenset([7, 18, 28, 52, 55, 56])
+timeout_error = 28
+retry_statuses = frozenset([429, 500, 502, 503, 504])
+
+def _default(value, default):
+    return default if value is None else value
+
+def host_of(url):
+    return urlparse.urlsplit(url).netloc
+
+def parse_retry_after(value, now=None):
+    """Returns the seconds to wait from a Retry-After header *value*, which holds either
+    seconds or an HTTP date. Returns None for a missing or malformed value."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_tz, mktime_tz
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - (now if now is not None else time.time()), 0.0)
+
+
+class TokenBucket(object):
+    """
+    Allows *rate* requests per second with bursts of up to *burst* requests. A *rate* of
+    None lets every request through.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None
+
+    def _refill(self, now):
+        if self.rate and self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Returns the seconds until a token is available, 0 when one is."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self.rate = rate
+        if rate is None:
+            self.tokens = float(self.burst)
+
+
+class CircuitBreaker(object):
+    """Opens after *threshold* failures in a row and lets a probe through after *cooldown*
+    seconds; see the module docstring."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self, now):
+        if self.opened_at is None:
+            return 'closed'
+        if now - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def record(self, succeeded, now):
+        """Records the outcome of a request. Returns True when this opened the circuit."""
+        self.probing = False
+        if succeeded:
+            self.failures = 0
+            self.opened_at = None
+            return False
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = now
+            return True
+        return False
+
+
+class HostState(object):
+    """The bucket, the circuit breaker and the recent history of a single host."""
+
+    def __init__(self, rate, burst, breaker_threshold, breaker_cooldown):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.starts = deque(maxlen=32)
+        self.error_rate = 0.0
+        self.decreased_at = None
+
+    def observed_rate(self, now):
+        """Returns the requests per second recently started, None without any."""
+        if not self.starts:
+            return None
+        return len(self.starts) / max(now - self.starts[0], 0.001)
+
+
+class FetchPolicy(object):
+    """
+    Decides when requests may start, whether and when failed ones are retried and how long
+    a transfer may take. Parameters left at None are read from *constants*; see the module
+    docstring for how they interact. A policy is shared by threads.
+    """
+
+    def __init__(self, rate=None, burst=1, connect_timeout=None, timeout=None, retries=None,
+                 backoff=None, max_backoff=None, max_retry_after=None, min_rate=None,
+                 increase=1.0, error_threshold=0.5, breaker_threshold=None,
+                 breaker_cooldown=None):
+        self.rate = rate
+        self.burst = burst
+        self.connect_timeout = _default(connect_timeout, constants.fetch_connect_timeout)
+        self.timeout = _default(timeout, constants.fetch_timeout)
+        self.retries = _default(retries, constants.fetch_retries)
+        self.backoff = _default(backoff, constants.fetch_backoff)
+        self.max_backoff = _default(max_backoff, constants.fetch_max_backoff)
+        self.max_retry_after = _default(max_retry_after, constants.fetch_max_retry_after)
+        self.min_rate = _default(min_rate, constants.fetch_min_rate)
+        self.increase = increase
+        self.error_threshold = error_threshold
+        self.breaker_threshold = _default(breaker_threshold, constants.fetch_breaker_threshold)
+        self.breaker_cooldown = _default(breaker_cooldown, constants.fetch_breaker_cooldown)
+        self.hosts = {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def _host(self, url):
+        host = host_of(url)
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.rate, self.burst, self.breaker_threshold,
+                                                 self.breaker_cooldown)
+        return state
+
+    def apply(self, c):
+        """Sets the timeouts on the curl handle *c*."""
+        # Timeouts would otherwise be implemented with signals, which only work in the main
+        # thread.
+        c.setopt(c.NOSIGNAL, 1)
+        if self.connect_timeout:
+            c.setopt(c.CONNECTTIMEOUT_MS, int(self.connect_timeout * 1000))
+        c.setopt(c.TIMEOUT_MS, int((self.timeout or 0) * 1000))
+
+    def delay(self, url, now=None):
+        """
+        Returns the seconds to wait before a request to *url* may start, 0 when it may start
+        right away and None when the circuit of its host is open.
+        """
+        now = now if now is not None else time.time()
+        with self.lock:
+            state = self._host(url)
+            breaker = state.breaker.state(now)
+            if breaker == 'open':
+                return None
+            if breaker == 'half-open' and state.breaker.probing:
+                # Wait for the outcome of the probe.
+                return 0.1
+            return state.bucket.delay(now)
+
+    def started(self, url, now=None):
+        """Records that a request to *url*, which *delay* let through, starts."""
+        now = now if now is not None else time.time()
+        with self.lock:
+            state = self._host(url)
+            state.bucket.take(now)
+            state.starts.append(now)
+            if state.breaker.state(now) == 'half-open':
+                state.breaker.probing = True
+
+    def wait(self, url):
+        """Blocks until a request to *url* may start and records its start. Returns False
+        when the circuit of its host is open."""
+        while True:
+            seconds = self.delay(url)
+            if seconds is None:
+                self.reject()
+                return False
+            if seconds <= 0:
+                self.started(url)
+                return True
+            time.sleep(seconds)
+
+    def reject(self):
+        """Records a request given up on without trying because its circuit is open."""
+        self._count('rejected', 'fetch_circuit_rejected')
+
+    def backoff_delay(self, attempt):
+        """Returns the seconds to wait before retry number *attempt* + 1: up to *backoff*
+        seconds doubled per attempt and capped at *max_backoff*, of which the upper half is
+        picked at random so that concurrent retries spread out."""
+        cap = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return self.random.uniform(cap / 2.0, cap)
+
+    def outcome(self, url, attempt, status=None, error=None, headers=None, started_at=None,
+                now=None):
+        """
+        Records the outcome of try number *attempt*, counted from 0, of a request to *url*
+        started at *started_at*: the HTTP *status* and the response *headers*, or the curl
+        *error* number when the transfer failed. Returns the seconds to wait before retrying
+        it, None when it isn't retried.
+        """
+        now = now if now is not None else time.time()
+        headers = headers or {}
+        retry_after = parse_retry_after(headers.get('retry-after'), now)
+        failed = error is not None or (status is not None and status >= 500)
+        throttled = status == 429 or (status is not None and status >= 400 and
+                                      bool(retry_after))
+        with self.lock:
+            state = self._host(url)
+            state.error_rate = 0.8 * state.error_rate + 0.2 * (failed or throttled)
+            if state.breaker.record(not failed, now):
+                self._count('breaker_opened', 'fetch_circuit_opened')
+            if throttled or (failed and state.error_rate > self.error_threshold):
+                self._slow_down(state, started_at, now)
+            elif not failed:
+                self._speed_up(state, now)
+            open_circuit = state.breaker.state(now) != 'closed'
+
+        if error == timeout_error:
+            self._count('timeouts', 'fetch_timeouts')
+        if throttled:
+            self._count('throttled', 'fetch_throttled')
+        retryable = error in retry_errors or status in retry_statuses
+        if not retryable or attempt >= self.retries or open_circuit:
+            return None
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return None
+        self._count('retries', 'fetch_retries')
+        return max(self.backoff_delay(attempt), retry_after or 0)
+
+    def _slow_down(self, state, started_at, now):
+        # Pushback on requests started before the last decrease was answered by it already.
+        if state.decreased_at is not None:
+            if started_at is not None and started_at < state.decreased_at:
+                return
+            if started_at is None and now - state.decreased_at < 1.0:
+                return
+        state.decreased_at = now
+        rate = state.bucket.rate or state.observed_rate(now)
+        state.bucket.set_rate(max(self.min_rate, (rate or 2 * self.min_rate) / 2.0), now)
+
+    def _speed_up(self, state, now):
+        rate = state.bucket.rate
+        if rate is None or rate == self.rate:
+            return
+        rate += self.increase
+        if self.rate is not None:
+            rate = min(rate, self.rate)
+        state.bucket.set_rate(rate, now)
+
+    def _count(self, stat, metric):
+        self.stats[stat] += 1
+        metrics.incr(metric)
+
+    def summary(self):
+        return ('fetch policy: {retries} retries, {timeouts} timeouts, {throttled} throttled, '
+                '{breaker_opened} circuits opened, {rejected} rejected'.format(
+                    **dict((k, self.stats[k]) for k in ('retries', 'timeouts', 'throttled',
+                                                         'breaker_opened', 'rejected'))))
+
+_default_policy = None
+_default_lock = threading.Lock()
+
+def default_policy():
+    """Returns the policy shared by *process_url* and the fetchers, created from *constants*
+    on first use, so every host has one bucket and one breaker per process."""
+    global _default_policy
+    with _default_lock:
+        if _default_policy is None:
+            _default_policy = FetchPolicy(rate=constants.fetch_rate_limit)
+        return _default_policy
+
+def reset_default_policy():
+    """Forgets the shared policy; the next *default_policy* call builds it from *constants*
+    again."""
+    global _default_policy
+    with _default_lock:
+        _default_policy = None
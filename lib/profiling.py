@@ -0,0 +1,76 @@
+"""
+Optional profilers for a whole command run.
+
+*CProfileHook* traces every call with cProfile and writes a pstats file. *SamplingProfiler*
+looks at the stacks of all threads every few milliseconds instead, which costs far less on
+long crawls, and writes the sampled stacks in the folded format flame graph tools read:
+
+    module:function;module:function;... <samples>
+"""
+import os
+import sys
+import cProfile
+import threading
+from collections import Counter
+
+
+class CProfileHook(object):
+    """Profiles the calling thread with cProfile and writes the stats to *path*."""
+
+    def __init__(self, path):
+        self.path = path
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+        return self
+
+    def stop(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all other threads every *interval* seconds and writes the
+    folded stacks to *path*."""
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        own_ident = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(
+                        os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+profilers = {'cprofile': CProfileHook, 'sample': SamplingProfiler}
+
+def start_profiler(mode, path):
+    """Starts the profiler for *mode*, 'cprofile' or 'sample', which writes to *path* when
+    it is stopped."""
+    return profilers[mode](path).start()
@@ -0,0 +1,84 @@
+"""
+A read path which skips the ORM.
+
+The functions in here select just the columns *print_model* needs with Core statements and
+hand out namedtuples, which carry no per instance dict, identity map entry or instance
+state. They are meant for printing and exporting; use the models for anything that writes.
+"""
+from collections import namedtuple
+
+from sqlalchemy import select, literal, null, union_all
+
+from lib.database import get_engine
+from lib.models import Movie, TVShow, Person, result_movie, result_tvshow, result_person
+
+TitleRecord = namedtuple('TitleRecord', 'id title release_year plot poster rating')
+PersonRecord = namedtuple('PersonRecord', 'id firstname middlename lastname')
+
+def _columns(model):
+    """
+    Returns the columns selected for *model*. Titles and people are selected side by side
+    in one UNION, so both kinds of rows have all columns and the ones of the other kind
+    are NULL.
+    """
+    if model is Person:
+        titles = [null().label(c) for c in TitleRecord._fields[1:]]
+        people = [model.firstname, model.middlename, model.lastname]
+    else:
+        titles = [model.title, model.release_year, model.plot, model.poster, model.rating]
+        people = [null().label(c) for c in PersonRecord._fields[1:]]
+    return [model.id] + titles + people
+
+def _record(row):
+    """Turns a row of the UNION into a *TitleRecord* or a *PersonRecord*."""
+    if row[0].startswith('nm'):
+        return PersonRecord(row[0], *row[6:9])
+    return TitleRecord(*row[:6])
+
+def to_record(model):
+    """Returns the record of a *Movie*, *TVShow* or *Person*; records are returned as is."""
+    if isinstance(model, (TitleRecord, PersonRecord)):
+        return model
+    if model.id.startswith('nm'):
+        return PersonRecord(*[getattr(model, c) for c in PersonRecord._fields])
+    return TitleRecord(*[getattr(model, c) for c in TitleRecord._fields])
+
+def _stream(statement, db_uri):
+    connection = get_engine(db_uri).connect()
+    try:
+        for row in connection.execute(statement):
+            yield _record(row)
+    finally:
+        connection.close()
+
+def search_result_records(query, db_uri=None):
+    """
+    Yields the records of the search result set stored for *query*, people first, then
+    movies and tv shows, with a single query.
+    """
+    selects = []
+    for family, (model, table) in enumerate(((Person, result_person), (Movie, result_movie),
+                                             (TVShow, result_tvshow))):
+        model_column = list(table.c)[1]
+        selects.append(select(_columns(model) + [literal(family).label('family')])
+                       .select_from(table.join(model.__table__, model_column == model.id))
+                       .where(table.c.query == query))
+    statement = union_all(*selects).order_by('family')
+    return _stream(statement, db_uri)
+
+def model_records(model_ids, db_uri=None):
+    """Returns a dict mapping the passed *model_ids* to the records of the stored models."""
+    model_ids = list(model_ids)
+    records = {}
+    # Stay below SQLite's limit of bound parameters per statement.
+    for i in range(0, len(model_ids), 300):
+        chunk = model_ids[i:i + 300]
+        titles = [m for m in chunk if m.startswith('tt')]
+        people = [m for m in chunk if m.startswith('nm')]
+        selects = [select(_columns(model)).where(model.id.in_(ids))
+                   for model, ids in ((Movie, titles), (TVShow, titles), (Person, people))
+                   if ids]
+        if selects:
+            for record in _stream(union_all(*selects), db_uri):
+                records[record.id] = record
+    return records
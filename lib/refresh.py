@@ -0,0 +1,168 @@
+"""
+Keeps stored models up to date with their pages.
+
+Every model built from a page carries the time it was fetched and the SHA-1 of the page up
+to its last field (see *factory.content_hash*).
+A refresh picks the models fetched longest ago, or the most popular ones by their amount of
+cast and search result links, and fetches at most *budget* of their pages again. A page
+with an unchanged hash only moves *fetched_at* forward without being parsed; a changed page
+is parsed and only the columns whose values differ are written.
+"""
+import time
+from collections import Counter
+
+from sqlalchemy import select, func, union_all, or_
+
+from lib import crawl, factory
+from lib.fetch import fetch_many
+from lib.database import get_engine, session_scope, retry_locked, forget_models
+from lib.models import (
+    Movie,
+    TVShow,
+    Person,
+    genre_movie,
+    genre_tvshow,
+    actor_movie,
+    actor_tvshow,
+    result_movie,
+    result_tvshow,
+    result_person,
+)
+
+# The columns referring to each model table, counted as its popularity.
+link_columns = (
+    (Movie.__table__, (actor_movie.c.movie_id, result_movie.c.movie_id)),
+    (TVShow.__table__, (actor_tvshow.c.tvshow_id, result_tvshow.c.tvshow_id)),
+    (Person.__table__, (actor_movie.c.actor_id, actor_tvshow.c.actor_id,
+                        result_person.c.person_id)),
+)
+genre_tables = {Movie.__table__: genre_movie, TVShow.__table__: genre_tvshow}
+tracking_columns = ('id', 'fetched_at', 'content_hash')
+
+def _oldest(connection, table, limit, cutoff):
+    """Returns up to *limit* rows of *table* fetched before *cutoff*, never fetched first."""
+    columns = [table.c.id, table.c.content_hash, table.c.fetched_at]
+    # Two queries instead of NULLS FIRST, which not every backend knows; both use the index.
+    rows = connection.execute(select(columns).where(table.c.fetched_at.is_(None))
+                              .limit(limit)).fetchall()
+    if len(rows) < limit:
+        query = select(columns).where(table.c.fetched_at.isnot(None))
+        if cutoff is not None:
+            query = query.where(table.c.fetched_at < cutoff)
+        rows.extend(connection.execute(query.order_by(table.c.fetched_at)
+                                       .limit(limit - len(rows))))
+    return [(table, row.id, row.content_hash, (row.fetched_at or 0,)) for row in rows]
+
+def _popular(connection, table, columns, limit, cutoff):
+    """Returns up to *limit* rows of *table* fetched before *cutoff*, most links first."""
+    links = union_all(*[select([c.label('model_id')]) for c in columns]).alias('links')
+    counts = select([links.c.model_id, func.count().label('links')]) \
+        .group_by(links.c.model_id).alias('counts')
+    popularity = func.coalesce(counts.c.links, 0)
+    query = select([table.c.id, table.c.content_hash, table.c.fetched_at,
+                    popularity.label('popularity')]) \
+        .select_from(table.outerjoin(counts, counts.c.model_id == table.c.id))
+    if cutoff is not None:
+        query = query.where(or_(table.c.fetched_at.is_(None), table.c.fetched_at < cutoff))
+    query = query.order_by(popularity.desc(), func.coalesce(table.c.fetched_at, 0)).limit(limit)
+    return [(table, row.id, row.content_hash, (-row.popularity, row.fetched_at or 0))
+            for row in connection.execute(query)]
+
+def candidates(budget, order='oldest', max_age=None, db_uri=None):
+    """
+    Returns up to *budget* tuples of the table, identifier and content hash of the models
+    to refresh next, in the passed *order*: 'oldest' or 'popular'. Only models fetched more
+    than *max_age* seconds ago are considered when it is set.
+    """
+    cutoff = time.time() - max_age if max_age is not None else None
+    found = []
+    with get_engine(db_uri).connect() as connection:
+        for table, columns in link_columns:
+            if order == 'popular':
+                found.extend(_popular(connection, table, columns, budget, cutoff))
+            else:
+                found.extend(_oldest(connection, table, budget, cutoff))
+    found.sort(key=lambda candidate: candidate[3])
+    return [candidate[:3] for candidate in found[:budget]]
+
+@retry_locked
+def store_refresh(unchanged, models, fetched_at, db_uri=None):
+    """
+    Moves *fetched_at* of the *unchanged* (table, identifier) pairs forward and writes the
+    differing columns and genres of the re-parsed (table, model) pairs in *models*, all in
+    one transaction. Returns a *Counter* of the changed columns per name and the set of
+    identifiers which had changes.
+    """
+    changed_columns = Counter()
+    changed_ids = set()
+    with session_scope(db_uri) as db:
+        for table, _ in link_columns:
+            model_ids = [model_id for t, model_id in unchanged if t is table]
+            # Stay below SQLite's limit of bound parameters per statement.
+            for i in range(0, len(model_ids), 500):
+                db.execute(table.update().where(table.c.id.in_(model_ids[i:i + 500]))
+                           .values(fetched_at=fetched_at))
+
+        for table, model in models:
+            row = db.execute(select([table]).where(table.c.id == model.id)).first()
+            if row is None:
+                continue
+            values = dict((c.key, getattr(model, c.key)) for c in table.columns
+                          if c.key not in tracking_columns and getattr(model, c.key) != row[c.key])
+            changed_columns.update(list(values))
+            genre_table = genre_tables.get(table)
+            if genre_table is not None:
+                genre_column, title_column = list(genre_table.c)
+                stored = set(r[0] for r in db.execute(
+                    select([genre_column]).where(title_column == model.id)))
+                genres = set(genre.id for genre in model.genres)
+                if genres != stored:
+                    changed_columns['genres'] += 1
+                    db.execute(genre_table.delete().where(title_column == model.id))
+                    db.execute(genre_table.insert(), [
+                        {genre_column.key: genre_id, title_column.key: model.id}
+                        for genre_id in genres])
+                    changed_ids.add(model.id)
+            if values:
+                changed_ids.add(model.id)
+            values.update(fetched_at=fetched_at, content_hash=model.content_hash)
+            db.execute(table.update().where(table.c.id == model.id).values(values))
+    return changed_columns, changed_ids
+
+def refresh(budget=100, order='oldest', max_age=None, db_uri=None):
+    """
+    Fetches the pages of up to *budget* models picked by *candidates* and updates the
+    models whose pages changed. Returns a dict with the amount of checked pages, unchanged
+    and updated models, failed fetches or parses, the changed columns and the elapsed
+    seconds.
+    """
+    started = time.time()
+    stats = {'checked': 0, 'unchanged': 0, 'updated': 0, 'failed': 0}
+    picked = dict((crawl.model_url(candidate[1]), candidate)
+                  for candidate in candidates(budget, order, max_age, db_uri))
+
+    unchanged = []
+    models = []
+    for url, source in fetch_many(picked):
+        table, model_id, content_hash = picked[url]
+        stats['checked'] += 1
+        if not source:
+            stats['failed'] += 1
+            continue
+        if factory.content_hash(source) == content_hash:
+            unchanged.append((table, model_id))
+            continue
+        model = factory.model_builder(source, db_uri)
+        if model is None or model.id != model_id or model.__table__ is not table:
+            stats['failed'] += 1
+            continue
+        models.append((table, model))
+
+    changed_columns, changed_ids = store_refresh(unchanged, models, time.time(), db_uri)
+    forget_models(set(model_id for _, model_id in unchanged) |
+                  set(model.id for _, model in models), db_uri)
+    stats['updated'] = len(changed_ids)
+    stats['unchanged'] = len(unchanged) + len(models) - len(changed_ids)
+    stats['columns'] = dict(changed_columns)
+    stats['seconds'] = time.time() - started
+    return stats
@@ -0,0 +1,155 @@
+"""
+Re-derives the stored models from the pages in the page cache, without fetching anything.
+
+The pages are parsed on a pool of worker processes which read and decompress the cached
+bodies themselves, so only file paths travel to the workers and plain tuples travel back.
+A writer thread of the main process resolves the genres and upserts the models in batches
+while the next batch is collected.
+"""
+import re
+import time
+import zlib
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from lib import constants, pagecache, parser
+from lib.database import (
+    session_scope,
+    upsert,
+    insert_ignore,
+    resolve_genres,
+    retry_locked,
+    clear_model_cache,
+)
+from lib.models import Movie, TVShow, Person, genre_movie, genre_tvshow
+
+# Only the pages of titles and people hold models, cast and search pages are skipped.
+model_page_re = re.compile(r'/(?:title|name)/(?:tt|nm)\d+/?$')
+
+title_fields = ('id', 'title', 'poster', 'rating', 'plot', 'duration', 'release_year', 'genres')
+person_fields = ('id', 'firstname', 'middlename', 'lastname', 'birthday')
+
+def parse_page(path):
+    """
+    Parses the compressed page body stored at *path* and returns a tuple of the model type
+    followed by the *title_fields* or *person_fields* of the page. Returns None when the
+    page can't be read or doesn't describe a model.
+    """
+    try:
+        with open(path, 'rb') as f:
+            source = zlib.decompress(f.read()).decode('utf-8', 'replace')
+        record = parser.extract(source)
+    except (IOError, OSError, zlib.error, AttributeError):
+        return None
+    fields = person_fields if record['model_type'] == 'actor' else title_fields
+    return (record['model_type'],) + tuple(record[field] for field in fields)
+
+def page_paths(cache):
+    """Yields the blob path of every cached title and person page, each body once."""
+    seen = set()
+    for entry in cache.entries():
+        if entry['content'] in seen or not model_page_re.search(entry.get('url', '')):
+            continue
+        seen.add(entry['content'])
+        yield cache._blob_path(entry['content'])
+
+@retry_locked
+def store_rows(rows, db_uri=None):
+    """Upserts the parsed *rows* in one transaction and replaces the genres of the titles."""
+    tables = {'movie': Movie.__table__, 'tv_show': TVShow.__table__, 'actor': Person.__table__}
+    by_table = {}
+    genre_names = []
+    for row in rows:
+        if row[0] != 'actor':
+            genre_names.extend(row[-1])
+    genre_ids = dict((g.name, g.id) for g in resolve_genres(genre_names, db_uri))
+
+    genre_rows = {genre_movie: [], genre_tvshow: []}
+    for row in rows:
+        model_type, values = row[0], row[1:]
+        table = tables[model_type]
+        if model_type == 'actor':
+            record = dict(zip(person_fields, values))
+        else:
+            record = dict(zip(title_fields, values))
+            genre_table = genre_movie if model_type == 'movie' else genre_tvshow
+            genre_rows[genre_table].extend(dict(zip(genre_table.c.keys(),
+                                                    (genre_ids[name], record['id'])))
+                                           for name in record.pop('genres'))
+        # Columns the page doesn't describe, like fetched_at, keep their stored values.
+        by_table.setdefault(table, []).append(
+            dict((c.key, record[c.key]) for c in table.columns if c.key in record))
+
+    with session_scope(db_uri) as db:
+        for table, table_rows in by_table.items():
+            upsert(table, table_rows, db)
+        for genre_table, edges in genre_rows.items():
+            title_ids = [r['id'] for r in by_table.get(
+                Movie.__table__ if genre_table is genre_movie else TVShow.__table__, [])]
+            title_column = list(genre_table.c)[1]
+            # Stay below SQLite's limit of bound parameters per statement.
+            for i in range(0, len(title_ids), 500):
+                db.execute(genre_table.delete().where(title_column.in_(title_ids[i:i + 500])))
+            if edges:
+                db.execute(insert_ignore(genre_table, db), edges)
+
+def reparse(cache=None, db_uri=None, processes=None, chunk_size=64, batch_size=1000):
+    """
+    Parses every title and person page in the page *cache* on *processes* worker processes,
+    one per core by default, and upserts the models into the database of *db_uri*. Pages
+    are handed to the workers in chunks of *chunk_size* and the models are written in
+    batches of *batch_size*. Returns a dict with the amount of pages, the stored models,
+    the pages which failed to parse and the elapsed seconds.
+    """
+    cache = cache or pagecache.PageCache(constants.page_cache_dir)
+    stats = {'pages': 0, 'stored': 0, 'failed': 0}
+    started = time.time()
+    batches = queue.Queue(maxsize=2)
+    errors = []
+
+    def write():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                if not errors:
+                    store_rows(batch, db_uri)
+                    stats['stored'] += len(batch)
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        batch = []
+        for row in pool.imap_unordered(parse_page, page_paths(cache), chunk_size):
+            stats['pages'] += 1
+            if row is None:
+                stats['failed'] += 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                batches.put(batch)
+                batch = []
+            if errors:
+                break
+        if batch:
+            batches.put(batch)
+    finally:
+        batches.put(None)
+        writer.join()
+        pool.terminate()
+        pool.join()
+        # The cached models were built from the old rows.
+        clear_model_cache(db_uri)
+    if errors:
+        raise errors[0]
+    stats['seconds'] = time.time() - started
+    return stats
@@ -0,0 +1,162 @@
+"""
+Local full text search over the indexed titles and people.
+
+On SQLite the titles, plots and names live in an FTS5 table which triggers on the model
+tables keep in sync, no matter whether a model is stored through the ORM or a *WriteBuffer*.
+The FTS rowid is derived from the identifier (tt ids map to even, nm ids to odd rowids) so
+updates and deletes never scan the index. Other backends, or SQLite builds without FTS5,
+fall back to LIKE queries.
+"""
+import re
+import threading
+
+import sqlalchemy
+from sqlalchemy import or_
+
+from lib import constants
+from lib.database import get_db, get_engine, get_cached_models
+from lib.models import Movie, TVShow, Person
+from lib.records import model_records
+
+token_re = re.compile(r'\w+', re.UNICODE)
+
+fts_table = 'tbl_search_fts'
+fts_rowid = "CAST(substr({0}.id, 3) AS INTEGER) * 2 + ({0}.id LIKE 'nm%')"
+fts_schema = "CREATE VIRTUAL TABLE {fts} USING fts5(model_id UNINDEXED, name, plot, prefix='2 3')"
+# The update triggers only fire for the indexed columns, so bookkeeping updates such as a
+# refreshed *fetched_at* leave the index alone.
+fts_sources = (
+    ('tbl_movie', 'new.title', 'new.plot', 'title, plot'),
+    ('tbl_tvshow', 'new.title', 'new.plot', 'title, plot'),
+    ('tbl_person', "trim(new.firstname || ' ' || coalesce(new.middlename, '') || ' ' || "
+                   "coalesce(new.lastname, ''))", "''", 'firstname, middlename, lastname'),
+)
+# Columns of the FTS table are model_id, name and plot; matches in names count most.
+fts_rank = 'bm25({fts}, 0.0, 10.0, 1.0)'.format(fts=fts_table)
+
+_ready = {}
+_ready_lock = threading.Lock()
+
+def _create_fts_index(connection):
+    """Creates the FTS table and its triggers and indexes the models stored so far."""
+    connection.execute(fts_schema.format(fts=fts_table))
+    for table, name, plot, columns in fts_sources:
+        values = "{rowid}, new.id, {name}, {plot}".format(
+            rowid=fts_rowid.format('new'), name=name, plot=plot)
+        connection.execute(
+            'CREATE TRIGGER {t}_fts_ai AFTER INSERT ON {t} BEGIN '
+            'INSERT INTO {fts} (rowid, model_id, name, plot) VALUES ({values}); END'
+            .format(t=table, fts=fts_table, values=values))
+        connection.execute(
+            'CREATE TRIGGER {t}_fts_au AFTER UPDATE OF {columns} ON {t} BEGIN '
+            'DELETE FROM {fts} WHERE rowid = {old_rowid}; '
+            'INSERT INTO {fts} (rowid, model_id, name, plot) VALUES ({values}); END'
+            .format(t=table, fts=fts_table, values=values, columns=columns,
+                    old_rowid=fts_rowid.format('old')))
+        connection.execute(
+            'CREATE TRIGGER {t}_fts_ad AFTER DELETE ON {t} BEGIN '
+            'DELETE FROM {fts} WHERE rowid = {old_rowid}; END'
+            .format(t=table, fts=fts_table, old_rowid=fts_rowid.format('old')))
+        connection.execute(
+            'INSERT INTO {fts} (rowid, model_id, name, plot) SELECT {values} FROM {t} AS new'
+            .format(t=table, fts=fts_table, values=values))
+
+def has_fts(db_uri=None):
+    """
+    Returns True when the database of *db_uri* has a full text index, creating it on first
+    use. Only SQLite with FTS5 support gets one.
+    """
+    db_uri = db_uri or constants.database_uri
+    if db_uri in _ready:
+        return _ready[db_uri]
+
+    with _ready_lock:
+        if db_uri not in _ready:
+            engine = get_engine(db_uri)
+            ready = False
+            if engine.dialect.name == 'sqlite':
+                with engine.begin() as connection:
+                    exists = connection.execute(
+                        "SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table,)).first()
+                    try:
+                        if not exists:
+                            _create_fts_index(connection)
+                        ready = True
+                    except sqlalchemy.exc.OperationalError:
+                        # This SQLite build comes without FTS5.
+                        ready = False
+            _ready[db_uri] = ready
+    return _ready[db_uri]
+
+def drop_index(db_uri=None):
+    """
+    Drops the full text index and its triggers, e.g. ahead of a bulk load, and returns True
+    when there was one. *has_fts* creates it again and indexes every stored model at once.
+    """
+    db_uri = db_uri or constants.database_uri
+    engine = get_engine(db_uri)
+    dropped = False
+    if engine.dialect.name == 'sqlite':
+        with _ready_lock, engine.begin() as connection:
+            dropped = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table,)).first() is not None
+            for table, _, _, _ in fts_sources:
+                for suffix in ('ai', 'au', 'ad'):
+                    connection.execute('DROP TRIGGER IF EXISTS {}_fts_{}'.format(table, suffix))
+            connection.execute('DROP TABLE IF EXISTS {}'.format(fts_table))
+            _ready.pop(db_uri, None)
+    return dropped
+
+def tokenize(query):
+    """Splits *query* into lower case words."""
+    return token_re.findall(query.lower())
+
+def search_ids(query, limit=20, db_uri=None):
+    """
+    Returns the identifiers of the indexed models matching all words of *query*, best
+    matches first. Every word also matches as a prefix, so "matr" finds "The Matrix".
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+
+    if has_fts(db_uri):
+        match = ' AND '.join('"{}"*'.format(token.replace('"', '')) for token in tokens)
+        db = get_db(db_uri)
+        try:
+            rows = db.execute(
+                'SELECT model_id FROM {fts} WHERE {fts} MATCH :match ORDER BY {rank} '
+                'LIMIT :limit'.format(fts=fts_table, rank=fts_rank),
+                {'match': match, 'limit': limit})
+            return [row[0] for row in rows]
+        finally:
+            db.close()
+
+    db = get_db(db_uri)
+    try:
+        model_ids = []
+        for model, columns in ((Movie, (Movie.title, Movie.plot)),
+                               (TVShow, (TVShow.title, TVShow.plot)),
+                               (Person, (Person.firstname, Person.middlename,
+                                         Person.lastname))):
+            q = db.query(model.id)
+            for token in tokens:
+                q = q.filter(or_(*[c.ilike(u'%{}%'.format(token)) for c in columns]))
+            model_ids.extend(row[0] for row in q.limit(limit - len(model_ids)))
+            if len(model_ids) >= limit:
+                break
+        return model_ids
+    finally:
+        db.close()
+
+def search(query, limit=20, db_uri=None):
+    """Returns the indexed models matching *query*, best matches first."""
+    model_ids = search_ids(query, limit, db_uri)
+    models = get_cached_models(model_ids, db_uri)
+    return [models[i] for i in model_ids if i in models]
+
+def search_records(query, limit=20, db_uri=None):
+    """Returns the records of the indexed models matching *query*, best matches first."""
+    model_ids = search_ids(query, limit, db_uri)
+    records = model_records(model_ids, db_uri)
+    return [records[i] for i in model_ids if i in records]
@@ -0,0 +1,211 @@
+"""
+A layered cache for search result sets: an in-process LRU in front of *tbl_search_result*.
+
+Queries are keyed by their normalized words (see *search_key*), so "The Matrix", "the
+matrix!" and "matrix" share one entry. A query which isn't cached itself can be answered
+from the result set of a cached prefix of its key, "matri" for "matrix", filtered to the
+results whose title or name has a word starting with every word of the query. IMDb's
+suggestions are capped, so such an answer may lack results the full query would find; it
+is only used when it isn't empty.
+
+Result sets older than *constants.search_cache_ttl* are stale: the caller fetches them
+again and falls back to the stale set when that fails.
+
+    cache = get_cache(db_uri)
+    hit = cache.lookup('the matrix')    # None, or a SearchHit
+    ...
+    cache.reload('the matrix')          # after storing the fetched set
+
+Queries are appended to *constants.query_log_path* when it is set; *hot_queries* reads the
+most frequent ones back to *prewarm* the LRU of a long running server.
+"""
+import io
+import time
+import threading
+from collections import namedtuple, Counter
+
+from sqlalchemy import select
+
+from lib import constants, metrics
+from lib.database import get_engine
+from lib.lru import LRUCache
+from lib.models import SearchResult
+from lib.records import PersonRecord, search_result_records
+from lib.search import token_re
+
+# Left out of keys unless a query consists of nothing else.
+stop_words = frozenset(['a', 'an', 'the'])
+
+SearchHit = namedtuple('SearchHit', 'records fetched_at layer stale')
+
+def search_tokens(query):
+    """Returns the lower cased words of *query* without stop words."""
+    tokens = token_re.findall(query.lower())
+    return [t for t in tokens if t not in stop_words] or tokens
+
+def search_key(query):
+    """Returns the key *query* is cached under."""
+    return u' '.join(search_tokens(query))
+
+def matches(record, tokens):
+    """Returns True when every one of *tokens* starts a word of the title or name of
+    *record*."""
+    if isinstance(record, PersonRecord):
+        text = u' '.join(n for n in (record.firstname, record.middlename, record.lastname) if n)
+    else:
+        text = record.title or u''
+    words = token_re.findall(text.lower())
+    return all(any(w.startswith(t) for w in words) for t in tokens)
+
+
+class SearchCache(object):
+    """
+    Holds up to *size* result sets in memory in front of the ones stored in the database at
+    *db_uri*. Sets older than *ttl* seconds are stale. Thread safe.
+    """
+
+    def __init__(self, size=None, ttl=None, db_uri=None, prefix_min=None):
+        self.lru = LRUCache(size or constants.search_cache_size)
+        self.ttl = constants.search_cache_ttl if ttl is None else ttl
+        self.prefix_min = prefix_min or constants.search_prefix_min
+        self.db_uri = db_uri
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def _stale(self, fetched_at, now):
+        return fetched_at is None or now - fetched_at > self.ttl
+
+    def _stored(self, keys):
+        """Returns a dict mapping those of *keys* stored in the database to their fetch
+        times."""
+        table = SearchResult.__table__
+        statement = select([table.c.query, table.c.fetched_at]).where(table.c.query.in_(keys))
+        connection = get_engine(self.db_uri).connect()
+        try:
+            return dict((row[0], row[1]) for row in connection.execute(statement))
+        finally:
+            connection.close()
+
+    def _load(self, key, fetched_at):
+        entry = (tuple(search_result_records(key, self.db_uri)), fetched_at)
+        self.lru.put(key, entry)
+        return entry
+
+    def _count(self, result):
+        with self.lock:
+            self.stats[result] += 1
+        metrics.incr('search_cache_lookups', result=result)
+
+    def lookup(self, query, now=None):
+        """
+        Returns the *SearchHit* for *query*, None when nothing is cached for it. The *layer*
+        of a hit is 'memory', 'database' or 'prefix'; *stale* hits are only returned when
+        there is no fresh one.
+        """
+        now = now if now is not None else time.time()
+        key = search_key(query)
+        tokens = key.split()
+        candidates = [key[:i].rstrip() for i in range(len(key) - 1, self.prefix_min - 1, -1)]
+        candidates = [c for i, c in enumerate(candidates) if c and c not in candidates[:i]]
+
+        stale = None
+        entry = self.lru.get(key)
+        if entry is not None:
+            if not self._stale(entry[1], now):
+                self._count('memory')
+                return SearchHit(entry[0], entry[1], 'memory', False)
+            stale = SearchHit(entry[0], entry[1], 'memory', True)
+
+        stored = self._stored([key] + candidates)
+        if key in stored and (stale is None or stored[key] != stale.fetched_at):
+            records, fetched_at = self._load(key, stored[key])
+            if not self._stale(fetched_at, now):
+                self._count('database')
+                return SearchHit(records, fetched_at, 'database', False)
+            stale = SearchHit(records, fetched_at, 'database', True)
+
+        for candidate in candidates:
+            entry = self.lru.get(candidate) if candidate in self.lru else None
+            if entry is None and candidate in stored:
+                entry = self._load(candidate, stored[candidate])
+            if entry is None or self._stale(entry[1], now):
+                continue
+            records = tuple(r for r in entry[0] if matches(r, tokens))
+            if records:
+                self._count('prefix')
+                return SearchHit(records, entry[1], 'prefix', False)
+
+        self._count('stale' if stale else 'miss')
+        return stale
+
+    def put(self, query, records, fetched_at=None):
+        """Caches *records* as the result set of *query*, fetched at *fetched_at*."""
+        self.lru.put(search_key(query), (tuple(records), fetched_at or time.time()))
+
+    def reload(self, query):
+        """Replaces the result set of *query* held in memory by the stored one."""
+        key = search_key(query)
+        stored = self._stored([key])
+        if key in stored:
+            self._load(key, stored[key])
+        else:
+            self.lru.pop(key)
+
+    def prewarm(self, queries):
+        """Loads the stored result sets of *queries* into memory. Returns how many were
+        stored."""
+        keys = [k for k in set(search_key(q) for q in queries) if k]
+        stored = {}
+        for i in range(0, len(keys), 300):
+            stored.update(self._stored(keys[i:i + 300]))
+        for key, fetched_at in stored.items():
+            self._load(key, fetched_at)
+        return len(stored)
+
+    def hit_ratio(self):
+        """Returns the share of lookups answered by a fresh result set, None before any."""
+        lookups = sum(self.stats.values())
+        if not lookups:
+            return None
+        return float(sum(self.stats[k] for k in ('memory', 'database', 'prefix'))) / lookups
+
+    def summary(self):
+        ratio = self.hit_ratio()
+        return ('search cache: {memory} memory, {database} database, {prefix} prefix hits, '
+                '{stale} stale, {miss} misses, {ratio} hit ratio'.format(
+                    ratio='-' if ratio is None else '{:.0%}'.format(ratio),
+                    **dict((k, self.stats[k])
+                           for k in ('memory', 'database', 'prefix', 'stale', 'miss'))))
+
+_caches = {}
+_caches_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+def get_cache(db_uri=None):
+    """Returns the *SearchCache* of the database at *db_uri*, created on first use."""
+    with _caches_lock:
+        cache = _caches.get(db_uri)
+        if cache is None:
+            cache = _caches[db_uri] = SearchCache(db_uri=db_uri)
+        return cache
+
+def log_query(query, now=None):
+    """Appends *query* to *constants.query_log_path* when it is set."""
+    path = constants.query_log_path
+    if not path:
+        return
+    line = u'{:.0f}\t{}\n'.format(now if now is not None else time.time(),
+                                  query.replace(u'\t', u' ').replace(u'\n', u' '))
+    with _log_lock:
+        with io.open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+def hot_queries(path, count):
+    """Returns the keys of the *count* most frequent queries in the query log at *path*."""
+    counts = Counter()
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            key = search_key(line.rstrip(u'\n').partition(u'\t')[2])
+            if key:
+                counts[key] += 1
+    return [key for key, _ in counts.most_common(count)]
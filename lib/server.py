@@ -0,0 +1,250 @@
+"""
+A long running server which answers search, get and index requests with JSON, over HTTP or
+a local Unix socket. A command line run pays for starting the interpreter, the imports and
+opening the database on every call and starts with cold caches; the server keeps the
+database engine, the model and genre caches, the full text index and the curl handles of its
+workers warm between requests. *lib.client* forwards command line calls to it.
+
+    GET  /search?q=matrix&limit=20&remote=0&ordered=0
+    GET  /get?id=tt0133093&fetch=1
+    POST /index {"url": ..., "source": ..., "with_cast": true, "with_roles": true,
+                 "depth": null, "max_pages": null}
+    GET  /status       pid, uptime, requests and the search cache counters
+
+Answers are JSON objects. Search, get and index answer {"results": [record, ...]}, where
+a record holds the fields of a *lib.records* record; errors answer {"error": message}.
+"""
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer, UnixStreamServer
+
+from lib import constants, database, search, searchcache, service
+from lib.client import parse_address
+from lib.records import to_record
+
+def _flag(params, name, default=False):
+    value = params.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def _number(params, name, default=None):
+    value = params.get(name)
+    return default if value is None else int(value)
+
+def _remove_stale_socket(path):
+    """Removes the socket file at *path* left behind by a server which is gone. Raises a
+    ValueError when a server still listens on it."""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise ValueError('A server is listening on {} already.'.format(path))
+    finally:
+        probe.close()
+
+
+class _WorkerPoolMixIn(ThreadingMixIn):
+    """
+    Handles requests in a fixed amount of worker threads instead of a thread per request.
+    The fetcher of a thread is kept for its life time (see *lib.fetch.default_fetcher*), so
+    the curl handles and their connections are reused across requests.
+    """
+
+    def start_workers(self, count):
+        self.pending = queue.Queue()
+        self.workers = [threading.Thread(target=self._work) for _ in range(count)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            request = self.pending.get()
+            if request is None:
+                return
+            self.process_request_thread(*request)
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def stop_workers(self):
+        for _ in self.workers:
+            self.pending.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class _TCPServer(_WorkerPoolMixIn, TCPServer):
+    allow_reuse_address = True
+
+
+class _UnixServer(_WorkerPoolMixIn, UnixStreamServer):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._answer('GET')
+
+    def do_POST(self):
+        self._answer('POST')
+
+    def _answer(self, method):
+        app = self.server.app
+        path, _, query = self.path.partition('?')
+        route = app.routes.get((method, path.rstrip('/')))
+        if route is None:
+            status, answer = 404, {'error': 'No such endpoint: {} {}'.format(method, path)}
+        else:
+            try:
+                if method == 'POST':
+                    length = int(self.headers.get('Content-Length') or 0)
+                    params = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+                else:
+                    params = dict(urlparse.parse_qsl(query))
+                status, answer = 200, route(params)
+            except ValueError as e:
+                status, answer = 400, {'error': str(e)}
+            except Exception as e:
+                traceback.print_exc()
+                status, answer = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+        app.requests += 1
+
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(object):
+    """
+    Serves the JSON API at *address*, *constants.server_address* by default, with
+    *workers* threads answering requests. A TCP port 0 picks a free port; *address* holds
+    the address to connect to once the server is bound.
+    """
+
+    def __init__(self, address=None, workers=None, db_uri=None):
+        self.family, target = parse_address(address or constants.server_address)
+        self.db_uri = db_uri
+        self.requests = 0
+        self.started = time.time()
+        self.routes = {
+            ('GET', '/search'): self.search,
+            ('GET', '/get'): self.get,
+            ('POST', '/index'): self.index,
+            ('GET', '/status'): self.status,
+        }
+        if self.family == 'unix':
+            _remove_stale_socket(target)
+            self.httpd = _UnixServer(target, _Handler)
+            self.address = 'unix:' + target
+        else:
+            self.httpd = _TCPServer(target, _Handler)
+            self.address = '{}:{}'.format(*self.httpd.server_address[:2])
+        self.httpd.app = self
+        self.httpd.start_workers(workers or constants.server_workers)
+        self.thread = None
+
+    def warm(self, prewarm=0):
+        """
+        Opens the database and readies the full text index before the first request. Loads
+        the result sets of the *prewarm* most frequent queries of the query log into the
+        search cache. Returns how many were loaded.
+        """
+        database.get_engine(self.db_uri)
+        search.has_fts(self.db_uri)
+        path = constants.query_log_path
+        if not prewarm or not path or not os.path.exists(path):
+            return 0
+        return searchcache.get_cache(self.db_uri).prewarm(searchcache.hot_queries(path, prewarm))
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serves in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+        self.httpd.server_close()
+        self.httpd.stop_workers()
+        if self.family == 'unix' and os.path.exists(self.httpd.server_address):
+            os.unlink(self.httpd.server_address)
+
+    def search(self, params):
+        query = params.get('q')
+        if not query:
+            raise ValueError('Pass the search query as q.')
+        results = []
+        service.search(query, lambda model: results.append(to_record(model)._asdict()),
+                       limit=_number(params, 'limit', 20), remote=_flag(params, 'remote'),
+                       ordered=_flag(params, 'ordered'), db_uri=self.db_uri)
+        return {'results': results}
+
+    def get(self, params):
+        model_id = params.get('id')
+        if not model_id:
+            raise ValueError('Pass the identifier of the model as id.')
+        record = service.get(model_id, fetch=_flag(params, 'fetch', True), db_uri=self.db_uri)
+        return {'results': [record._asdict()] if record else []}
+
+    def index(self, params):
+        if not params.get('url') and params.get('source') is None:
+            raise ValueError('Pass either the url or the source to index.')
+        results = []
+        expansion = service.index(lambda model: results.append(to_record(model)._asdict()),
+                                  url=params.get('url'), source=params.get('source'),
+                                  with_cast=_flag(params, 'with_cast', True),
+                                  with_roles=_flag(params, 'with_roles', True),
+                                  depth=_number(params, 'depth'),
+                                  max_pages=_number(params, 'max_pages'),
+                                  db_uri=self.db_uri)
+        if expansion is not None:
+            expansion = {'levels': expansion.levels, 'pages': expansion.pages,
+                         'stored': expansion.stored}
+        return {'results': results, 'expansion': expansion}
+
+    def status(self, params):
+        cache = searchcache.get_cache(self.db_uri)
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started,
+                'requests': self.requests,
+                'search_cache': dict(cache.stats, hit_ratio=cache.hit_ratio())}
@@ -0,0 +1,115 @@
+"""
+The search, get and index operations behind the command line and the server in
+lib/server.py. Search and index hand every model or record to an *emit* callable as soon as
+it is found, so the command line prints results right away and the server collects them.
+"""
+import json
+
+from lib import constants, crawl, factory, searchcache
+from lib.database import store_model
+from lib.models import Movie, TVShow, Person
+from lib.records import model_records, to_record
+from lib.search import search_records
+
+def search(query, emit, limit=20, remote=False, ordered=False, db_uri=None):
+    """
+    Searches the local index, then the cached search result sets (see *lib.searchcache*)
+    and finally IMDb's suggestions for *query*. *remote* skips the local index, *ordered*
+    emits fetched results in ranking order instead of as they arrive. A stale result set is
+    emitted when the suggestions can't be fetched or find nothing. Raises a ValueError when
+    *query* is empty once encoded.
+    """
+    encoded_query = crawl.encode_search_query(query)
+    if not encoded_query:
+        raise ValueError('Search query was empty after encoding it.')
+    searchcache.log_query(query)
+
+    # Anything we indexed already is answered by the local full text index.
+    if remote is False:
+        local_models = search_records(query, limit=limit, db_uri=db_uri)
+        for model in local_models:
+            emit(model)
+        if local_models:
+            return
+
+    # Query our cached search result sets before making an actual web request.
+    cache = searchcache.get_cache(db_uri)
+    key = searchcache.search_key(query)
+    hit = cache.lookup(query)
+    if hit is not None and not hit.stale:
+        for record in hit.records:
+            emit(record)
+        return
+
+    import pycurl
+
+    found = []
+    try:
+        json_result_raw = crawl.process_url(constants.suggest_url.format(encoded_query[0],
+                                                                         encoded_query))
+        if json_result_raw:
+            json_result = json.loads(json_result_raw.split('(', 1)[1][:-1])
+            for model in crawl.models_from_json(json_result, db_uri, ordered=ordered,
+                                                query=key):
+                if model:
+                    found.append(to_record(model))
+                    emit(model)
+    except (pycurl.error, ValueError, IndexError):
+        # Unreachable, or an answer which isn't the suggestions.
+        if hit is None or found:
+            raise
+    if found:
+        # The stored set, which is only stamped when the search wasn't cut short.
+        cache.reload(key)
+    elif hit is not None:
+        for record in hit.records:
+            emit(record)
+
+def get(model_id, fetch=True, db_uri=None):
+    """
+    Returns the record of the model *model_id*. A model which isn't stored yet is fetched
+    and stored first when *fetch* is True; the page of a merged identifier gives the model
+    it was merged into. Returns None when there is no such model.
+    """
+    found = model_records([model_id], db_uri).get(model_id)
+    url = crawl.model_url(model_id)
+    if found is None and fetch and url is not None:
+        for _, source in crawl.fetch_many([url], model_pages=True):
+            model = factory.model_builder(source, db_uri) if source else None
+            if model is not None:
+                # Already stored when it was merged into a known model.
+                store_model(model, db_uri)
+                found = to_record(model)
+    return found
+
+def index(emit, url=None, source=None, with_cast=True, with_roles=True, depth=None,
+          max_pages=None, db_uri=None):
+    """
+    Indexes the models found by crawling *url* or in the page *source*, along with the cast
+    of the titles and the filmography of the people, and emits every model found. Passing
+    *depth* or *max_pages* expands the models breadth first instead; the *Expansion* is
+    returned then, None otherwise.
+    """
+    if url:
+        found = crawl.models_from_url(url, db_uri)
+    else:
+        found = crawl.models_from_source(source, db_uri)
+
+    if depth is None and max_pages is None:
+        for model in found:
+            if isinstance(model, Person) and with_roles:
+                crawl.extract_acts_by_person(model, db_uri)
+            if isinstance(model, (Movie, TVShow)) and with_cast:
+                crawl.extract_cast(model, db_uri)
+            emit(model)
+        return None
+
+    from lib.expand import Expansion
+
+    seeds = list(found)
+    for model in seeds:
+        emit(model)
+    expansion = Expansion(depth=depth or 1, max_pages=max_pages, with_cast=with_cast,
+                          with_roles=with_roles, on_model=emit, db_uri=db_uri)
+    expansion.run(seeds)
+    return expansion
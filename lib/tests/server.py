@@ -0,0 +1,186 @@
+"""
+A local HTTP stand-in for the IMDb pages used by the tests and benchmarks. It serves the
+fixture pages in *files* under the same paths the crawler requests them from, and can
+inject latency, errors, throttling and dropped connections (see *Faults*).
+"""
+import os
+import sys
+import time
+import random
+import socket
+import hashlib
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from lib.policy import TokenBucket
+
+here = os.path.dirname(__file__)
+
+fixture_pages = {
+    '/title/tt0133093': 'the_matrix.html',
+    '/title/tt2085059': 'black_mirror.html',
+    '/name/nm0000151': 'morgan_freeman.html',
+}
+
+def load_fixture_pages():
+    """Returns a dict mapping request paths to the raw fixture page bodies."""
+    pages = {}
+    for path, filename in fixture_pages.items():
+        with open(os.path.join(here, 'files', filename), 'rb') as f:
+            pages[path] = f.read()
+    return pages
+
+
+class Faults(object):
+    """
+    The faults a *StandInServer* injects. *script* maps request paths to the faults their
+    next requests get, in order, before the page is served normally again. A fault is an
+    HTTP status to answer with, 'reset' to drop the connection without an answer or
+    ('stall', seconds) to hold the answer back.
+
+    Beyond the script every request is answered with one of *statuses* at *error_rate*
+    and held back *stall* seconds at *stall_rate*, as drawn from a generator seeded with
+    *seed*. Requests beyond *max_rate* per second get a 429. 429 and 503 answers carry a
+    Retry-After of *retry_after* seconds unless it is None.
+    """
+
+    def __init__(self, script=None, error_rate=0, statuses=(500, 502, 503), stall_rate=0,
+                 stall=0, max_rate=None, retry_after=None, seed=0):
+        self.script = dict((path, list(faults)) for path, faults in (script or {}).items())
+        self.error_rate = error_rate
+        self.statuses = statuses
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.bucket = TokenBucket(max_rate, burst=max(1, int(max_rate or 1)))
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.injected = 0
+
+    def pick(self, path):
+        """Returns the faults for the next request to *path*."""
+        with self.lock:
+            faults = []
+            if self.script.get(path):
+                faults.append(self.script[path].pop(0))
+            if self.stall_rate and self.random.random() < self.stall_rate:
+                faults.append(('stall', self.stall))
+            if self.error_rate and self.random.random() < self.error_rate:
+                faults.append(self.random.choice(self.statuses))
+            now = time.time()
+            if self.bucket.delay(now) > 0:
+                faults.append(429)
+            else:
+                self.bucket.take(now)
+            self.injected += bool(faults)
+            return faults
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Room for many clients connecting at once, which streaming clients do as they hang up.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Streaming clients hang up once they have what they need.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        with stand_in.lock:
+            stand_in.requests += 1
+            stand_in.in_flight += 1
+            stand_in.peak_in_flight = max(stand_in.peak_in_flight, stand_in.in_flight)
+        try:
+            self.answer(stand_in)
+        finally:
+            with stand_in.lock:
+                stand_in.in_flight -= 1
+
+    def answer(self, stand_in):
+        if stand_in.delay:
+            time.sleep(stand_in.delay)
+        for fault in stand_in.faults.pick(self.path.rstrip('/')) if stand_in.faults else []:
+            if fault == 'reset':
+                self.close_connection = True
+                return
+            if isinstance(fault, tuple):
+                time.sleep(fault[1])
+            else:
+                self.send_fault(fault)
+                return
+        body = stand_in.pages.get(self.path.rstrip('/'))
+        status = 200
+        etag = None
+        if body is None:
+            status, body = 404, b'Not Found'
+        else:
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self, status):
+        body = b'Injected fault'
+        self.send_response(status)
+        if status in (429, 503) and self.server.stand_in.faults.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.stand_in.faults.retry_after))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(object):
+    """
+    Serves *pages*, a dict of request path to response body, on a random local port. Each
+    page carries an ETag and conditional requests for an unchanged page get a 304.
+    The fixture pages are served when no *pages* are passed. Every response is held back
+    for *delay* seconds to simulate network latency. *faults*, a *Faults*, makes it
+    misbehave. *peak_in_flight* is the most requests it was answering at once.
+
+        with StandInServer(faults=Faults({'/title/tt0133093': [503]})) as server:
+            process_url(server.url + '/title/tt0133093')
+    """
+
+    def __init__(self, pages=None, delay=0, faults=None):
+        self.pages = pages if pages is not None else load_fixture_pages()
+        self.delay = delay
+        self.faults = faults
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.stand_in = self
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
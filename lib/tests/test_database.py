@@ -0,0 +1,259 @@
+import os
+import unittest
+import tempfile
+import multiprocessing
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from lib import constants, database, migrations, models
+
+def write_people(db_uri, first, count):
+    """Stores *count* people in small transactions, run by several processes at once."""
+    for i in range(first, first + count):
+        with database.WriteBuffer(db_uri, max_rows=5) as buffer:
+            buffer.add_model(models.Person(id='nm{:07d}'.format(i), firstname='Extra'))
+
+
+class PostgresStandIn(object):
+    """Records the statements a PostgreSQL session would be asked to execute."""
+
+    dialect = postgresql.dialect()
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(str(statement.compile(dialect=self.dialect)))
+
+
+class TestDatabase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+
+    def test_engine_is_cached(self):
+        assert database.get_engine(self.db_uri) is database.get_engine(self.db_uri)
+
+    def test_session_scope(self):
+        with database.session_scope(self.db_uri) as db:
+            db.add(models.Person(id='nm0000001', firstname='Fred', lastname='Astaire'))
+        person = database.get_cached_model('nm0000001', self.db_uri)
+        assert person.lastname == 'Astaire'
+
+        try:
+            with database.session_scope(self.db_uri) as db:
+                db.add(models.Person(id='nm0000002', firstname='Lauren', lastname='Bacall'))
+                raise ValueError()
+        except ValueError:
+            pass
+        assert database.get_cached_model('nm0000002', self.db_uri) is None
+
+    def test_write_buffer(self):
+        movie = models.Movie(id='tt0000003', title='Casablanca', poster=None, rating=None,
+                             plot=None, duration=None, release_year=1942, genres=[])
+        person = models.Person(id='nm0000003', firstname='Humphrey', lastname='Bogart')
+        with database.WriteBuffer(self.db_uri, max_rows=3) as buffer:
+            buffer.add_model(movie)
+            buffer.add_model(person)
+            buffer.add_cast_member(movie, person)
+            assert buffer.pending == 0
+            buffer.add_model(person)
+            buffer.add_cast_member(movie, person)
+        assert buffer.written == 5
+
+        db = database.get_db(self.db_uri)
+        assert [p.id for p in db.query(models.Movie).get('tt0000003').actors] == ['nm0000003']
+        db.close()
+
+    def test_get_cached_models(self):
+        database.store_model(models.Person(id='nm0000004', firstname='Ingrid',
+                                           lastname='Bergman'), self.db_uri)
+        with database.session_scope(self.db_uri) as db:
+            db.add(models.TVShow(id='tt0000004', title='Columbo', poster=None, rating=None,
+                                 plot=None, release_year=1968, genres=[]))
+
+        found = database.get_cached_models(['nm0000004', 'tt0000004', 'tt0000005'],
+                                           self.db_uri)
+        assert sorted(found) == ['nm0000004', 'tt0000004']
+        assert isinstance(found['tt0000004'], models.TVShow)
+
+        # Known missing identifiers are answered without a query until they are stored.
+        assert database.get_cached_model('tt0000005', self.db_uri) is None
+        database.store_model(models.Movie(id='tt0000005', title='Notorious', poster=None,
+                                          rating=None, plot=None, duration=None,
+                                          release_year=1946, genres=[]), self.db_uri)
+        assert database.get_cached_model('tt0000005', self.db_uri).title == 'Notorious'
+
+        # Missing identifiers stored by another process are found once they expire.
+        assert database.get_cached_model('tt0000006', self.db_uri) is None
+        with database.get_engine(self.db_uri).begin() as connection:
+            connection.execute(models.Movie.__table__.insert(), id='tt0000006',
+                               title='Rope', release_year=1948)
+        assert database.get_cached_model('tt0000006', self.db_uri) is None
+        ttl = constants.missing_cache_ttl
+        constants.missing_cache_ttl = 0
+        try:
+            assert database.get_cached_models(['tt0000006'], self.db_uri)['tt0000006'] \
+                .title == 'Rope'
+        finally:
+            constants.missing_cache_ttl = ttl
+
+        # So are models updated by another process.
+        with database.get_engine(self.db_uri).begin() as connection:
+            connection.execute(models.Movie.__table__.update()
+                               .where(models.Movie.__table__.c.id == 'tt0000006'),
+                               title='Rope (1948)')
+        assert database.get_cached_model('tt0000006', self.db_uri).title == 'Rope'
+        ttl = constants.model_cache_ttl
+        constants.model_cache_ttl = 0
+        try:
+            assert database.get_cached_model('tt0000006', self.db_uri).title == 'Rope (1948)'
+            assert database.get_cached_models(['tt0000006'], self.db_uri)['tt0000006'] \
+                .title == 'Rope (1948)'
+        finally:
+            constants.model_cache_ttl = ttl
+
+    def test_sqlite_wal(self):
+        with database.get_engine(self.db_uri).connect() as connection:
+            assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.execute('PRAGMA busy_timeout').scalar() == \
+                constants.database_busy_timeout * 1000
+
+    def test_migrations(self):
+        engine = database.get_engine(self.db_uri)
+        with engine.connect() as connection:
+            assert migrations.applied_versions(connection) == \
+                set(version for version, _, _ in migrations.migrations)
+        assert migrations.migrate(engine) == []
+
+    def test_fetch_tracking_migration(self):
+        fd, filepath = tempfile.mkstemp()
+        engine = sqlalchemy.create_engine('sqlite:///' + filepath)
+        try:
+            # The model tables as they were before the fetch tracking columns.
+            with engine.begin() as connection:
+                connection.execute('CREATE TABLE tbl_movie (id VARCHAR PRIMARY KEY, '
+                                   'title VARCHAR(256) NOT NULL)')
+                connection.execute('CREATE TABLE tbl_tvshow (id VARCHAR PRIMARY KEY)')
+                connection.execute('CREATE TABLE tbl_person (id VARCHAR PRIMARY KEY, '
+                                   'firstname VARCHAR(256) NOT NULL)')
+                connection.execute("INSERT INTO tbl_movie VALUES ('tt0133093', 'The Matrix')")
+                connection.execute('CREATE TABLE tbl_genre_movie (genre_id VARCHAR, '
+                                   'movie_id VARCHAR, PRIMARY KEY (genre_id, movie_id))')
+                connection.execute("INSERT INTO tbl_genre_movie VALUES ('3', 'tt0133093')")
+                migrations.version_table.create(connection)
+                connection.execute(migrations.version_table.insert(), version=1)
+            assert migrations.migrate(engine) == [2, 3, 4, 5]
+
+            inspector = sqlalchemy.inspect(engine)
+            columns = [c['name'] for c in inspector.get_columns('tbl_movie')]
+            assert columns[-2:] == ['fetched_at', 'content_hash']
+            assert 'ix_tbl_person_fetched_at' in \
+                [i['name'] for i in inspector.get_indexes('tbl_person')]
+            assert engine.execute('SELECT fetched_at FROM tbl_movie').scalar() is None
+            genre_id = [c for c in inspector.get_columns('tbl_genre_movie')
+                        if c['name'] == 'genre_id'][0]
+            assert isinstance(genre_id['type'], sqlalchemy.Integer)
+            assert engine.execute('SELECT genre_id FROM tbl_genre_movie').scalar() == 3
+        finally:
+            engine.dispose()
+            os.close(fd)
+            os.unlink(filepath)
+
+    def test_retry_locked(self):
+        calls = []
+
+        @database.retry_locked
+        def contended():
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('database is locked'))
+            return 'stored'
+
+        assert contended() == 'stored' and len(calls) == 3
+
+        @database.retry_locked
+        def broken():
+            calls.append(1)
+            raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('no such table'))
+
+        self.assertRaises(sqlalchemy.exc.OperationalError, broken)
+        assert len(calls) == 4
+
+    def test_postgres_statements(self):
+        db = PostgresStandIn()
+        database.upsert(models.Person.__table__,
+                        [{'id': 'nm0000001', 'firstname': 'Fred', 'middlename': None,
+                          'lastname': 'Astaire', 'birthday': None}], db)
+        db.execute(database.insert_ignore(models.actor_movie, db))
+        assert 'ON CONFLICT (id) DO UPDATE SET firstname = excluded.firstname' in db.statements[0]
+        assert db.statements[1].endswith('ON CONFLICT DO NOTHING')
+
+    def test_postgres_schema(self):
+        # PostgreSQL refuses foreign keys between columns of different types.
+        dialect = postgresql.dialect()
+        for table in models.Base.metadata.sorted_tables:
+            str(sqlalchemy.schema.CreateTable(table).compile(dialect=dialect))
+            for key in table.foreign_keys:
+                assert key.parent.type.compile(dialect) == key.column.type.compile(dialect), \
+                    '{} references {}'.format(key.parent, key.column)
+
+    @unittest.skipUnless(os.environ.get('IMDBOOO_TEST_POSTGRES_URI'),
+                         'Set $IMDBOOO_TEST_POSTGRES_URI to an empty PostgreSQL database')
+    def test_postgres(self):
+        db_uri = os.environ['IMDBOOO_TEST_POSTGRES_URI']
+        movie = models.Movie(id='tt0133093', title='The Matrix', poster=None, rating=8.7,
+                             plot='Neo.', duration='136 min', release_year=1999,
+                             genres=[models.Genre('Action'), models.Genre('Sci-Fi')])
+        person = models.Person(id='nm0000151', firstname='Morgan', lastname='Freeman')
+        try:
+            database.init_db(db_uri)
+            for _ in range(2):
+                with database.WriteBuffer(db_uri) as buffer:
+                    buffer.add_model(movie)
+                    buffer.add_model(person)
+                    buffer.add_cast_member(movie, person)
+            db = database.get_db(db_uri)
+            stored = db.query(models.Movie).get('tt0133093')
+            assert sorted(g.name for g in stored.genres) == ['Action', 'Sci-Fi']
+            assert [p.id for p in stored.actors] == ['nm0000151']
+            db.close()
+        finally:
+            engine = database.get_engine(db_uri)
+            models.Base.metadata.drop_all(engine)
+            migrations.version_table.drop(engine, checkfirst=True)
+            database.dispose_db(db_uri)
+
+    def test_concurrent_writers(self):
+        fd, filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + filepath
+        database.init_db(db_uri)
+        context = multiprocessing.get_context('spawn') \
+            if hasattr(multiprocessing, 'get_context') else multiprocessing
+        try:
+            writers = [context.Process(target=write_people, args=(db_uri, i * 100, 100))
+                       for i in range(4)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+            assert all(writer.exitcode == 0 for writer in writers)
+            with database.session_scope(db_uri) as db:
+                assert db.query(models.Person).count() == 400
+        finally:
+            database.dispose_db(db_uri)
+            os.close(fd)
+            os.unlink(filepath)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import datetime
+import unittest
+import tempfile
+
+from lib import database, dump, models, search
+
+class TestDump(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_uri = 'sqlite:///' + os.path.join(self.directory, 'source.db')
+        self.target_uri = 'sqlite:///' + os.path.join(self.directory, 'target.db')
+        genres = database.resolve_genres(['Action', 'Sci-Fi'], self.source_uri)
+        matrix = models.Movie(id='tt0133093', title=u'The Matrix –', poster=None,
+                              rating=8.7, plot='Neo.', duration='136 min', release_year=1999,
+                              genres=genres)
+        freeman = models.Person(id='nm0000151', firstname='Morgan', lastname='Freeman',
+                                birthday=datetime.date(1937, 6, 1))
+        with database.WriteBuffer(self.source_uri) as buffer:
+            buffer.add_model(matrix)
+            buffer.add_model(freeman)
+            buffer.add_cast_member(matrix, freeman)
+        database.store_search_results('matrix', [matrix], self.source_uri)
+
+    def round_trip(self, filename):
+        path = os.path.join(self.directory, filename)
+        exported = dump.dump(path, self.source_uri, chunk_size=1)
+        # The target has an index already; it has to cover the loaded models.
+        search.has_fts(self.target_uri)
+        imported = dump.load(path, self.target_uri, chunk_size=1)
+        assert exported == imported
+        assert imported['tbl_movie'] == 1 and imported['tbl_genre_movie'] == 2
+
+        person = database.get_cached_model('nm0000151', self.target_uri)
+        assert person.birthday == datetime.date(1937, 6, 1)
+        movie = database.get_cached_model('tt0133093', self.target_uri)
+        assert movie.title == u'The Matrix –'
+        assert search.search_ids('freeman', db_uri=self.target_uri) == ['nm0000151']
+        assert [m.id for m in database.get_search_results('matrix', self.target_uri)] == \
+            ['tt0133093']
+
+        # Loading again skips the rows which exist already.
+        assert dump.load(path, self.target_uri) == imported
+
+    def test_round_trip(self):
+        self.round_trip('dump.jsonl')
+
+    def test_round_trip_gzip(self):
+        self.round_trip('dump.jsonl.gz')
+
+    def tearDown(self):
+        database.dispose_db(self.source_uri)
+        database.dispose_db(self.target_uri)
+        shutil.rmtree(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import unittest
+import tempfile
+
+from lib import constants, database, expand, factory
+from lib.tests.server import StandInServer, load_fixture_pages
+
+class TestExpansion(unittest.TestCase):
+
+    def setUp(self):
+        self.db_fd, self.db_filepath = tempfile.mkstemp()
+        self.db_uri = 'sqlite:///' + self.db_filepath
+        pages = load_fixture_pages()
+        # The Matrix -> Morgan Freeman -> Black Mirror -> Morgan Freeman
+        pages['/cast/tt0133093'] = (b'<div id="fullcredits-content">'
+                                    b'<a href="/name/nm0000151/">Morgan Freeman</a></div>')
+        pages['/cast/tt2085059'] = pages['/cast/tt0133093']
+        pages['/roles/nm0000151'] = (b'<div id="actor-tt2085059"></div>'
+                                     b'<div id="actor-tt0133093"></div>')
+        self.server = StandInServer(pages).__enter__()
+        self.saved = constants.url_base, constants.cast_url, constants.roles_url
+        constants.url_base = self.server.url
+        constants.cast_url = self.server.url + '/cast/{model_id}'
+        constants.roles_url = self.server.url + '/roles/{model_id}'
+
+    def test_expand(self):
+        matrix = self.build('/title/tt0133093')
+        database.store_model(matrix, self.db_uri)
+        stored = []
+        expansion = expand.Expansion(depth=2, on_model=stored.append, db_uri=self.db_uri)
+        expansion.run([matrix])
+
+        # Cast page, Freeman, his roles page and Black Mirror, each once.
+        assert expansion.pages == 4 and expansion.levels == 2
+        assert [m.id for m in stored] == ['nm0000151', 'tt2085059']
+        edges = expand.stored_edges(['nm0000151', 'tt2085059'], self.db_uri)
+        assert sorted(edges['nm0000151']) == ['tt0133093', 'tt2085059']
+        assert edges['tt2085059'] == ['nm0000151']
+        assert expand.complete_ids(['tt0133093', 'nm0000151', 'tt2085059'], self.db_uri) == \
+            set(['tt0133093', 'nm0000151'])
+
+        # A deeper run expands the complete models from the database.
+        requests = self.server.requests
+        expansion = expand.Expansion(depth=3, db_uri=self.db_uri)
+        expansion.run([database.get_cached_model('tt0133093', self.db_uri)])
+        assert expansion.pages == 1 and self.server.requests - requests == 1
+        assert 'tt2085059' in expand.complete_ids(['tt2085059'], self.db_uri)
+
+    def test_max_pages(self):
+        matrix = self.build('/title/tt0133093')
+        database.store_model(matrix, self.db_uri)
+        expansion = expand.Expansion(depth=5, max_pages=2, db_uri=self.db_uri)
+        expansion.run([matrix])
+        assert expansion.pages == 2 and expansion.levels == 1
+        assert database.get_cached_model('tt2085059', self.db_uri) is None
+
+    def build(self, path):
+        return factory.model_builder(self.server.pages[path].decode('utf-8'), self.db_uri)
+
+    def tearDown(self):
+        constants.url_base, constants.cast_url, constants.roles_url = self.saved
+        self.server.__exit__(None, None, None)
+        database.dispose_db(self.db_uri)
+        os.close(self.db_fd)
+        os.unlink(self.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import unittest
+import tempfile
+
+from lib import constants, crawl, database, factory, models, parser
+from lib.fetch import Fetcher
+from lib.tests.server import StandInServer
+
+class TestFetcher(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        cls.server = StandInServer().__enter__()
+
+    def test_fetch(self):
+        fetcher = Fetcher(concurrency=2)
+        urls = [self.server.url + path for path in self.server.pages]
+        results = dict(fetcher.fetch(urls + [self.server.url + '/title/tt0000000']))
+        fetcher.close()
+
+        assert set(results) == set(urls) | set([self.server.url + '/title/tt0000000'])
+        assert 'pageId" content="tt0133093"' in results[self.server.url + '/title/tt0133093']
+
+    def test_rate_limit(self):
+        fetcher = Fetcher(concurrency=4, rate_limit=1000)
+        urls = [self.server.url + '/title/tt0133093'] * 10
+        assert len(list(fetcher.fetch(urls))) == 10
+        fetcher.close()
+
+    def test_stream(self):
+        fetcher = Fetcher(concurrency=2, stream=True)
+        urls = [self.server.url + path for path in self.server.pages]
+        streamed = dict(fetcher.fetch(urls, model_pages=True))
+        full = dict(fetcher.fetch(urls))
+        fetcher.close()
+
+        for url in urls:
+            assert len(streamed[url]) < len(full[url])
+            assert parser.extract(streamed[url]) == parser.extract(full[url])
+            # Refreshing the full page later finds it unchanged.
+            assert factory.content_hash(streamed[url]) == factory.content_hash(full[url])
+        stats = fetcher.stream_stats
+        assert stats['pages'] == 3 and stats['stopped'] == 3
+        assert stats['bytes_saved'] > sum(len(s) for s in full.values()) / 2
+
+    def test_models_from_source(self):
+        url_base = constants.url_base
+        constants.url_base = self.server.url
+        try:
+            source = '<a href="/title/tt0133093/"></a> <a href="/name/nm0000151/"></a>'
+            found = list(crawl.models_from_source(source, self.db_uri))
+        finally:
+            constants.url_base = url_base
+        assert set(m.id for m in found) == set(['tt0133093', 'nm0000151'])
+        assert any(isinstance(m, models.Person) for m in found)
+
+    def test_models_from_json(self):
+        json_data = {'q': 'freeman', 'd': [{'id': 'tt0133093'}, {'id': 'nm0000151'},
+                                          {'id': 'tt0000000'}, {'id': 'tt2085059'}]}
+        url_base = constants.url_base
+        constants.url_base = self.server.url
+        try:
+            ordered = [m.id for m in crawl.models_from_json(json_data, self.db_uri, ordered=True)]
+            # The second search answers from the models stored by the first.
+            cached = [m.id for m in crawl.models_from_json(json_data, self.db_uri)]
+        finally:
+            constants.url_base = url_base
+        assert ordered == ['tt0133093', 'nm0000151', 'tt2085059']
+        assert cached == ordered
+        stored = set(m.id for m in database.get_search_results('freeman', self.db_uri))
+        assert stored == set(ordered)
+
+    def test_partial_search_results(self):
+        json_data = {'q': 'partial', 'd': [{'id': 'tt0133093'}, {'id': 'nm0000151'}]}
+        fd, filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + filepath
+        url_base, fetch_many = constants.url_base, crawl.fetch_many
+
+        def fetched_at():
+            db = database.get_db(db_uri)
+            try:
+                return db.query(models.SearchResult).get('partial').fetched_at
+            finally:
+                db.close()
+
+        def stored():
+            return set(m.id for m in database.get_search_results('partial', db_uri))
+
+        def flaky_fetch_many(urls, model_pages=False):
+            for url, source in fetch_many(urls, model_pages):
+                yield url, None if url.endswith('nm0000151') else source
+
+        constants.url_base = self.server.url
+        try:
+            crawl.fetch_many = flaky_fetch_many
+            assert [m.id for m in crawl.models_from_json(json_data, db_uri)] == \
+                ['tt0133093']
+            # Stored, but stale until a search gets every result.
+            assert stored() == set(['tt0133093']) and fetched_at() is None
+            crawl.fetch_many = fetch_many
+            assert len(list(crawl.models_from_json(json_data, db_uri))) == 2
+            stamp = fetched_at()
+            assert stored() == set(['tt0133093', 'nm0000151']) and stamp is not None
+
+            # A consumer which stops after the first result doesn't truncate the set.
+            json_data['d'].reverse()
+            results = crawl.models_from_json(json_data, db_uri, ordered=True)
+            assert next(results).id == 'nm0000151'
+            results.close()
+            assert stored() == set(['tt0133093', 'nm0000151']) and fetched_at() == stamp
+        finally:
+            constants.url_base, crawl.fetch_many = url_base, fetch_many
+            database.dispose_db(db_uri)
+            os.close(fd)
+            os.unlink(filepath)
+
+    def test_models_from_json_concurrent(self):
+        json_data = {'q': 'slow', 'd': [{'id': 'tt0133093'}, {'id': 'tt2085059'},
+                                       {'id': 'nm0000151'}]}
+        fd, filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + filepath
+        url_base = constants.url_base
+        with StandInServer(delay=0.3) as server:
+            constants.url_base = server.url
+            try:
+                found = list(crawl.models_from_json(json_data, db_uri))
+            finally:
+                constants.url_base = url_base
+                database.dispose_db(db_uri)
+                os.close(fd)
+                os.unlink(filepath)
+        assert len(found) == 3
+        # The pages were requested side by side, not one after another.
+        assert server.peak_in_flight >= 2
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
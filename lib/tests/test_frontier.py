@@ -0,0 +1,177 @@
+import os
+import unittest
+import tempfile
+
+from lib import constants, database, models
+from lib import frontier as frontier_module
+from lib.frontier import SeenSet, Frontier, Crawler, QUEUED, DONE, FAILED
+from lib.tests.server import StandInServer, load_fixture_pages
+
+class TestFrontier(unittest.TestCase):
+
+    def setUp(self):
+        self.frontier_fd, self.frontier_path = tempfile.mkstemp()
+
+    def test_seen_set(self):
+        seen = SeenSet()
+        assert seen.add('tt0133093') is True
+        assert seen.add('tt0133093') is False
+        assert seen.add('nm0133093') is True
+        assert 'tt0133093' in seen and 'tt0133094' not in seen and 'tt99999999' not in seen
+
+    def test_resume(self):
+        frontier = Frontier(self.frontier_path)
+        frontier.add(['tt0000001', 'nm0000002'])
+        frontier.add(['tt0000003'], priority=10)
+        assert frontier.add(['tt0000001']) == 0
+        assert frontier.pop(1) == [('tt0000003', 10)]
+        frontier.close()
+
+        # The identifier which was being crawled is queued again after a restart.
+        frontier = Frontier(self.frontier_path)
+        assert 'tt0000001' in frontier.seen
+        assert [i for i, _ in frontier.pop(10)] == ['tt0000003', 'tt0000001', 'nm0000002']
+        frontier.close()
+
+    def test_crawler(self):
+        db_fd, db_filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + db_filepath
+        pages = load_fixture_pages()
+        pages['/title/tt0133093/fullcredits/cast'] = (
+            b'<div id="fullcredits-content"><a href="/name/nm0000151/">Morgan Freeman</a></div>')
+        url_base, cast_url = constants.url_base, constants.cast_url
+        with StandInServer(pages) as server:
+            constants.url_base = server.url
+            constants.cast_url = server.url + '/title/{model_id}/fullcredits/cast'
+            try:
+                frontier = Frontier(self.frontier_path)
+                frontier.add(['tt0133093'], priority=100)
+                crawler = Crawler(frontier, batch_size=1000, with_roles=False, db_uri=db_uri)
+                assert crawler.step() == 1
+                assert crawler.step() > 1
+                frontier.close()
+            finally:
+                constants.url_base, constants.cast_url = url_base, cast_url
+
+        db = database.get_db(db_uri)
+        movie = db.query(models.Movie).get('tt0133093')
+        assert [p.id for p in movie.actors] == ['nm0000151']
+        db.close()
+        database.dispose_db(db_uri)
+        os.close(db_fd)
+        os.unlink(db_filepath)
+
+    def test_redirected_id(self):
+        db_fd, db_filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + db_filepath
+        pages = load_fixture_pages()
+        # A merged identifier whose page is the one of The Matrix.
+        pages['/title/tt0000099'] = pages['/title/tt0133093']
+        pages['/title/tt0133093/fullcredits/cast'] = (
+            b'<div id="fullcredits-content"><a href="/name/nm0000151/">Morgan Freeman</a></div>')
+        url_base, cast_url = constants.url_base, constants.cast_url
+        with StandInServer(pages) as server:
+            constants.url_base = server.url
+            constants.cast_url = server.url + '/title/{model_id}/fullcredits/cast'
+            try:
+                frontier = Frontier(self.frontier_path)
+                frontier.add(['tt0000099'], priority=100)
+                # An edge found before, waiting for the merged identifier.
+                frontier.add_edges([('tt0000099', 'tt0000099', 'nm0000151')])
+                crawler = Crawler(frontier, batch_size=1000, with_roles=False, db_uri=db_uri)
+                assert crawler.step() == 1
+                state = frontier.db.execute('SELECT state FROM frontier WHERE id = ?',
+                                            ('tt0000099',)).fetchone()[0]
+                assert state == DONE
+                assert frontier.db.execute('SELECT priority FROM frontier WHERE id = ?',
+                                           ('nm0000151',)).fetchone()[0] == 99
+                assert crawler.step() > 0
+                frontier.close()
+            finally:
+                constants.url_base, constants.cast_url = url_base, cast_url
+
+        db = database.get_db(db_uri)
+        assert db.query(models.Movie).get('tt0000099') is None
+        assert [p.id for p in db.query(models.Movie).get('tt0133093').actors] == ['nm0000151']
+        db.close()
+        database.dispose_db(db_uri)
+        os.close(db_fd)
+        os.unlink(db_filepath)
+
+    def test_resume_expansion(self):
+        db_fd, db_filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + db_filepath
+        pages = load_fixture_pages()
+        pages['/title/tt0133093/fullcredits/cast'] = (
+            b'<div id="fullcredits-content"><a href="/name/nm0000151/">Morgan Freeman</a></div>')
+        # Stored by a crawler which stopped while fetching the cast.
+        with database.WriteBuffer(db_uri) as buffer:
+            buffer.add_model(models.Movie(id='tt0133093', title='The Matrix', poster=None,
+                                          rating=8.7, plot='Neo.', duration='136 min',
+                                          release_year=1999, genres=[]))
+        url_base, cast_url = constants.url_base, constants.cast_url
+        with StandInServer(pages) as server:
+            constants.url_base = server.url
+            constants.cast_url = server.url + '/title/{model_id}/fullcredits/cast'
+            try:
+                frontier = Frontier(self.frontier_path)
+                frontier.add(['tt0133093'], priority=100)
+                crawler = Crawler(frontier, batch_size=1000, with_roles=False, db_uri=db_uri)
+                assert crawler.step() == 1
+                assert 'nm0000151' in frontier.seen
+                assert crawler.step() == 1
+                states = dict(frontier.db.execute('SELECT id, state FROM frontier'))
+                assert states['tt0133093'] == states['nm0000151'] == DONE
+                frontier.close()
+            finally:
+                constants.url_base, constants.cast_url = url_base, cast_url
+
+        db = database.get_db(db_uri)
+        assert [p.id for p in db.query(models.Movie).get('tt0133093').actors] == ['nm0000151']
+        db.close()
+        database.dispose_db(db_uri)
+        os.close(db_fd)
+        os.unlink(db_filepath)
+
+    def test_unreachable(self):
+        db_fd, db_filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + db_filepath
+        url_base, fetch_many = constants.url_base, frontier_module.fetch_many
+
+        def flaky_fetch_many(urls, model_pages=False):
+            for url, source in fetch_many(urls, model_pages):
+                yield url, None if url.endswith('tt2085059') else source
+
+        with StandInServer() as server:
+            constants.url_base = server.url
+            frontier_module.fetch_many = flaky_fetch_many
+            try:
+                frontier = Frontier(self.frontier_path)
+                frontier.add(['tt0133093', 'tt2085059', 'tt0000001'], priority=100)
+                crawler = Crawler(frontier, batch_size=3, with_cast=False, with_roles=False,
+                                  retry_delay=0, db_uri=db_uri)
+                assert crawler.step() == 3
+                rows = dict((row[0], row[1:]) for row in frontier.db.execute(
+                    'SELECT id, state, priority, attempts FROM frontier'))
+                # A failed transfer is tried again later, a page which isn't a model isn't.
+                assert rows['tt0133093'] == (DONE, 100, 0)
+                assert rows['tt2085059'] == (QUEUED, 99, 1)
+                assert rows['tt0000001'][0] == FAILED
+                frontier.retry(['tt2085059'], max_attempts=2)
+                assert frontier.counts()['failed'] == 2
+                frontier.close()
+            finally:
+                constants.url_base, frontier_module.fetch_many = url_base, fetch_many
+        database.dispose_db(db_uri)
+        os.close(db_fd)
+        os.unlink(db_filepath)
+
+    def tearDown(self):
+        os.close(self.frontier_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.frontier_path + suffix):
+                os.unlink(self.frontier_path + suffix)
+
+
+if __name__ == '__main__':
+    unittest.main()
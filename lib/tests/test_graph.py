@@ -0,0 +1,92 @@
+import os
+import unittest
+import tempfile
+
+from lib import database, graph as graph_module, models
+from lib.graph import CastGraph
+
+def person(number):
+    return models.Person(id='nm{:07d}'.format(number), firstname='Person')
+
+def movie(number):
+    return models.Movie(id='tt{:07d}'.format(number), title='Movie', poster=None, rating=None,
+                        plot=None, duration=None, release_year=None, genres=[])
+
+class TestGraph(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        # nm1 - tt1 - nm2 - tt2 - nm3 - tt3 - nm4, with a shortcut nm1 - tt4 - nm3.
+        # nm5 only played in tt5.
+        casts = {1: [1, 2], 2: [2, 3], 3: [3, 4], 4: [1, 3], 5: [5]}
+        with database.WriteBuffer(cls.db_uri) as buffer:
+            for p in range(1, 6):
+                buffer.add_model(person(p))
+            shows = models.TVShow(id='tt0000005', title='Show', poster=None, rating=None,
+                                  plot=None, release_year=None, genres=[])
+            for t, cast in casts.items():
+                title = shows if t == 5 else movie(t)
+                buffer.add_model(title)
+                for p in cast:
+                    buffer.add_cast_member(title, person(p))
+        cls.graph = CastGraph.from_db(cls.db_uri)
+
+    def test_lookups(self):
+        assert len(self.graph) == 9
+        assert self.graph.titles_of('nm0000001') == ['tt0000001', 'tt0000004']
+        assert self.graph.cast_of('tt0000005') == ['nm0000005']
+        assert self.graph.costars('nm0000003') == [
+            ('nm0000001', 1), ('nm0000002', 1), ('nm0000004', 1)]
+        assert self.graph.costars('nm0000009') == []
+
+    def test_shortest_path(self):
+        assert self.graph.shortest_path('nm0000001', 'nm0000004') == \
+            ['nm0000001', 'tt0000004', 'nm0000003', 'tt0000003', 'nm0000004']
+        assert self.graph.shortest_path('nm0000004', 'nm0000001', max_degrees=1) is None
+        assert len(self.graph.shortest_path('nm0000004', 'nm0000001', max_degrees=2)) == 5
+        assert self.graph.shortest_path('nm0000001', 'nm0000005') is None
+        assert self.graph.shortest_path('nm0000002', 'nm0000002') == ['nm0000002']
+
+    def test_neighbourhood(self):
+        assert self.graph.neighbourhood('nm0000004', 1) == {
+            'nm0000004': 0, 'tt0000003': 1, 'nm0000003': 1}
+        around = self.graph.neighbourhood('nm0000004', 2)
+        assert around['nm0000001'] == 2 and around['tt0000004'] == 2
+        assert 'nm0000005' not in around
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.graph.save(path)
+            graph = CastGraph.load(path)
+            assert graph.costars('nm0000003') == self.graph.costars('nm0000003')
+            assert graph.shortest_path('nm0000001', 'nm0000004') == \
+                self.graph.shortest_path('nm0000001', 'nm0000004')
+            graph.close()
+
+            # The arrays are copied where memory can't be viewed as integers (Python 2).
+            saved, graph_module.memoryview_cast = graph_module.memoryview_cast, False
+            try:
+                graph = CastGraph.load(path)
+            finally:
+                graph_module.memoryview_cast = saved
+            assert graph.snapshot is None and list(graph.people) == list(self.graph.people)
+            assert graph.costars('nm0000003') == self.graph.costars('nm0000003')
+            with open(path, 'wb') as f:
+                f.write(b'not a graph' * 10)
+            self.assertRaises(ValueError, CastGraph.load, path)
+        finally:
+            os.unlink(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import unittest
+import tempfile
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from lib import crawl, database, factory, metrics, models, pagecache, parser
+from lib.fetch import Fetcher
+from lib.profiling import SamplingProfiler
+from lib.tests.server import StandInServer, here
+
+def figures(registry, kind, name):
+    return dict((tuple(sorted(f['labels'].items())), f)
+                for f in registry.snapshot()[kind] if f['name'] == name)
+
+class TestMetrics(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer().__enter__()
+
+    def setUp(self):
+        pagecache.disable()
+        self.registry = metrics.enable()
+
+    def test_disabled(self):
+        metrics.disable()
+        metrics.incr('fetch_bytes', 10)
+        with metrics.timer('db_commit_seconds'):
+            pass
+        assert metrics.get_registry() is None
+
+    def test_fetch(self):
+        crawl.process_url(self.server.url + '/title/tt0133093')
+        fetcher = Fetcher(concurrency=2)
+        list(fetcher.fetch([self.server.url + '/name/nm0000151',
+                            self.server.url + '/title/tt0000000']))
+        fetcher.close()
+
+        requests = figures(self.registry, 'counters', 'fetch_requests')
+        assert requests[(('status', 200),)]['value'] == 2
+        assert requests[(('status', 404),)]['value'] == 1
+        assert figures(self.registry, 'counters', 'fetch_bytes')[()]['value'] > 10000
+        for phase in ('dns', 'connect', 'ttfb', 'transfer', 'total'):
+            assert figures(self.registry, 'timers', 'fetch_{}_seconds'.format(phase))[()] \
+                ['count'] == 3
+
+    def test_parse(self):
+        with open(os.path.join(here, 'files', 'the_matrix.html')) as f:
+            source = f.read()
+        fd, filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + filepath
+        try:
+            factory.model_builder(source, db_uri)
+            assert factory.model_builder(source.replace('og:title', 'og:tilte'), db_uri) is None
+        finally:
+            database.dispose_db(db_uri)
+            os.close(fd)
+            os.unlink(filepath)
+        fields = figures(self.registry, 'timers', 'parse_field_seconds')
+        assert fields[(('field', 'title'),)]['count'] == 2
+        assert fields[(('field', 'genres'),)]['count'] == 1
+        failures = figures(self.registry, 'counters', 'parse_failures')
+        assert list(failures) == [(('field', 'title'),)]
+        assert figures(self.registry, 'counters', 'build_failures')[()]['value'] == 1
+        assert figures(self.registry, 'timers', 'build_seconds')[(('model_type', 'movie'),)]
+
+    def test_database(self):
+        fd, filepath = tempfile.mkstemp()
+        db_uri = 'sqlite:///' + filepath
+        try:
+            with database.WriteBuffer(db_uri) as buffer:
+                buffer.add_model(models.Person(id='nm0000151', firstname='Morgan'))
+            database.get_cached_models(['nm0000152'], db_uri)
+        finally:
+            database.dispose_db(db_uri)
+            os.close(fd)
+            os.unlink(filepath)
+        queries = figures(self.registry, 'timers', 'db_query_seconds')
+        assert queries[(('kind', 'INSERT'),)]['count'] >= 1
+        assert queries[(('kind', 'SELECT'),)]['count'] >= 1
+        assert figures(self.registry, 'timers', 'db_commit_seconds')[()]['count'] >= 1
+        assert figures(self.registry, 'counters', 'db_rows_written')[()]['value'] == 1
+
+    def test_sinks(self):
+        metrics.incr('fetch_requests', status=200)
+        metrics.observe('fetch_total_seconds', 0.5)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.JSONLinesSink(self.registry, path, interval=60).close()
+            with open(path) as f:
+                snapshot = json.loads(f.readline())
+            assert snapshot['counters'][0]['labels'] == {'status': 200}
+        finally:
+            os.unlink(path)
+
+        sink = metrics.PrometheusSink(self.registry, port=0)
+        try:
+            text = urlopen(sink.url).read().decode('utf-8')
+        finally:
+            sink.close()
+        assert '# TYPE imdbooo_fetch_requests_total counter' in text
+        assert 'imdbooo_fetch_requests_total{status="200"} 1' in text
+        assert 'imdbooo_fetch_total_seconds_count 1' in text
+
+    def test_sampling_profiler(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            profiler = SamplingProfiler(path, interval=0.001).start()
+            end = time.time() + 0.1
+            while time.time() < end:
+                parser.model_ids('<a href="/title/tt0133093/">')
+            profiler.stop()
+            with open(path) as f:
+                assert 'test_metrics:test_sampling_profiler' in f.read()
+        finally:
+            os.unlink(path)
+
+    def tearDown(self):
+        metrics.disable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import unittest
+import tempfile
+
+from lib import crawl, pagecache
+from lib.fetch import Fetcher
+from lib.tests.server import StandInServer
+
+class TestPageCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer().__enter__()
+        cls.url = cls.server.url + '/title/tt0133093'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_hit_and_revalidation(self):
+        cache = pagecache.configure(self.directory)
+        source = crawl.process_url(self.url)
+        assert crawl.process_url(self.url) == source
+        assert cache.stats['misses'] == 1 and cache.stats['hits'] == 1
+
+        cache.ttl = 0
+        requests = self.server.requests
+        assert crawl.process_url(self.url) == source
+        assert cache.stats['revalidated'] == 1
+        assert self.server.requests == requests + 1
+
+    def test_vanished_body(self):
+        cache = pagecache.configure(self.directory, ttl=0)
+        source = crawl.process_url(self.url)
+        fetcher = Fetcher(concurrency=2)
+        for fetch in (crawl.process_url, lambda url: dict(fetcher.fetch([url]))[url]):
+            # Another process evicts the body while the entry is revalidated.
+            shutil.rmtree(os.path.join(self.directory, 'blobs'))
+            cache.total_bytes = None
+            requests = self.server.requests
+            assert fetch(self.url) == source
+            # The 304 is followed by an unconditional request.
+            assert self.server.requests == requests + 2
+            assert cache.read(cache.get(self.url)) == source.encode('utf-8')
+        fetcher.close()
+        assert cache.stats['revalidated'] == 0
+
+    def test_offline(self):
+        pagecache.configure(self.directory)
+        source = crawl.process_url(self.url)
+        cache = pagecache.configure(self.directory, offline=True)
+        requests = self.server.requests
+        assert crawl.process_url(self.url) == source
+        assert crawl.process_url(self.server.url + '/name/nm0000151') == ''
+        assert self.server.requests == requests
+        assert cache.stats['misses'] == 1
+
+    def test_fetcher(self):
+        cache = pagecache.configure(self.directory)
+        fetcher = Fetcher(concurrency=2)
+        urls = [self.server.url + path for path in self.server.pages]
+        first = dict(fetcher.fetch(urls))
+        assert dict(fetcher.fetch(urls)) == first
+        fetcher.close()
+        assert cache.stats['hits'] == len(urls)
+
+    def test_eviction(self):
+        cache = pagecache.configure(self.directory, max_bytes=1)
+        crawl.process_url(self.url)
+        assert cache.stats['evicted'] == 1
+        assert cache.get(self.url) is None
+
+    def tearDown(self):
+        pagecache.disable()
+        shutil.rmtree(self.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,8 @@ import os
 
 import unittest
 
-from lib import models, factory
-from lib.database import get_db
+from lib import models, factory, parser
+from lib.database import get_db, store_model
 
 class TestModelFactory(unittest.TestCase):
 
@@ -18,6 +18,15 @@ class TestModelFactory(unittest.TestCase):
             movie_source = f.read()
         movie = factory.model_builder(movie_source, self.db_uri)
         assert isinstance(movie, models.Movie) == True
+        assert [g.name for g in movie.genres] == ['Action', 'Sci-Fi']
+
+    def test_genres_are_stored(self):
+        with open(os.path.join(self.here, 'files', 'black_mirror.html')) as f:
+            tvshow_source = f.read()
+        tvshow = factory.model_builder(tvshow_source, self.db_uri)
+        assert store_model(tvshow, self.db_uri) is True
+        genres = self.db_session.query(models.TVShow).get(tvshow.id).genres
+        assert sorted(g.name for g in genres) == ['Drama', 'Sci-Fi', 'Thriller']
 
     def test_tvshow_builder(self):
         with open(os.path.join(self.here, 'files', 'black_mirror.html')) as f:
@@ -31,6 +40,28 @@ class TestModelFactory(unittest.TestCase):
         person = factory.model_builder(person_source)
         assert isinstance(person, models.Person) == True
 
+    def test_extract(self):
+        with open(os.path.join(self.here, 'files', 'the_matrix.html')) as f:
+            movie_source = f.read()
+        record = parser.extract(movie_source)
+        assert record['id'] == parser.model_id(movie_source)
+        assert record['title'] == parser.title(movie_source)
+        assert record['duration'] == parser.duration(movie_source)
+        assert record['plot'] == parser.plot(movie_source)
+        assert record['rating'] == parser.rating(movie_source)
+        assert record['genres'] == parser.genres(movie_source)
+
+    def test_credits(self):
+        source = ('<a href="/name/nm0000001/">Header</a><div id="fullcredits-content"><table>'
+                  '<tr><td><a href="/name/nm0000206/"><img src="k.jpg"></a></td>'
+                  '<td><a href="/name/nm0000206/">Keanu Reeves</a></td>'
+                  '<td class="character"> <a href="/title/tt0133093/characters/">Neo</a></td></tr>'
+                  '<tr><td><a href="/name/nm0000401/">Laurence Fishburne</a><br/></td></tr>'
+                  '</table></div><a href="/name/nm0000002/">Footer</a>')
+        assert parser.credits(source) == [(1, 'nm0000206', 'Neo'), (2, 'nm0000401', None)]
+        assert parser.cast(source) == ['nm0000206', 'nm0000401']
+        assert parser.cast('<div id="content"></div>') == []
+
     @classmethod
     def tearDownClass(cls):
         cls.db_session.close()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+import tempfile
+
+from lib import constants, database, models
+from lib.tests.server import StandInServer, load_fixture_pages
+
+@unittest.skipIf(sys.version_info < (3, 5), 'The pipeline requires asyncio and async/await')
+class TestPipeline(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        pages = load_fixture_pages()
+        pages['/title/tt0133093/fullcredits/cast'] = (
+            b'<div id="fullcredits-content"><a href="/name/nm0000151/">Morgan Freeman</a></div>')
+        cls.server = StandInServer(pages).__enter__()
+
+    def test_run_source(self):
+        from lib.pipeline import Pipeline
+
+        url_base, cast_url = constants.url_base, constants.cast_url
+        constants.url_base = self.server.url
+        constants.cast_url = self.server.url + '/title/{model_id}/fullcredits/cast'
+        found = []
+        try:
+            pipeline = Pipeline(on_model=found.append, with_roles=False, db_uri=self.db_uri)
+            pipeline.run_source('<a href="/title/tt0133093/"></a>')
+        finally:
+            constants.url_base, constants.cast_url = url_base, cast_url
+
+        assert [m.id for m in found] == ['tt0133093']
+        assert pipeline.stats['fetch'].processed == 3
+        assert pipeline.stats['persist'].failed == 0
+
+        db = database.get_db(self.db_uri)
+        movie = db.query(models.Movie).get('tt0133093')
+        assert [p.id for p in movie.actors] == ['nm0000151']
+        db.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import time
+import unittest
+
+import pycurl
+
+from lib import crawl, policy
+from lib.fetch import Fetcher
+from lib.policy import FetchPolicy, TokenBucket, parse_retry_after
+from lib.tests.server import StandInServer, Faults
+
+def quick_policy(**kwargs):
+    """A policy with short waits, so the tests don't idle."""
+    settings = dict(backoff=0.01, max_backoff=0.05, connect_timeout=2, timeout=5,
+                    breaker_cooldown=60)
+    settings.update(kwargs)
+    return FetchPolicy(**settings)
+
+
+class TestPolicy(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        for _ in range(2):
+            assert bucket.delay(100.0) == 0
+            bucket.take(100.0)
+        assert abs(bucket.delay(100.0) - 0.1) < 1e-9
+        assert bucket.delay(100.2) == 0
+        assert TokenBucket().delay(100.0) == 0
+
+    def test_retry_after(self):
+        assert parse_retry_after('7') == 7
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470) == 10
+        assert parse_retry_after('soon') is None and parse_retry_after(None) is None
+
+    def test_backoff(self):
+        fetch_policy = quick_policy(retries=3, backoff=1, max_backoff=3)
+        url = 'http://example.invalid/title/tt0133093'
+        assert 0.5 <= fetch_policy.outcome(url, 0, status=500, now=0) <= 1
+        assert 1 <= fetch_policy.outcome(url, 1, error=28, now=0) <= 2
+        assert 1.5 <= fetch_policy.outcome(url, 2, status=502, now=0) <= 3
+        # Out of retries, and answers which aren't worth retrying.
+        assert fetch_policy.outcome(url, 3, status=500, now=0) is None
+        assert fetch_policy.outcome(url, 0, status=404, now=0) is None
+        assert fetch_policy.outcome(url, 0, error=6, now=0) is None
+        # Retry-After wins over a shorter backoff, one beyond the limit isn't waited for.
+        assert fetch_policy.outcome(url, 0, status=429, headers={'retry-after': '20'},
+                                    now=0) == 20
+        assert fetch_policy.outcome(url, 0, status=429, headers={'retry-after': '9999'},
+                                    now=0) is None
+
+    def test_adaptive_rate(self):
+        fetch_policy = quick_policy(rate=8, min_rate=1)
+        url = 'http://example.invalid/'
+        fetch_policy.outcome(url, 0, status=429, started_at=0, now=1)
+        state = fetch_policy.hosts['example.invalid']
+        assert state.bucket.rate == 4
+        # Requests started before the decrease don't halve the rate again.
+        fetch_policy.outcome(url, 0, status=429, started_at=0.5, now=1.5)
+        assert state.bucket.rate == 4
+        # A lone server error isn't pushback.
+        fetch_policy.outcome(url, 0, status=503, started_at=1.2, now=1.5)
+        assert state.bucket.rate == 4
+        fetch_policy.outcome(url, 0, status=503, headers={'retry-after': '1'}, started_at=1.2,
+                             now=1.5)
+        assert state.bucket.rate == 2
+        for i in range(100):
+            fetch_policy.outcome(url, 0, status=200, now=2 + i)
+        assert state.bucket.rate == 8
+
+        # An unthrottled host starts from the rate it was fetched at.
+        unlimited = quick_policy(min_rate=1)
+        for i in range(10):
+            unlimited.started(url, now=i * 0.05)
+        unlimited.outcome(url, 0, status=429, now=0.5)
+        assert abs(unlimited.hosts['example.invalid'].bucket.rate - 10) < 1e-9
+
+    def test_circuit_breaker(self):
+        fetch_policy = quick_policy(breaker_threshold=2, breaker_cooldown=10)
+        url = 'http://example.invalid/'
+        fetch_policy.outcome(url, 0, error=7, now=0)
+        assert fetch_policy.delay(url, now=0) == 0
+        # The failure which opens the circuit isn't retried.
+        assert fetch_policy.outcome(url, 0, error=7, now=0) is None
+        assert fetch_policy.delay(url, now=5) is None
+        # After the cooldown a single probe goes through.
+        assert fetch_policy.delay(url, now=10) == 0
+        fetch_policy.started(url, now=10)
+        assert fetch_policy.delay(url, now=10) > 0
+        fetch_policy.outcome(url, 0, status=200, now=10.5)
+        assert fetch_policy.delay(url, now=10.5) == 0
+        assert fetch_policy.stats['breaker_opened'] == 1
+
+
+class TestFaults(unittest.TestCase):
+
+    def test_retries(self):
+        faults = Faults({'/title/tt0133093': ['reset', 503, 500],
+                         '/name/nm0000151': [429]}, retry_after=0)
+        with StandInServer(faults=faults) as server:
+            fetcher = Fetcher(concurrency=2, policy=quick_policy(retries=3))
+            urls = [server.url + '/title/tt0133093', server.url + '/name/nm0000151']
+            results = dict(fetcher.fetch(urls))
+            fetcher.close()
+            assert all(results[url] for url in urls)
+            assert server.requests == 6
+            assert fetcher.policy.stats['retries'] == 4
+
+            # Given up once the retries are spent.
+            faults.script['/title/tt2085059'] = [500, 500]
+            fetcher = Fetcher(concurrency=2, policy=quick_policy(retries=1))
+            assert list(fetcher.fetch([server.url + '/title/tt2085059'])) == \
+                [(server.url + '/title/tt2085059', None)]
+            fetcher.close()
+
+    def test_timeout(self):
+        faults = Faults({'/title/tt0133093': [('stall', 2)]})
+        with StandInServer(faults=faults) as server:
+            fetcher = Fetcher(concurrency=2, policy=quick_policy(timeout=0.3))
+            started = time.time()
+            results = dict(fetcher.fetch([server.url + '/title/tt0133093']))
+            fetcher.close()
+            assert results[server.url + '/title/tt0133093']
+            assert time.time() - started < 1.5
+            assert fetcher.policy.stats['timeouts'] == 1
+
+    def test_circuit_breaker(self):
+        faults = Faults(error_rate=1, statuses=(500,))
+        with StandInServer(faults=faults) as server:
+            fetcher = Fetcher(concurrency=1, policy=quick_policy(retries=0,
+                                                                 breaker_threshold=2))
+            urls = [server.url + path for path in server.pages] * 3
+            results = list(fetcher.fetch(urls))
+            fetcher.close()
+            assert len(results) == 9 and not any(source for _, source in results)
+            # The circuit opened after two failures, the others were never requested.
+            assert server.requests == 2
+            assert fetcher.policy.stats['rejected'] == 7
+
+    def test_throttling(self):
+        faults = Faults(max_rate=20)
+        with StandInServer(faults=faults) as server:
+            fetcher = Fetcher(concurrency=8, policy=quick_policy(retries=8))
+            urls = [server.url + '/title/tt0133093'] * 60
+            results = list(fetcher.fetch(urls))
+            fetcher.close()
+        assert all(source for _, source in results)
+        assert fetcher.policy.stats['throttled'] > 0
+        rate = fetcher.policy.hosts[policy.host_of(server.url)].bucket.rate
+        assert rate is not None and rate < 40
+
+    def test_process_url(self):
+        faults = Faults({'/title/tt0133093': [502]}, retry_after=0)
+        saved = policy._default_policy
+        policy._default_policy = quick_policy()
+        try:
+            with StandInServer(faults=faults) as server:
+                assert 'tt0133093' in crawl.process_url(server.url + '/title/tt0133093')
+                assert server.requests == 2
+                faults.script['/title/tt2085059'] = [('stall', 2)]
+                policy._default_policy = quick_policy(retries=0, timeout=0.3)
+                self.assertRaises(pycurl.error, crawl.process_url,
+                                  server.url + '/title/tt2085059')
+                # An error page is no page once the retries are spent.
+                faults.script['/name/nm0000151'] = [503, 503]
+                policy._default_policy = quick_policy(retries=1)
+                self.assertRaises(pycurl.error, crawl.process_url, server.url + '/name/nm0000151')
+        finally:
+            policy._default_policy = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import unittest
+import tempfile
+
+from lib import database, models, records
+
+class TestRecords(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        cls.matrix = models.Movie(id='tt0133093', title='The Matrix', poster=None, rating=8.7,
+                                  plot='Neo.', duration='136 min', release_year=1999, genres=[])
+        cls.mirror = models.TVShow(id='tt2085059', title='Black Mirror', poster=None,
+                                   rating=8.9, plot='Tech.', release_year=2011, genres=[])
+        cls.freeman = models.Person(id='nm0000151', firstname='Morgan', lastname='Freeman')
+        with database.WriteBuffer(cls.db_uri) as buffer:
+            for model in (cls.matrix, cls.mirror, cls.freeman):
+                buffer.add_model(model)
+        database.store_search_results('q', [cls.matrix, cls.mirror, cls.freeman], cls.db_uri)
+
+    def test_search_result_records(self):
+        found = list(records.search_result_records('q', self.db_uri))
+        assert found == [
+            records.PersonRecord('nm0000151', 'Morgan', None, 'Freeman'),
+            records.TitleRecord('tt0133093', 'The Matrix', 1999, 'Neo.', None, 8.7),
+            records.TitleRecord('tt2085059', 'Black Mirror', 2011, 'Tech.', None, 8.9),
+        ]
+        assert [m.id for m in database.get_search_results('q', self.db_uri)] == \
+            [r.id for r in found]
+        assert list(records.search_result_records('unknown', self.db_uri)) == []
+
+    def test_model_records(self):
+        found = records.model_records(['tt0133093', 'nm0000151', 'tt0000000'], self.db_uri)
+        assert set(found) == set(['tt0133093', 'nm0000151'])
+        assert found['tt0133093'].title == 'The Matrix'
+        assert found['nm0000151'].lastname == 'Freeman'
+
+    @classmethod
+    def tearDownClass(cls):
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
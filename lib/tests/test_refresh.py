@@ -0,0 +1,77 @@
+import os
+import time
+import unittest
+import tempfile
+
+from lib import constants, crawl, database, pagecache, refresh, search
+from lib.tests.server import StandInServer
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.db_fd, self.db_filepath = tempfile.mkstemp()
+        self.db_uri = 'sqlite:///' + self.db_filepath
+        self.server = StandInServer().__enter__()
+        self.url_base = constants.url_base
+        constants.url_base = self.server.url
+        pagecache.disable()
+        source = ' '.join('<a href="{}/"></a>'.format(path) for path in self.server.pages)
+        assert len(list(crawl.models_from_source(source, self.db_uri))) == 3
+        search.has_fts(self.db_uri)
+
+    def test_stamped(self):
+        movie = database.get_cached_model('tt0133093', self.db_uri)
+        assert len(movie.content_hash) == 40 and time.time() - movie.fetched_at < 60
+
+    def test_candidates(self):
+        self.set_fetched_at('tt0133093', 10)
+        self.set_fetched_at('nm0000151', None)
+        oldest = [model_id for _, model_id, _ in refresh.candidates(2, db_uri=self.db_uri)]
+        assert oldest == ['nm0000151', 'tt0133093']
+        # Only models fetched longer ago than max_age.
+        recent = refresh.candidates(10, max_age=3600, db_uri=self.db_uri)
+        assert set(model_id for _, model_id, _ in recent) == set(['nm0000151', 'tt0133093'])
+
+        database.store_cast_member(database.get_cached_model('tt2085059', self.db_uri),
+                                   database.get_cached_model('nm0000151', self.db_uri),
+                                   self.db_uri)
+        popular = refresh.candidates(2, 'popular', db_uri=self.db_uri)
+        assert set(model_id for _, model_id, _ in popular) == set(['tt2085059', 'nm0000151'])
+
+    def test_refresh(self):
+        for model_id in ('tt0133093', 'tt2085059', 'nm0000151'):
+            self.set_fetched_at(model_id, 10)
+        matrix = self.server.pages['/title/tt0133093']
+        self.server.pages['/title/tt0133093'] = matrix.replace(
+            b'vertically-middle">8.7<small', b'vertically-middle">9.1<small')
+        requests = self.server.requests
+
+        stats = refresh.refresh(2, db_uri=self.db_uri)
+        assert self.server.requests - requests == 2
+        assert stats['checked'] == 2 and stats['failed'] == 0
+        assert stats['updated'] == 1 and stats['columns'] == {'rating': 1}
+
+        movie = database.get_cached_model('tt0133093', self.db_uri)
+        assert movie.rating == 9.1 and movie.title == 'The Matrix' and movie.fetched_at > 10
+        assert search.search_ids('matrix', db_uri=self.db_uri) == ['tt0133093']
+
+        # The one left over is due next; its page is unchanged.
+        stats = refresh.refresh(10, max_age=3600, db_uri=self.db_uri)
+        assert stats['checked'] == 1 and stats['unchanged'] == 1 and stats['updated'] == 0
+
+    def set_fetched_at(self, model_id, fetched_at):
+        for model in database.model_classes(model_id):
+            with database.session_scope(self.db_uri) as db:
+                db.query(model).filter(model.id == model_id).update({'fetched_at': fetched_at})
+        database.forget_models([model_id], self.db_uri)
+
+    def tearDown(self):
+        constants.url_base = self.url_base
+        self.server.__exit__(None, None, None)
+        database.dispose_db(self.db_uri)
+        os.close(self.db_fd)
+        os.unlink(self.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
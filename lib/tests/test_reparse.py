@@ -0,0 +1,59 @@
+import os
+import shutil
+import unittest
+import tempfile
+
+from lib import database, models, pagecache, reparse, search
+from lib.tests.server import load_fixture_pages
+
+class TestReparse(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_fd, self.db_filepath = tempfile.mkstemp()
+        self.db_uri = 'sqlite:///' + self.db_filepath
+        self.cache = pagecache.PageCache(self.directory)
+        for path, body in load_fixture_pages().items():
+            self.cache.put('http://www.imdb.com' + path, body)
+        # Not a model page, must be skipped.
+        self.cache.put('http://www.imdb.com/title/tt0133093/fullcredits', b'<html></html>')
+
+    def test_parse_page(self):
+        entry = self.cache.get('http://www.imdb.com/title/tt0133093')
+        row = reparse.parse_page(self.cache._blob_path(entry['content']))
+        assert row[:3] == ('movie', 'tt0133093', 'The Matrix')
+        assert reparse.parse_page(os.path.join(self.directory, 'missing.z')) is None
+
+    def test_reparse(self):
+        # A row derived by an older parser which has to be overwritten.
+        database.store_model(models.Movie(id='tt0133093', title='The Matrx', poster=None,
+                                          rating=None, plot=None, duration=None,
+                                          release_year=None, genres=[]), self.db_uri)
+        search.has_fts(self.db_uri)
+        stats = reparse.reparse(self.cache, self.db_uri, processes=2, chunk_size=1)
+        assert stats['pages'] == 3 and stats['stored'] == 3 and stats['failed'] == 0
+
+        movie = database.get_cached_model('tt0133093', self.db_uri)
+        assert movie.title == 'The Matrix' and movie.release_year == 1999
+        assert self.genres('tt0133093') == ['Action', 'Sci-Fi']
+        assert database.get_cached_model('tt2085059', self.db_uri).title == 'Black Mirror'
+        assert database.get_cached_model('nm0000151', self.db_uri).lastname == 'Freeman'
+        assert search.search_ids('matrix', db_uri=self.db_uri) == ['tt0133093']
+
+        # Running it again changes nothing.
+        assert reparse.reparse(self.cache, self.db_uri, processes=1)['stored'] == 3
+        assert self.genres('tt0133093') == ['Action', 'Sci-Fi']
+
+    def genres(self, title_id):
+        with database.session_scope(self.db_uri) as db:
+            return sorted(g.name for g in db.query(models.Movie).get(title_id).genres)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        database.dispose_db(self.db_uri)
+        os.close(self.db_fd)
+        os.unlink(self.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
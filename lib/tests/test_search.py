@@ -0,0 +1,53 @@
+import os
+import unittest
+import tempfile
+
+from lib import database, models, search
+
+class TestSearch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        # Stored before the index exists, has to be picked up when it gets created.
+        database.store_model(models.Movie(id='tt0133093', title='The Matrix', poster=None,
+                                          rating=8.7, plot='A computer hacker learns about '
+                                          'the true nature of reality.', duration='136 min',
+                                          release_year=1999, genres=[]), cls.db_uri)
+        search.has_fts(cls.db_uri)
+        with database.WriteBuffer(cls.db_uri) as buffer:
+            buffer.add_model(models.Person(id='nm0000151', firstname='Morgan',
+                                           lastname='Freeman'))
+            buffer.add_model(models.Movie(id='tt0000001', title='Hackers', poster=None,
+                                          rating=6.2, plot='Teenage hackers and a matrix.',
+                                          duration=None, release_year=1995, genres=[]))
+
+    def test_prefix(self):
+        assert [m.id for m in search.search('matr', db_uri=self.db_uri)] == \
+            ['tt0133093', 'tt0000001']
+        assert [m.id for m in search.search('the matrix', db_uri=self.db_uri)] == ['tt0133093']
+
+    def test_people(self):
+        found = search.search('morgan free', db_uri=self.db_uri)
+        assert [m.id for m in found] == ['nm0000151']
+        assert search.search('', db_uri=self.db_uri) == []
+
+    def test_plot(self):
+        assert [m.id for m in search.search('hacker', db_uri=self.db_uri)] == \
+            ['tt0000001', 'tt0133093']
+
+    def test_records(self):
+        found = search.search_records('matr', db_uri=self.db_uri)
+        assert [r.id for r in found] == ['tt0133093', 'tt0000001']
+        assert found[0].title == 'The Matrix'
+
+    @classmethod
+    def tearDownClass(cls):
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
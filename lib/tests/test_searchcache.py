@@ -0,0 +1,122 @@
+import os
+import time
+import shutil
+import unittest
+import tempfile
+
+import pycurl
+
+from lib import constants, crawl, database, models, searchcache, service
+from lib.searchcache import SearchCache, search_key, hot_queries
+
+class TestSearchCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        matrix = models.Movie(id='tt0133093', title='The Matrix', poster=None, rating=8.7,
+                              plot='Neo.', duration='136 min', release_year=1999, genres=[])
+        mirror = models.TVShow(id='tt2085059', title='Black Mirror', poster=None, rating=8.9,
+                               plot='Tech.', release_year=2011, genres=[])
+        freeman = models.Person(id='nm0000151', firstname='Morgan', lastname='Freeman')
+        with database.WriteBuffer(cls.db_uri) as buffer:
+            for model in (matrix, mirror, freeman):
+                buffer.add_model(model)
+        database.store_search_results('matrix', [matrix], cls.db_uri)
+        database.store_search_results('mor', [matrix, mirror, freeman], cls.db_uri)
+
+    def test_search_key(self):
+        assert search_key('The Matrix!') == search_key('  the   MATRIX') == 'matrix'
+        assert search_key('A Beautiful Mind') == 'beautiful mind'
+        assert search_key('The') == 'the' and search_key('?!') == ''
+
+    def test_layers(self):
+        cache = SearchCache(ttl=60, db_uri=self.db_uri)
+        hit = cache.lookup('The Matrix')
+        assert hit.layer == 'database' and not hit.stale
+        assert [r.id for r in hit.records] == ['tt0133093']
+        assert cache.lookup('the matrix').layer == 'memory'
+
+        # "morgan fr" is answered by filtering the result set of "mor".
+        hit = cache.lookup('Morgan Fr')
+        assert hit.layer == 'prefix' and [r.id for r in hit.records] == ['nm0000151']
+        # Too short for a prefix, and a prefix whose results don't match.
+        assert cache.lookup('mo') is None and cache.lookup('mortal kombat') is None
+
+        assert dict(cache.stats) == {'database': 1, 'memory': 1, 'prefix': 1, 'miss': 2}
+        assert cache.hit_ratio() == 0.6
+        assert '60% hit ratio' in cache.summary()
+
+    def test_staleness(self):
+        cache = SearchCache(ttl=60, db_uri=self.db_uri)
+        later = time.time() + 120
+        hit = cache.lookup('matrix', now=later)
+        assert hit.stale and hit.layer == 'database'
+        assert cache.lookup('matrix', now=later).layer == 'memory'
+        # Stale sets don't answer longer queries.
+        assert cache.lookup('mortal', now=later) is None
+        cache.put('matrix', hit.records, fetched_at=later)
+        assert not cache.lookup('matrix', now=later).stale
+
+    def test_reload(self):
+        cache = SearchCache(ttl=60, db_uri=self.db_uri)
+        cache.put('matrix', [])
+        cache.put('unknown', [])
+        cache.reload('The Matrix')
+        cache.reload('unknown')
+        hit = cache.lookup('matrix')
+        assert hit.layer == 'memory' and [r.id for r in hit.records] == ['tt0133093']
+        assert 'unknown' not in cache.lru
+
+    def test_stale_fallback(self):
+        cache = searchcache.get_cache(self.db_uri)
+        saved = cache.ttl, crawl.process_url
+        cache.ttl = -1
+
+        def unreachable(url):
+            raise pycurl.error(pycurl.E_COULDNT_CONNECT, 'unreachable')
+
+        try:
+            for process_url in (unreachable, lambda url: None):
+                crawl.process_url = process_url
+                found = []
+                service.search('the matrix', found.append, remote=True, db_uri=self.db_uri)
+                assert [r.id for r in found] == ['tt0133093']
+            # Neither are programming errors.
+            crawl.process_url = lambda url: 1 / 0
+            self.assertRaises(ZeroDivisionError, service.search, 'the matrix', found.append,
+                              remote=True, db_uri=self.db_uri)
+            # Without a stale set the error isn't swallowed.
+            crawl.process_url = unreachable
+            self.assertRaises(pycurl.error, service.search, 'black', found.append, remote=True,
+                              db_uri=self.db_uri)
+        finally:
+            cache.ttl, crawl.process_url = saved
+
+    def test_prewarm(self):
+        directory = tempfile.mkdtemp()
+        saved = constants.query_log_path
+        constants.query_log_path = os.path.join(directory, 'queries.log')
+        try:
+            for query in ('The Matrix', 'matrix!', 'mor', 'unknown', 'Unknown', 'The Matrix'):
+                searchcache.log_query(query)
+            assert hot_queries(constants.query_log_path, 2) == ['matrix', 'unknown']
+
+            cache = SearchCache(ttl=60, db_uri=self.db_uri)
+            assert cache.prewarm(hot_queries(constants.query_log_path, 10)) == 2
+            assert len(cache.lru) == 2
+            assert cache.lookup('matrix').layer == 'memory'
+        finally:
+            constants.query_log_path = saved
+            shutil.rmtree(directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
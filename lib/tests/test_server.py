@@ -0,0 +1,80 @@
+import os
+import shutil
+import unittest
+import tempfile
+
+from lib import client, constants, database
+from lib.server import Server
+from lib.tests.server import StandInServer
+
+class TestServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_fd, cls.db_filepath = tempfile.mkstemp()
+        cls.db_uri = 'sqlite:///' + cls.db_filepath
+        cls.stand_in = StandInServer().__enter__()
+        cls.url_base = constants.url_base
+        constants.url_base = cls.stand_in.url
+        cls.server = Server('127.0.0.1:0', workers=2, db_uri=cls.db_uri).start()
+        cls.client = client.Client(cls.server.address, timeout=30)
+
+    def test_index_search_get(self):
+        source = '<a href="/title/tt0133093/"></a>'
+        found, expansion = self.client.index(source=source, with_cast=False)
+        assert [r.title for r in found] == ['The Matrix'] and expansion is None
+
+        assert [r.id for r in self.client.search('matrix')] == ['tt0133093']
+        assert self.client.get('tt0133093', fetch=False).release_year == 1999
+        assert self.client.get('nm0000151', fetch=False) is None
+        assert self.client.get('nm0000151').lastname == 'Freeman'
+        assert database.get_cached_model('nm0000151', self.db_uri) is not None
+
+        # The page of a merged identifier gives the model it was merged into.
+        self.stand_in.pages['/title/tt0000099'] = self.stand_in.pages['/title/tt0133093']
+        assert self.client.get('tt0000099').id == 'tt0133093'
+
+    def test_errors(self):
+        for method, path, params, status in (('GET', '/search', {'q': ''}, 400),
+                                             ('GET', '/search', {'q': 'x', 'limit': 'x'}, 400),
+                                             ('POST', '/search', None, 404),
+                                             ('GET', '/nowhere', None, 404)):
+            try:
+                self.client.request(method, path, params)
+            except client.ServerError as e:
+                assert e.status == status
+            else:
+                raise AssertionError('{} {} succeeded'.format(method, path))
+        self.assertRaises(client.ServerError, client.Client('127.0.0.1:1').status)
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'imdbooo.sock')
+        try:
+            server = Server('unix:' + path, workers=1, db_uri=self.db_uri).start()
+            # A second server refuses to take over the socket of a running one.
+            self.assertRaises(ValueError, Server, path)
+            assert client.Client(server.address).status()['pid'] == os.getpid()
+            server.close()
+            assert not os.path.exists(path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parse_address(self):
+        assert client.parse_address('unix:/tmp/a.sock') == ('unix', '/tmp/a.sock')
+        assert client.parse_address('database/a.sock') == ('unix', 'database/a.sock')
+        assert client.parse_address('http://localhost:8642/') == ('tcp', ('localhost', 8642))
+        assert client.parse_address(':8642') == ('tcp', ('127.0.0.1', 8642))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        constants.url_base = cls.url_base
+        cls.stand_in.__exit__(None, None, None)
+        database.dispose_db(cls.db_uri)
+        os.close(cls.db_fd)
+        os.unlink(cls.db_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,21 @@
 #!/bin/bash
 
 #
-# Make sure the indexer keeps running when it either finishes or crashes.
+# Keep the crawler running: restart it whenever it exits or crashes. The frontier is
+# persistent, so every restart resumes where the last run stopped.
+# Pass any argument to the script to use torify.
 #
 
+use_torify=$1
+
 while true
 do
-    process_alive=$(pgrep rnd.sh)
-    if [ ! $process_alive ]
+    echo 'Starting crawler...'
+    if [ $use_torify ]
     then
-        echo 'Restarting crawler...'
-        ./rnd.sh $@
+        torify python imdbooo.py crawl --random 100
+    else
+        python imdbooo.py crawl --random 100
     fi
+    sleep 1
 done
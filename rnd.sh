@@ -2,17 +2,20 @@
 #
 # Randomly crawl things.
 # Pass any argument to the script to use torify.
+# Set IMDBOOO_SERVER to forward the call to a running `imdbooo.py serve`.
 #
 
 use_torify=$1
 url='http://m.imdb.com'
-random_id=$(python -c 'import random; print("{:07}".format(random.randrange(1, 9999999)))')
-random_type=$(python -c 'import random; print(random.choice(("title", "name")))')
+# $RANDOM has 15 bits, two draws make 30, enough for the 1 to 9999998 range.
+random_id=$(printf '%07d' $(( (RANDOM * 32768 + RANDOM) % 9999998 + 1 )))
 
-if [ $random_type == 'title' ]
+if (( RANDOM % 2 ))
 then
+    random_type='title'
     random_type_alias='tt'
 else
+    random_type='name'
     random_type_alias='nm'
 fi
 